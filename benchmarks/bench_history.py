@@ -0,0 +1,145 @@
+"""
+Benchmark of the account history query against the total size of the transaction table.
+
+Fills an SQLite DB with transactions of unrelated accounts and measures how long it takes to fetch
+a page of history of an account with a fixed number of transactions. Latency of the per-direction
+UNION ALL query should stay flat as the table grows, unlike the `account_from = X OR account_to = X` filter.
+
+    python -m benchmarks.bench_history --sizes 10000 100000 1000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from wallet import models
+from wallet.db import DB, account, init_db, transaction
+
+ACCOUNTS = 1000
+ACCOUNT_TRANSACTIONS = 500
+DAY = datetime(2021, 6, 1)
+# Other accounts' transactions are spread over the queried time range
+WINDOW_DAYS = 30
+
+
+def populate(engine: sqlalchemy.engine.Engine, start: int, stop: int):
+    rnd = random.Random(start)
+    rows = []
+    for i in range(start, stop):
+        account_from, account_to = rnd.sample(range(3, ACCOUNTS + 3), 2)
+        rows.append(
+            {
+                "id": f"bg{i}",
+                "account_from": account_from,
+                "account_to": account_to,
+                "type": models.TransactionType.transfer,
+                "amount": 1,
+                "created": DAY
+                - timedelta(
+                    days=rnd.randrange(365), seconds=rnd.randrange(86400)
+                ),
+            }
+        )
+        if len(rows) == 10000:
+            engine.execute(transaction.insert(), rows)
+            rows = []
+    if rows:
+        engine.execute(transaction.insert(), rows)
+
+
+def setup(engine: sqlalchemy.engine.Engine) -> int:
+    init_db(engine)
+    engine.execute(
+        account.insert(),
+        [
+            {"id": i, "username": f"user{i}", "password": ""}
+            for i in range(2, ACCOUNTS + 3)
+        ],
+    )
+    # The benchmarked account, with transactions in both directions on the same day
+    engine.execute(
+        transaction.insert(),
+        [
+            {
+                "id": f"acc{i}",
+                "account_from": 2 if i % 2 else 3,
+                "account_to": 3 if i % 2 else 2,
+                "type": models.TransactionType.transfer,
+                "amount": 1,
+                "created": DAY + timedelta(seconds=i * 60),
+            }
+            for i in range(ACCOUNT_TRANSACTIONS)
+        ],
+    )
+    return 2
+
+
+async def measure(db: DB, query_fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await db._db.fetch_all(query_fn())
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def run(sizes: list[int], repeat: int, limit: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.sqlite3")
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        account_id = setup(engine)
+        db = DB(f"sqlite:///{path}")
+        await db._db.connect()
+        populated = 0
+        dt_from = DAY - timedelta(days=WINDOW_DAYS)
+        dt_to = DAY + timedelta(days=1)
+
+        def union_all():
+            return DB._history_query(
+                account_id, dt_from, dt_to, limit, models.Ordering.desc
+            )
+
+        def or_filter():
+            return (
+                DB._transaction_query(for_account=account_id)
+                .where(transaction.c.created >= dt_from)
+                .where(transaction.c.created <= dt_to)
+                .order_by(transaction.c.created.desc(), transaction.c.id.desc())
+                .limit(limit)
+            )
+
+        for size in sorted(sizes):
+            populate(engine, populated, size)
+            populated = size
+            engine.execute("ANALYZE")
+            print(
+                json.dumps(
+                    {
+                        "rows": size + ACCOUNT_TRANSACTIONS,
+                        "union_all_ms": round(
+                            await measure(db, union_all, repeat), 3
+                        ),
+                        "or_filter_ms": round(
+                            await measure(db, or_filter, repeat), 3
+                        ),
+                    }
+                )
+            )
+        await db._db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 500000]
+    )
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.repeat, args.limit))
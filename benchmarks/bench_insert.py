@@ -0,0 +1,177 @@
+"""
+Benchmark of inserting transactions keyed by the client ID against keyed by the internal integer `pk`.
+
+Clients send random IDs, so a string primary key inserts into random pages of the clustered index,
+while an increasing integer one appends. Throughput is measured in batches as the table grows, along with
+the size of the table and its indexes. Uses a temporary SQLite DB unless `--db-uri` is given,
+e.g. a MySQL one, where the tables are created and dropped with a `bench_` prefix.
+
+    python -m benchmarks.bench_insert --rows 200000
+"""
+from typing import Optional
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from wallet import models
+from wallet.db import INSERT_CHUNK_SIZE
+
+DAY = datetime(2021, 6, 1)
+
+
+def tables(
+    metadata: sqlalchemy.MetaData,
+) -> dict[str, sqlalchemy.Table]:
+    """
+    The transaction table with each kind of key, with the same indexes as `wallet.db.transaction`.
+    """
+    result = {}
+    for key in ("client_id", "pk"):
+        name = f"bench_transaction_{key}"
+        columns = [
+            sqlalchemy.Column(
+                "id",
+                sqlalchemy.String(length=255),
+                nullable=False,
+                primary_key=key == "client_id",
+                unique=key == "pk",
+            ),
+            sqlalchemy.Column(
+                "account_from", sqlalchemy.Integer, nullable=False
+            ),
+            sqlalchemy.Column("account_to", sqlalchemy.Integer, nullable=False),
+            sqlalchemy.Column(
+                "type", sqlalchemy.Enum(models.TransactionType), nullable=False
+            ),
+            sqlalchemy.Column("amount", sqlalchemy.Integer, nullable=False),
+            sqlalchemy.Column("created", sqlalchemy.DateTime, nullable=False),
+        ]
+        if key == "pk":
+            columns.insert(
+                0,
+                sqlalchemy.Column(
+                    "pk",
+                    sqlalchemy.BigInteger().with_variant(
+                        sqlalchemy.Integer, "sqlite"
+                    ),
+                    primary_key=True,
+                ),
+            )
+        result[key] = sqlalchemy.Table(
+            name,
+            metadata,
+            *columns,
+            sqlalchemy.Index(f"ix_{name}_created_id", "created", "id"),
+            sqlalchemy.Index(
+                f"ix_{name}_account_from_created",
+                "account_from",
+                "created",
+                "id",
+            ),
+            sqlalchemy.Index(
+                f"ix_{name}_account_to_created", "account_to", "created", "id"
+            ),
+        )
+    return result
+
+
+def batch(rnd: random.Random, start: int, size: int) -> list[dict]:
+    return [
+        {
+            "id": "%032x" % rnd.getrandbits(128),
+            "account_from": rnd.randrange(2, 10000),
+            "account_to": rnd.randrange(2, 10000),
+            "type": models.TransactionType.transfer,
+            "amount": 100,
+            "created": DAY + timedelta(milliseconds=i),
+        }
+        for i in range(start, start + size)
+    ]
+
+
+def table_size(
+    engine: sqlalchemy.engine.Engine, table: sqlalchemy.Table
+) -> Optional[int]:
+    """
+    Bytes taken by the table and its indexes, if the DB reports it.
+    """
+    if engine.dialect.name == "mysql":
+        engine.execute(f"ANALYZE TABLE {table.name}")
+        return engine.execute(
+            "SELECT data_length + index_length FROM information_schema.tables"
+            " WHERE table_schema = DATABASE() AND table_name = %s",
+            table.name,
+        ).scalar()
+    if engine.dialect.name == "sqlite":
+        # Pages in use by the whole DB, which only holds this table at a time
+        pages = engine.execute("PRAGMA page_count").scalar()
+        free = engine.execute("PRAGMA freelist_count").scalar()
+        return (pages - free) * engine.execute("PRAGMA page_size").scalar()
+    return None
+
+
+def run(db_uri: str, rows: int, steps: int):
+    engine = sqlalchemy.create_engine(db_uri)
+    metadata = sqlalchemy.MetaData()
+    step = rows // steps
+    try:
+        for key, table in tables(metadata).items():
+            table.create(engine)
+            rnd = random.Random(0)
+            inserted = 0
+            while inserted < rows:
+                start = time.perf_counter()
+                for offset in range(
+                    inserted, inserted + step, INSERT_CHUNK_SIZE
+                ):
+                    with engine.begin() as conn:
+                        conn.execute(
+                            table.insert(),
+                            batch(
+                                rnd,
+                                offset,
+                                min(
+                                    INSERT_CHUNK_SIZE, inserted + step - offset
+                                ),
+                            ),
+                        )
+                elapsed = time.perf_counter() - start
+                inserted += step
+                print(
+                    json.dumps(
+                        {
+                            "key": key,
+                            "rows": inserted,
+                            "rows_per_s": round(step / elapsed),
+                            "size_bytes": table_size(engine, table),
+                        }
+                    )
+                )
+            table.drop(engine)
+    finally:
+        metadata.drop_all(engine, checkfirst=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument(
+        "--steps", type=int, default=4, help="Batches to report throughput of"
+    )
+    parser.add_argument(
+        "--db-uri",
+        help="SQLAlchemy URI of the DB, a temporary SQLite one by default",
+    )
+    args = parser.parse_args()
+    if args.db_uri is not None:
+        run(args.db_uri, args.rows, args.steps)
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "bench.sqlite3")
+            run(f"sqlite:///{path}", args.rows, args.steps)
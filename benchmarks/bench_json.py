@@ -0,0 +1,95 @@
+"""
+Benchmark of encoding transaction history pages to JSON responses.
+
+Compares the response model path, where FastAPI validates models and runs `jsonable_encoder` on them,
+with encoding plain dicts by `FastJSONResponse`, with and without `orjson`.
+
+    python -m benchmarks.bench_json --sizes 100 1000
+"""
+from typing import List
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from starlette.responses import JSONResponse
+from wallet import models, responses
+from wallet.responses import FastJSONResponse
+
+DAY = datetime(2021, 6, 1)
+
+
+def page(size: int) -> list[dict]:
+    return [
+        {
+            "account_to": {"id": 3, "username": "user3"},
+            "amount": 100 + i,
+            "type": models.TransactionType.transfer,
+            "id": f"{i:064x}",
+            "created": DAY + timedelta(seconds=i),
+            "account_from": {"id": 2, "username": "user2"},
+        }
+        for i in range(size)
+    ]
+
+
+async def response_model(field, rows: list[dict]) -> bytes:
+    content = await serialize_response(
+        field=field,
+        response_content=[models.Transaction.construct(**row) for row in rows],
+    )
+    return JSONResponse(content).body
+
+
+async def fast(rows: list[dict]) -> bytes:
+    return FastJSONResponse(rows).body
+
+
+async def fast_stdlib(rows: list[dict]) -> bytes:
+    orjson, responses.orjson = responses.orjson, None
+    try:
+        return FastJSONResponse(rows).body
+    finally:
+        responses.orjson = orjson
+
+
+async def pages_per_second(fn, duration: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < duration:
+        await fn()
+        count += 1
+    return count / elapsed
+
+
+async def run(sizes: list[int], duration: float):
+    field = create_response_field(
+        name="Response", type_=List[models.Transaction]
+    )
+    for size in sizes:
+        rows = page(size)
+        cases = {
+            "response_model": lambda: response_model(field, rows),
+            "fast_json": lambda: fast(rows),
+            "fast_json_stdlib": lambda: fast_stdlib(rows),
+        }
+        results = {"rows": size}
+        for name, fn in cases.items():
+            results[f"{name}_pages_per_s"] = round(
+                await pages_per_second(fn, duration), 1
+            )
+        print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument(
+        "--duration", type=float, default=2.0, help="Seconds per case"
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.duration))
@@ -0,0 +1,172 @@
+"""
+Microbenchmarks of hot helpers, with a stored baseline to catch regressions.
+
+Each benchmark calls a helper with fixed inputs in a loop, calibrated to run for at least `--min-time`
+seconds, and keeps the fastest of `--repeat` runs, which is the least affected by noise.
+Results are printed as JSON lines in microseconds per call.
+
+    python -m benchmarks.bench_micro --save benchmarks/baseline.json
+    python -m benchmarks.bench_micro --compare benchmarks/baseline.json --threshold 20
+
+With `--compare`, the exit status is 1 if any helper got slower than the baseline by more than
+`--threshold` percent. Baselines only make sense on the machine and Python version they were saved on,
+so save a new one before comparing on another machine.
+"""
+from typing import Callable
+
+import argparse
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+
+import sqlalchemy
+from wallet import auth, models
+from wallet.db import DB
+
+ROW = {
+    "pk": 1,
+    "id": "0123456789abcdef0123456789abcdef",
+    "account_from": 2,
+    "account_to": 3,
+    "type": models.TransactionType.transfer,
+    "amount": 100,
+    "created": datetime(2021, 6, 1, 12, 30, 15),
+}
+USERNAMES = {2: "user2", 3: "user3"}
+TRANSACTION_DATA = DB._transaction_dict(ROW, USERNAMES)
+TRANSACTION = models.Transaction(**TRANSACTION_DATA)
+SQLITE = sqlalchemy.dialects.sqlite.dialect()
+
+
+def password_hash():
+    auth.get_password_hash("1q2w3e4r", "0123456789abcdef")
+
+
+def transaction_query():
+    DB._transaction_query(for_account=2)
+
+
+def transaction_query_compile():
+    DB._transaction_query(for_account=2).compile(dialect=SQLITE)
+
+
+def build_transaction_model():
+    DB._build_transaction_model(ROW, USERNAMES)
+
+
+def transaction_validate():
+    models.Transaction(**TRANSACTION_DATA)
+
+
+def transaction_serialize():
+    TRANSACTION.json()
+
+
+BENCHMARKS: dict[str, Callable[[], None]] = {
+    fn.__name__: fn
+    for fn in (
+        password_hash,
+        transaction_query,
+        transaction_query_compile,
+        build_transaction_model,
+        transaction_validate,
+        transaction_serialize,
+    )
+}
+
+
+def measure(fn: Callable[[], None], min_time: float, repeat: int) -> float:
+    """
+    Fastest time of one call in microseconds.
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    timings = [elapsed]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings) / loops * 1e6
+
+
+def compare(results: dict[str, float], path: str, threshold: float) -> bool:
+    """
+    Print the change of each result against the baseline. Returns whether any of them regressed.
+    """
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+    regressed = False
+    for name, value in results.items():
+        line = {"name": name, "us": round(value, 3)}
+        if name in baseline:
+            change = (value / baseline[name] - 1) * 100
+            line.update(
+                baseline_us=baseline[name],
+                change_pct=round(change, 1),
+                regressed=change > threshold,
+            )
+            regressed = regressed or change > threshold
+        print(json.dumps(line))
+    return regressed
+
+
+def main(args: argparse.Namespace) -> int:
+    names = args.only or list(BENCHMARKS)
+    results = {
+        name: measure(BENCHMARKS[name], args.min_time, args.repeat)
+        for name in names
+    }
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    for name, value in results.items():
+        print(json.dumps({"name": name, "us": round(value, 3)}))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "results": {
+                        name: round(value, 3) for name, value in results.items()
+                    },
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), help="Benchmarks to run"
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="Minimum duration of a run in seconds",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--save", help="Write the results as a baseline")
+    output.add_argument(
+        "--compare", help="Baseline to compare the results with"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20.0,
+        help="Slowdown against the baseline, in percent, that counts as a regression",
+    )
+    sys.exit(main(parser.parse_args()))
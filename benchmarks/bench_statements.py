@@ -0,0 +1,147 @@
+"""
+Benchmark of building and compiling the hot DB queries against binding values to precompiled statements.
+
+Measures the per-call overhead that `databases` adds before a query reaches the driver, i.e. everything
+but the query execution itself, and the latency of whole `DB` calls on a small SQLite DB.
+
+    python -m benchmarks.bench_statements --repeat 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from wallet import models
+from wallet.db import DB, account, init_db, transaction
+
+DAY = datetime(2021, 6, 1)
+
+
+def setup(engine: sqlalchemy.engine.Engine):
+    init_db(engine)
+    engine.execute(
+        account.insert(),
+        [
+            {"id": i, "username": f"user{i}", "password": ""}
+            for i in range(2, 4)
+        ],
+    )
+    engine.execute(
+        transaction.insert(),
+        [
+            {
+                "id": f"tx{i}",
+                "account_from": 2 if i % 2 else 3,
+                "account_to": 3 if i % 2 else 2,
+                "type": models.TransactionType.transfer,
+                "amount": 1,
+                "created": DAY + timedelta(seconds=i * 60),
+            }
+            for i in range(100)
+        ],
+    )
+
+
+def measure_sync(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e6
+
+
+async def measure_async(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e6
+
+
+async def run(repeat: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.sqlite3")
+        setup(sqlalchemy.create_engine(f"sqlite:///{path}"))
+        db = DB(f"sqlite:///{path}")
+        await db.connect()
+        # Backend connection compiles queries the same way as for execution
+        backend = db._db.connection()._connection
+        history_args = (
+            2,
+            DAY,
+            DAY + timedelta(days=1),
+            20,
+            models.Ordering.desc,
+            (DAY + timedelta(minutes=50), "tx50"),
+        )
+        history_values = {
+            "account_id": 2,
+            "dt_from": history_args[1],
+            "dt_to": history_args[2],
+            "limit": history_args[3],
+            "after_created": history_args[5][0],
+            "after_id": history_args[5][1],
+        }
+        # Query as built before precompiling, `DB` call, statement shape and its values
+        cases = {
+            "get_account": (
+                lambda: account.select().where(account.c.id == 2),
+                lambda: db.get_account(2),
+                ("account", "id"),
+                {"value": 2},
+            ),
+            "get_transaction": (
+                lambda: DB._transaction_query(for_account=2).where(
+                    transaction.c.id == "tx1"
+                ),
+                lambda: db.get_transaction("tx1", 2),
+                ("transaction", True),
+                {"transaction_id": "tx1", "account_id": 2},
+            ),
+            "get_transactions": (
+                lambda: DB._history_query(*history_args),
+                lambda: db.get_transactions(*history_args),
+                ("history", models.Ordering.desc, *sorted(history_values)),
+                history_values,
+            ),
+        }
+        for name, (build, call, shape, values) in cases.items():
+            # The first call compiles and caches the statement
+            await call()
+            statement = db._statements[("sqlite", shape)]
+            print(
+                json.dumps(
+                    {
+                        "query": name,
+                        "build_compile_us": round(
+                            measure_sync(
+                                lambda: backend._compile(build()), repeat
+                            ),
+                            1,
+                        ),
+                        "precompiled_us": round(
+                            measure_sync(
+                                lambda: backend._compile(statement(**values)),
+                                repeat,
+                            ),
+                            1,
+                        ),
+                        "call_us": round(await measure_async(call, repeat), 1),
+                    }
+                )
+            )
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(run(args.repeat))
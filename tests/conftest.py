@@ -1,6 +1,7 @@
 from typing import Coroutine, Generator
 
 import asyncio
+import os
 
 import httpx
 import pytest
@@ -48,11 +49,30 @@ async def client(test_db: DB) -> Generator[httpx.AsyncClient, None, None]:
 @pytest.fixture
 async def db_session(test_db: DB) -> Generator[DB, None, None]:
     try:
-        await test_db._db.connect()
+        await test_db.connect()
+        test_db.clear_caches()
         async with test_db._db.transaction(force_rollback=True):
             yield test_db
     finally:
-        await test_db._db.disconnect()
+        await test_db.disconnect()
+
+
+@pytest.fixture
+async def file_db(tmpdir) -> DB:
+    """
+    SQLite DB in a file without the rollback of `db_session`, so concurrent calls use separate connections.
+
+    Calls have to run in their own tasks, as `databases` keeps the connection for the task.
+    """
+    url = f"sqlite:///{os.path.join(tmpdir, 'concurrent.sqlite3')}"
+    init_db(create_engine(url))
+    # Transactions waiting for the write lock give up after `timeout` seconds, which slow test runs can exceed.
+    # A deadlock, where a transaction can't get the lock at all, still fails at once.
+    database = DB(url, timeout=600)
+    await database.connect()
+    yield database
+    await database.slow_query_log.join()
+    await database.disconnect()
 
 
 @pytest.fixture
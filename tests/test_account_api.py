@@ -1,11 +1,13 @@
+from datetime import date, datetime
+
 import httpx
 import pytest
 from wallet.auth import get_password_hash
-from wallet.db import DB
-from wallet.models import Account
+from wallet.db import DB, balance_snapshot
+from wallet.models import Account, TransactionType
 from wallet.settings import settings
 
-from . import asserts
+from . import asserts, factories
 
 
 @pytest.mark.asyncio
@@ -87,3 +89,222 @@ async def test_get_wrong_username(account: Account, client: httpx.AsyncClient):
 async def test_get_wrong_password(account: Account, client: httpx.AsyncClient):
     response = await client.get("/account", auth=(account.auth[0], "unknown"))
     assert response.status_code == 401, response.json()
+
+
+@pytest.mark.asyncio
+async def test_create_token(account: Account, client: httpx.AsyncClient):
+    response = await client.post("/token", auth=account.auth)
+    assert response.status_code == 200, response.json()
+    token = response.json()
+    assert token["token_type"] == "bearer"
+    assert token["expires_in"] == settings.TOKEN_TTL
+
+    response = await client.get(
+        "/account",
+        headers={"Authorization": f"Bearer {token['access_token']}"},
+    )
+    assert response.status_code == 200, response.json()
+    assert response.json() == {
+        "id": account.id,
+        "username": account.username,
+        "balance": account.balance,
+    }
+
+
+@pytest.mark.asyncio
+async def test_create_token_wrong_password(
+    account: Account, client: httpx.AsyncClient
+):
+    response = await client.post("/token", auth=(account.auth[0], "unknown"))
+    assert response.status_code == 401, response.json()
+
+
+@pytest.mark.asyncio
+async def test_get_invalid_token(account: Account, client: httpx.AsyncClient):
+    response = await client.get(
+        "/account", headers={"Authorization": "Bearer invalid"}
+    )
+    assert response.status_code == 401, response.json()
+    # Header values are decoded as Latin-1, so non-ASCII tokens reach the app
+    response = await client.get(
+        "/account", headers={"Authorization": "Bearer abc.é".encode("latin-1")}
+    )
+    assert response.status_code == 401, response.json()
+
+
+@pytest.mark.asyncio
+async def test_get_balance(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    # Created without snapshots, the current balance is 1000
+    await factories.transaction(
+        db_session,
+        settings.TOPUP_ACCOUNT_ID,
+        account.id,
+        TransactionType.topup,
+        300,
+        created=datetime(2021, 6, 1, 10),
+    )
+    await factories.transaction(
+        db_session,
+        account.id,
+        second_account.id,
+        TransactionType.transfer,
+        100,
+        created=datetime(2021, 6, 2, 10),
+    )
+
+    async def get_balance(at: datetime) -> int:
+        response = await client.get(
+            "/account/balance", params={"at": at}, auth=account.auth
+        )
+        assert response.status_code == 200, response.json()
+        assert response.json()["at"] == at.isoformat()
+        return response.json()["balance"]
+
+    assert await get_balance(datetime(2021, 6, 3)) == 1000
+    assert await get_balance(datetime(2021, 6, 2, 9)) == 1100
+    assert await get_balance(datetime(2021, 6, 1, 9)) == 800
+
+    # Snapshots are preferred to the current balance
+    await db_session._db.execute(
+        balance_snapshot.insert(),
+        values={
+            "account_id": account.id,
+            "day": date(2021, 5, 31),
+            "balance": 0,
+        },
+    )
+    assert await get_balance(datetime(2021, 6, 1, 9)) == 0
+    assert await get_balance(datetime(2021, 6, 2, 9)) == 300
+    assert await get_balance(datetime(2021, 6, 3)) == 200
+
+
+@pytest.mark.asyncio
+async def test_get_current_balance(account: Account, client: httpx.AsyncClient):
+    response = await client.get("/account/balance", auth=account.auth)
+    assert response.status_code == 200, response.json()
+    assert response.json()["balance"] == account.balance
+
+
+@pytest.mark.asyncio
+async def test_get_summary(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+):
+    for transaction_id, body in (
+        ("topup", {"amount": 300, "type": "topup"}),
+        (
+            "transfer1",
+            {
+                "account_to": {"id": second_account.id},
+                "amount": 100,
+                "type": "transfer",
+            },
+        ),
+        (
+            "transfer2",
+            {
+                "account_to": {"id": second_account.id},
+                "amount": 50,
+                "type": "transfer",
+            },
+        ),
+    ):
+        response = await client.put(
+            f"/transactions/{transaction_id}", json=body, auth=account.auth
+        )
+        assert response.status_code == 201, response.json()
+    response = await client.put(
+        "/transactions/transfer3",
+        json={
+            "account_to": {"id": account.id},
+            "amount": 10,
+            "type": "transfer",
+        },
+        auth=("test2", "123456"),
+    )
+    assert response.status_code == 201, response.json()
+
+    today = datetime.utcnow().date().isoformat()
+    response = await client.get("/account/summary", auth=account.auth)
+    assert response.status_code == 200, response.json()
+    assert response.json() == [
+        {
+            "period": today,
+            "type": "topup",
+            "count_in": 1,
+            "amount_in": 300,
+            "count_out": 0,
+            "amount_out": 0,
+        },
+        {
+            "period": today,
+            "type": "transfer",
+            "count_in": 1,
+            "amount_in": 10,
+            "count_out": 2,
+            "amount_out": 150,
+        },
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_summary_periods(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    # Created without rollup rows, they are filled in by rebuilding
+    for created in (
+        datetime(2021, 5, 30, 10),
+        datetime(2021, 5, 31, 10),
+        datetime(2021, 6, 1, 10),
+    ):
+        await factories.transaction(
+            db_session,
+            account.id,
+            second_account.id,
+            TransactionType.transfer,
+            100,
+            created=created,
+        )
+    for day in (date(2021, 5, 30), date(2021, 5, 31), date(2021, 6, 1)):
+        await db_session.rebuild_rollup(day)
+
+    async def get_summary(period: str) -> list[tuple[str, int]]:
+        response = await client.get(
+            "/account/summary",
+            params={
+                "date_from": "2021-05-01",
+                "date_to": "2021-06-30",
+                "period": period,
+            },
+            auth=account.auth,
+        )
+        assert response.status_code == 200, response.json()
+        return [(row["period"], row["amount_out"]) for row in response.json()]
+
+    assert await get_summary("day") == [
+        ("2021-05-30", 100),
+        ("2021-05-31", 100),
+        ("2021-06-01", 100),
+    ]
+    # May 30 is Sunday
+    assert await get_summary("week") == [
+        ("2021-05-24", 100),
+        ("2021-05-31", 200),
+    ]
+    assert await get_summary("month") == [
+        ("2021-05-01", 200),
+        ("2021-06-01", 100),
+    ]
+
+    # Rebuilding doesn't count transactions twice
+    await db_session.rebuild_rollup(date(2021, 6, 1))
+    assert (await get_summary("month"))[-1] == ("2021-06-01", 100)
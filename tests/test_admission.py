@@ -0,0 +1,89 @@
+import asyncio
+
+import httpx
+import pytest
+from wallet import api
+from wallet.admission import AdmissionController, Overloaded
+from wallet.models import Account
+
+
+async def hold(controller: AdmissionController, account_id: int, event):
+    async with controller.admit(account_id):
+        await event.wait()
+
+
+@pytest.mark.asyncio
+async def test_admission_account_limit():
+    controller = AdmissionController(1, 1, None, 0, retry_after=2)
+    release = asyncio.Event()
+    running = asyncio.create_task(hold(controller, 1, release))
+    waiting = asyncio.create_task(hold(controller, 1, release))
+    await asyncio.sleep(0)
+    assert controller.stats()["account_active"] == 1
+    assert controller.stats()["account_waiting"] == 1
+
+    with pytest.raises(Overloaded) as exc_info:
+        async with controller.admit(1):
+            pass
+    assert exc_info.value.retry_after == 2
+    # Other accounts aren't affected
+    async with controller.admit(2):
+        pass
+
+    release.set()
+    await asyncio.gather(running, waiting)
+    assert controller.stats() == {
+        "accounts": 0,
+        "account_active": 0,
+        "account_waiting": 0,
+        "account_rejected": 1,
+        "global_active": 0,
+        "global_waiting": 0,
+        "global_rejected": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_admission_global_limit():
+    controller = AdmissionController(None, 0, 1, 0, retry_after=1)
+    release = asyncio.Event()
+    running = asyncio.create_task(hold(controller, 1, release))
+    await asyncio.sleep(0)
+    with pytest.raises(Overloaded):
+        async with controller.admit(2):
+            pass
+    release.set()
+    await running
+    assert controller.stats()["global_rejected"] == 1
+    assert controller.stats()["global_active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_cancelled_waiter():
+    controller = AdmissionController(1, 1, None, 0, retry_after=1)
+    release = asyncio.Event()
+    running = asyncio.create_task(hold(controller, 1, release))
+    waiting = asyncio.create_task(hold(controller, 1, release))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+    assert controller.stats()["account_waiting"] == 0
+    release.set()
+    await running
+    assert controller.stats()["accounts"] == 0
+
+
+@pytest.mark.asyncio
+async def test_create_transaction_overloaded(
+    account: Account, client: httpx.AsyncClient, monkeypatch
+):
+    monkeypatch.setattr(
+        api, "admission", AdmissionController(0, 0, None, 0, retry_after=3)
+    )
+    response = await client.put(
+        "/transactions/transid",
+        json={"amount": 100, "type": "topup"},
+        auth=account.auth,
+    )
+    assert response.status_code == 429, response.json()
+    assert response.headers["Retry-After"] == "3"
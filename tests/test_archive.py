@@ -0,0 +1,139 @@
+from datetime import datetime
+
+import pytest
+from wallet import archive
+from wallet.archive import Archiver
+from wallet.db import DB, transaction, transaction_archive
+from wallet.models import Ordering, TransactionStatus, TransactionType
+from wallet.reconcile import Reconciler
+from wallet.settings import settings
+
+from . import factories
+
+
+async def count(db_session: DB, table) -> int:
+    return len(await db_session._db.fetch_all(table.select()))
+
+
+@pytest.mark.asyncio
+async def test_archive(db_session: DB, monkeypatch):
+    first = await factories.account(db_session, "first", "1q2w3e", 1000)
+    second = await factories.account(db_session, "second", "1q2w3e")
+    for day in range(1, 6):
+        await factories.transaction(
+            db_session,
+            first.id,
+            second.id,
+            TransactionType.transfer,
+            amount=day,
+            id_=f"transfer{day}",
+            created=datetime(2021, 6, day),
+        )
+    balance_before = await db_session.get_balance(
+        second.id, datetime(2021, 6, 3, 12)
+    )
+    await Reconciler(db_session._db, lag=0).run()
+
+    # Chunks are copied with more than one INSERT
+    monkeypatch.setattr(archive, "INSERT_CHUNK_SIZE", 2)
+    archiver = Archiver(db_session._db, chunk_size=3, delete_delay=0)
+    watermark = await archiver.run(datetime(2021, 6, 4))
+    assert watermark == datetime(2021, 6, 4)
+    assert (archiver.copied, archiver.deleted) == (3, 3)
+    assert await count(db_session, transaction) == 2
+    assert await count(db_session, transaction_archive) == 3
+    # The watermark doesn't move back
+    assert await archiver.run(datetime(2021, 6, 1)) == watermark
+    assert (archiver.copied, archiver.deleted) == (0, 0)
+    db_session.clear_caches()
+
+    # Pages continue across the watermark in both orders
+    for order, ids in (
+        (Ordering.desc, [5, 4, 3, 2, 1]),
+        (Ordering.asc, [1, 2, 3, 4, 5]),
+    ):
+        page = await db_session.get_transactions(
+            second.id, limit=2, order=order
+        )
+        page += await db_session.get_transactions(
+            second.id,
+            limit=3,
+            order=order,
+            after=(page[-1].created, page[-1].id),
+        )
+        assert [t.id for t in page] == [f"transfer{day}" for day in ids]
+    in_range = await db_session.get_transactions(
+        second.id,
+        dt_from=datetime(2021, 6, 2),
+        dt_to=datetime(2021, 6, 4),
+        order=Ordering.asc,
+    )
+    assert [t.id for t in in_range] == ["transfer2", "transfer3", "transfer4"]
+
+    archived = await db_session.get_transaction("transfer1", second.id)
+    assert archived is not None and archived.amount == 1
+    assert (
+        await db_session.get_balance(second.id, datetime(2021, 6, 3, 12))
+        == balance_before
+    )
+    # Retries of archived transactions are still recognized
+    assert (
+        await db_session.create_transaction(
+            "transfer1", first.id, second.id, 1, TransactionType.transfer
+        )
+        is TransactionStatus.replayed
+    )
+    assert (
+        await db_session.create_transaction(
+            "transfer2", first.id, second.id, 1, TransactionType.transfer
+        )
+        is TransactionStatus.conflict
+    )
+
+
+@pytest.mark.asyncio
+async def test_archive_keeps_unreconciled(db_session: DB):
+    first = await factories.account(db_session, "first", "1q2w3e")
+    for day in (1, 2):
+        await factories.transaction(
+            db_session,
+            settings.TOPUP_ACCOUNT_ID,
+            first.id,
+            TransactionType.topup,
+            id_=f"topup{day}",
+            created=datetime(2021, 6, day),
+        )
+    await Reconciler(db_session._db, lag=0).run()
+    await factories.transaction(
+        db_session,
+        settings.TOPUP_ACCOUNT_ID,
+        first.id,
+        TransactionType.topup,
+        id_="topup3",
+        created=datetime(2021, 6, 3),
+    )
+
+    # Archival stops at the reconciliation checkpoint
+    archiver = Archiver(db_session._db, delete_delay=0)
+    assert await archiver.run(datetime(2021, 6, 10)) == datetime(2021, 6, 2)
+    assert archiver.copied == 1
+    assert await count(db_session, transaction) == 2
+
+
+@pytest.mark.asyncio
+async def test_archive_without_reconciliation(db_session: DB):
+    first = await factories.account(db_session, "first", "1q2w3e", 100)
+    await factories.transaction(
+        db_session,
+        settings.TOPUP_ACCOUNT_ID,
+        first.id,
+        TransactionType.topup,
+        created=datetime(2021, 6, 1),
+    )
+
+    # The reconciliation job would miss archived transactions
+    archiver = Archiver(db_session._db, delete_delay=0)
+    assert await archiver.run(datetime(2021, 6, 10)) is None
+    assert (archiver.copied, archiver.deleted) == (0, 0)
+    assert await count(db_session, transaction) == 1
+    assert await Reconciler(db_session._db, lag=0).run() == []
@@ -1,4 +1,14 @@
-from wallet.auth import get_password_hash, verify_password_hash
+import pytest
+from wallet.auth import (
+    CredentialCache,
+    create_token,
+    get_password_hash,
+    get_password_hash_async,
+    verify_password_hash,
+    verify_password_hash_async,
+    verify_token,
+)
+from wallet.models import User
 from wallet.settings import settings
 
 
@@ -9,3 +19,68 @@ def test_verify_password_hash():
 def test_salt():
     salt = "a" * settings.SALT_LENGTH
     assert get_password_hash("1q2w3e", salt)[: settings.SALT_LENGTH] == salt
+
+
+def test_credential_cache():
+    cache = CredentialCache(maxsize=2, ttl=60)
+    hash = get_password_hash("1q2w3e")
+    assert not cache.get("test", "1q2w3e", hash)
+    cache.add("test", "1q2w3e", hash)
+    assert cache.get("test", "1q2w3e", hash)
+    assert not cache.get("test", "wrong", hash)
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+
+def test_credential_cache_password_change():
+    cache = CredentialCache(maxsize=2, ttl=60)
+    cache.add("test", "1q2w3e", get_password_hash("1q2w3e"))
+    assert not cache.get("test", "1q2w3e", get_password_hash("1q2w3e"))
+
+
+def test_credential_cache_eviction():
+    cache = CredentialCache(maxsize=2, ttl=60)
+    for username in ("a", "b", "c"):
+        cache.add(username, "1q2w3e", "hash")
+    assert len(cache) == 2
+    assert not cache.get("a", "1q2w3e", "hash")
+    assert cache.get("c", "1q2w3e", "hash")
+
+
+def test_credential_cache_ttl():
+    cache = CredentialCache(maxsize=2, ttl=0)
+    cache.add("test", "1q2w3e", "hash")
+    assert not cache.get("test", "1q2w3e", "hash")
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_password_hash_async():
+    hash = await get_password_hash_async("1q2w3e")
+    assert await verify_password_hash_async("1q2w3e", hash)
+    assert not await verify_password_hash_async("wrong", hash)
+    assert verify_password_hash("1q2w3e", hash)
+
+
+def test_token():
+    user = User(id=2, username="test")
+    assert verify_token(create_token(user)) == user
+
+
+def test_token_expired():
+    assert (
+        verify_token(create_token(User(id=2, username="test"), ttl=0)) is None
+    )
+
+
+def test_token_forged():
+    token = create_token(User(id=2, username="test"))
+    payload, signature = token.split(".")
+    forged = create_token(User(id=3, username="test2")).split(".")[0]
+    assert verify_token(f"{forged}.{signature}") is None
+    assert verify_token(payload) is None
+
+
+def test_token_malformed():
+    assert verify_token("é.x") is None
+    assert verify_token("abc.é") is None
+    assert verify_token("") is None
@@ -1,7 +1,14 @@
+from datetime import datetime
+
 import httpx
 import pytest
-from wallet.db import DB
-from wallet.models import Account, TransactionType
+from wallet.db import DB, balance_snapshot
+from wallet.models import (
+    Account,
+    TransactionBatchItem,
+    TransactionStatus,
+    TransactionType,
+)
 from wallet.settings import settings
 
 from . import asserts, factories
@@ -127,6 +134,7 @@ async def test_create_repeated_transaction(
         },
         auth=account.auth,
     )
+    assert response.status_code == 201, response.json()
 
     asserts.model_has_fields(
         await db_session.get_account("test"), balance=account.balance
@@ -154,7 +162,7 @@ async def test_create_different_transaction_same_id(
         },
         auth=account.auth,
     )
-    assert response.status_code == 400, response.json()
+    assert response.status_code == 409, response.json()
 
     asserts.model_has_fields(
         await db_session.get_account("test"), balance=account.balance
@@ -213,6 +221,7 @@ async def test_cannot_create_transaction_over_balance(
     )
 
     assert response.status_code == 400, response.json()
+    assert response.json() == {"detail": {"msg": "Insufficient funds"}}
     assert await db_session.get_transaction("transid2") is None
     asserts.model_has_fields(
         await db_session.get_account("test"), balance=account.balance
@@ -298,3 +307,314 @@ async def test_cannot_create_transaction_to_unknown_user_by_username(
     asserts.model_has_fields(
         await db_session.get_account("test"), balance=account.balance
     )
+
+
+@pytest.mark.asyncio
+async def test_create_transfer_to_self(
+    account: Account, client: httpx.AsyncClient, db_session: DB
+):
+    response = await client.put(
+        "/transactions/transid",
+        json={
+            "account_to": {"id": account.id},
+            "amount": 100,
+            "type": "transfer",
+        },
+        auth=account.auth,
+    )
+
+    assert response.status_code == 201, response.json()
+    asserts.model_has_fields(
+        await db_session.get_account("test"), balance=account.balance
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_transaction_status(
+    account: Account, second_account: Account, db_session: DB
+):
+    assert (
+        await db_session.create_transaction(
+            "transid",
+            account.id,
+            second_account.username,
+            account.balance + 1,
+            TransactionType.transfer,
+        )
+        is TransactionStatus.insufficient_funds
+    )
+    assert (
+        await db_session.create_transaction(
+            "transid",
+            account.id,
+            "whatever",
+            100,
+            TransactionType.transfer,
+        )
+        is TransactionStatus.unknown_account
+    )
+    assert (
+        await db_session.create_transaction(
+            "transid",
+            account.id,
+            second_account.username,
+            account.balance,
+            TransactionType.transfer,
+        )
+        is TransactionStatus.created
+    )
+    asserts.model_has_fields(await db_session.get_account("test"), balance=0)
+    asserts.model_has_fields(
+        await db_session.get_account("test2"),
+        balance=second_account.balance + account.balance,
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_batch(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    existing = await factories.transaction(
+        db_session, account.id, second_account.id, TransactionType.transfer, 100
+    )
+    response = await client.post(
+        "/transactions",
+        json={
+            "transactions": [
+                {
+                    "id": "transfer1",
+                    "account_to": {"id": second_account.id},
+                    "amount": 600,
+                    "type": "transfer",
+                },
+                {
+                    "id": "transfer2",
+                    "account_to": {"username": second_account.username},
+                    "amount": 600,
+                    "type": "transfer",
+                },
+                {"id": "topup", "amount": 300, "type": "topup"},
+                {
+                    "id": "transfer3",
+                    "account_to": {"username": second_account.username},
+                    "amount": 600,
+                    "type": "transfer",
+                },
+                {
+                    "id": "transfer4",
+                    "account_to": {"username": "whatever"},
+                    "amount": 100,
+                    "type": "transfer",
+                },
+                {
+                    "id": existing.id,
+                    "account_to": {"id": second_account.id},
+                    "amount": 100,
+                    "type": "transfer",
+                },
+                {"id": "topup", "amount": 300, "type": "topup"},
+            ],
+            "atomic": False,
+        },
+        auth=account.auth,
+    )
+
+    assert response.status_code == 200, response.json()
+    assert response.json() == [
+        {"id": "transfer1", "status": "created"},
+        {"id": "transfer2", "status": "insufficient_funds"},
+        {"id": "topup", "status": "created"},
+        {"id": "transfer3", "status": "created"},
+        {"id": "transfer4", "status": "unknown_account"},
+        {"id": existing.id, "status": "replayed"},
+        {"id": "topup", "status": "replayed"},
+    ]
+    asserts.model_has_fields(await db_session.get_account("test"), balance=100)
+    asserts.model_has_fields(
+        await db_session.get_account("test2"), balance=2200
+    )
+    asserts.model_has_fields(
+        await db_session.get_transaction("transfer3"),
+        account_from={"id": account.id, "username": account.username},
+        account_to={
+            "id": second_account.id,
+            "username": second_account.username,
+        },
+        type=TransactionType.transfer,
+        amount=600,
+    )
+    assert await db_session.get_transaction("transfer2") is None
+
+
+@pytest.mark.asyncio
+async def test_create_batch_atomic(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    response = await client.post(
+        "/transactions",
+        json={
+            "transactions": [
+                {
+                    "id": "transfer1",
+                    "account_to": {"id": second_account.id},
+                    "amount": 600,
+                    "type": "transfer",
+                },
+                {
+                    "id": "transfer2",
+                    "account_to": {"id": second_account.id},
+                    "amount": 600,
+                    "type": "transfer",
+                },
+            ],
+        },
+        auth=account.auth,
+    )
+
+    assert response.status_code == 200, response.json()
+    assert response.json() == [
+        {"id": "transfer1", "status": "aborted"},
+        {"id": "transfer2", "status": "insufficient_funds"},
+    ]
+    assert await db_session.get_transaction("transfer1") is None
+    asserts.model_has_fields(
+        await db_session.get_account("test"), balance=account.balance
+    )
+    asserts.model_has_fields(
+        await db_session.get_account("test2"), balance=second_account.balance
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_batch_concurrent_id(
+    account: Account, second_account: Account, db_session: DB, monkeypatch
+):
+    existing = await factories.transaction(
+        db_session, second_account.id, account.id, TransactionType.transfer
+    )
+    find_transactions = db_session._find_transactions
+    calls = []
+
+    async def racing_find_transactions(ids):
+        # The first lookup misses the transaction, as if it was committed right after it
+        calls.append(ids)
+        if len(calls) == 1:
+            return {}
+        return await find_transactions(ids)
+
+    monkeypatch.setattr(
+        db_session, "_find_transactions", racing_find_transactions
+    )
+    statuses = await db_session.create_transactions(
+        account.id,
+        [
+            TransactionBatchItem(
+                id=existing.id,
+                account_to={"id": second_account.id},
+                amount=100,
+                type=TransactionType.transfer,
+            ),
+            TransactionBatchItem(id="topup", amount=100, type="topup"),
+        ],
+        atomic=False,
+    )
+    assert statuses == [TransactionStatus.conflict, TransactionStatus.created]
+    assert len(calls) == 2
+    asserts.model_has_fields(
+        await db_session.get_account("test"), balance=account.balance + 100
+    )
+
+
+@pytest.mark.asyncio
+async def test_retry_transaction(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    body = {
+        "account_to": {"username": second_account.username},
+        "amount": 100,
+        "type": "transfer",
+    }
+    for _ in range(2):
+        response = await client.put(
+            "/transactions/transid", json=body, auth=account.auth
+        )
+        assert response.status_code == 201, response.json()
+
+    asserts.model_has_fields(await db_session.get_account("test"), balance=900)
+    asserts.model_has_fields(
+        await db_session.get_account("test2"), balance=1100
+    )
+
+    response = await client.put(
+        "/transactions/transid",
+        json={**body, "amount": 200},
+        auth=account.auth,
+    )
+    assert response.status_code == 409, response.json()
+    asserts.model_has_fields(await db_session.get_account("test"), balance=900)
+
+
+@pytest.mark.asyncio
+async def test_retry_transaction_status(
+    account: Account, second_account: Account, db_session: DB
+):
+    async def create(account_to, amount=100):
+        return await db_session.create_transaction(
+            "transid", account.id, account_to, amount, TransactionType.transfer
+        )
+
+    assert await create(second_account.id) is TransactionStatus.created
+    assert await create(second_account.id) is TransactionStatus.replayed
+    # The existing transaction is found in the DB, not only in the cache
+    db_session.clear_caches()
+    assert await create(second_account.username) is TransactionStatus.replayed
+    assert await create(second_account.id, 200) is TransactionStatus.conflict
+    assert await create(account.id) is TransactionStatus.conflict
+
+
+@pytest.mark.asyncio
+async def test_create_transaction_balance_snapshot(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    async def snapshots():
+        rows = await db_session._db.fetch_all(balance_snapshot.select())
+        return {(row["account_id"], row["day"]): row["balance"] for row in rows}
+
+    today = datetime.utcnow().date()
+    for transaction_id in ("transfer1", "transfer2"):
+        response = await client.put(
+            f"/transactions/{transaction_id}",
+            json={
+                "account_to": {"id": second_account.id},
+                "amount": 100,
+                "type": "transfer",
+            },
+            auth=account.auth,
+        )
+        assert response.status_code == 201, response.json()
+    assert await snapshots() == {
+        (account.id, today): 800,
+        (second_account.id, today): 1200,
+    }
+
+    response = await client.post(
+        "/transactions",
+        json={
+            "transactions": [{"id": "topup", "amount": 300, "type": "topup"}]
+        },
+        auth=account.auth,
+    )
+    assert response.status_code == 200, response.json()
+    assert (await snapshots())[(account.id, today)] == 1100
@@ -0,0 +1,170 @@
+import asyncio
+
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import sqlite
+from wallet.db import DB, Statement, account, init_db, transaction
+from wallet.deps import _pool_options
+from wallet.models import (
+    Account,
+    TransactionBatchItem,
+    TransactionStatus,
+    TransactionType,
+)
+
+from . import factories
+
+
+def test_read_your_writes():
+    db = DB(
+        "sqlite:///primary.sqlite3", read_db_uri="sqlite:///replica.sqlite3"
+    )
+    assert db._read_database(2) is db._read_db
+    assert db._read_database(None) is db._db
+
+    db._mark_written(2)
+    assert db._read_database(2) is db._db
+    assert db._read_database(3) is db._read_db
+
+
+def test_single_pool():
+    db = DB("sqlite:///primary.sqlite3")
+    db._mark_written(2)
+    assert db._read_database(2) is db._db
+    assert list(db.pool_stats()) == ["primary"]
+
+
+def test_pool_options():
+    assert _pool_options("mysql://wallet@localhost/wallet", 10) == {
+        "max_size": 10
+    }
+    assert _pool_options("mysql://wallet@localhost/wallet", None) == {}
+    assert _pool_options("sqlite:///wallet.sqlite3", 10) == {}
+
+
+@pytest.mark.asyncio
+async def test_pool_stats(account: Account, db_session: DB):
+    acquired = db_session.pool_stats()["primary"]["acquired"]
+    await db_session.get_account(account.id)
+    stats = db_session.pool_stats()["primary"]
+    assert stats["acquired"] == acquired + 1
+    assert stats["wait_seconds_max"] >= 0
+
+
+def test_statement_repeated_param():
+    statement = Statement(
+        DB._transaction_query(for_account=sqlalchemy.bindparam("account_id")),
+        sqlite.dialect(),
+    )
+    compiled = statement(account_id=2).compile(dialect=sqlite.dialect())
+    assert compiled.construct_params() == {
+        "account_id_0": 2,
+        "account_id_1": 2,
+    }
+
+
+def test_statement_cache(db_session: DB):
+    built = []
+
+    def build():
+        built.append(True)
+        return transaction.select()
+
+    first = db_session._statement(db_session._db, "test", build)
+    assert db_session._statement(db_session._db, "test", build) is first
+    assert len(built) == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_transfers(file_db: DB):
+    sender = await asyncio.create_task(
+        factories.account(file_db, "sender", "1q2w3e", 100)
+    )
+    await asyncio.create_task(factories.account(file_db, "recipient", "1q2w3e"))
+
+    statuses = await asyncio.gather(
+        *[
+            file_db.create_transaction(
+                f"transfer{i}",
+                sender.id,
+                "recipient",
+                20,
+                TransactionType.transfer,
+            )
+            for i in range(10)
+        ],
+        return_exceptions=True,
+    )
+    assert not [status for status in statuses if isinstance(status, Exception)]
+    assert statuses.count(TransactionStatus.created) == 5
+    assert statuses.count(TransactionStatus.insufficient_funds) == 5
+    assert (await file_db.get_account(sender.id)).balance == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_batches(file_db: DB):
+    sender = await asyncio.create_task(
+        factories.account(file_db, "sender", "1q2w3e", 100)
+    )
+    await asyncio.create_task(factories.account(file_db, "recipient", "1q2w3e"))
+
+    batches = await asyncio.gather(
+        *[
+            file_db.create_transactions(
+                sender.id,
+                [
+                    TransactionBatchItem(
+                        id=f"transfer{i}-{j}",
+                        account_to={"username": "recipient"},
+                        amount=10,
+                        type=TransactionType.transfer,
+                    )
+                    for j in range(2)
+                ],
+            )
+            for i in range(10)
+        ],
+        return_exceptions=True,
+    )
+    assert not [batch for batch in batches if isinstance(batch, Exception)]
+    statuses = [status for batch in batches for status in batch]
+    assert statuses.count(TransactionStatus.created) == 10
+    assert (await file_db.get_account(sender.id)).balance == 0
+
+
+@pytest.mark.asyncio
+async def test_batch_locks_recipients_first(db_session: DB, monkeypatch):
+    sender = await factories.account(db_session, "sender", "1q2w3e", 100)
+    by_id = await factories.account(db_session, "by_id", "1q2w3e")
+    by_name = await factories.account(db_session, "by_name", "1q2w3e")
+    await factories.account(db_session, "other", "1q2w3e")
+    locked = []
+    lock_accounts = db_session._lock_accounts
+
+    async def spy(where):
+        if not locked:
+            rows = await db_session._db.fetch_all(
+                sqlalchemy.select([account.c.id]).where(where)
+            )
+            locked.append({row["id"] for row in rows})
+        await lock_accounts(where)
+
+    monkeypatch.setattr(db_session, "_lock_accounts", spy)
+    await db_session.create_transactions(
+        sender.id,
+        [
+            TransactionBatchItem(
+                id="transfer1",
+                account_to={"id": by_id.id},
+                amount=10,
+                type=TransactionType.transfer,
+            ),
+            TransactionBatchItem(
+                id="transfer2",
+                account_to={"username": "by_name"},
+                amount=10,
+                type=TransactionType.transfer,
+            ),
+        ],
+    )
+    assert locked == [{sender.id, by_id.id, by_name.id}]
@@ -1,3 +1,5 @@
+import csv
+import json
 from datetime import datetime
 
 import httpx
@@ -6,7 +8,7 @@ from wallet.db import DB
 from wallet.models import Account, TransactionType
 from wallet.settings import settings
 
-from . import factories
+from . import asserts, factories
 
 
 @pytest.mark.asyncio
@@ -290,3 +292,166 @@ async def test_cannot_get_unknown_transaction(
         auth=account.auth,
     )
     assert response.status_code == 404, response.json()
+
+
+@pytest.mark.asyncio
+async def test_get_transaction_history_cursor(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    created = datetime.utcnow().replace(hour=0, minute=0, microsecond=0)
+    # Transactions with the same timestamp must not be lost at page boundaries
+    transactions = [
+        await factories.transaction(
+            db_session,
+            account.id,
+            second_account.id,
+            TransactionType.transfer,
+            100,
+            id_=f"trans{i}",
+            created=created,
+        )
+        for i in range(5)
+    ]
+
+    params = {"dt_from": created, "order": "asc", "limit": 2}
+    response = await client.get(
+        "/transactions", params=params, auth=account.auth
+    )
+    assert response.status_code == 200, response.json()
+    assert [t["id"] for t in response.json()] == ["trans0", "trans1"]
+    assert "X-Prev-Cursor" not in response.headers
+
+    response = await client.get(
+        "/transactions",
+        params={**params, "cursor": response.headers["X-Next-Cursor"]},
+        auth=account.auth,
+    )
+    assert [t["id"] for t in response.json()] == ["trans2", "trans3"]
+
+    response = await client.get(
+        "/transactions",
+        params={**params, "cursor": response.headers["X-Next-Cursor"]},
+        auth=account.auth,
+    )
+    assert [t["id"] for t in response.json()] == ["trans4"]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = await client.get(
+        "/transactions",
+        params={**params, "cursor": response.headers["X-Prev-Cursor"]},
+        auth=account.auth,
+    )
+    assert [t["id"] for t in response.json()] == ["trans2", "trans3"]
+    assert "X-Next-Cursor" in response.headers
+    assert "X-Prev-Cursor" in response.headers
+
+
+@pytest.mark.asyncio
+async def test_get_transaction_history_invalid_cursor(
+    account: Account, client: httpx.AsyncClient
+):
+    response = await client.get(
+        "/transactions", params={"cursor": "invalid"}, auth=account.auth
+    )
+    assert response.status_code == 400, response.json()
+
+
+@pytest.mark.asyncio
+async def test_get_transaction_usernames_cached(
+    account: Account, second_account: Account, db_session: DB
+):
+    transaction = await factories.transaction(
+        db_session, account.id, second_account.id, TransactionType.transfer, 100
+    )
+    assert await db_session._get_usernames({account.id}) == {
+        account.id: account.username
+    }
+
+    # Cached usernames are used instead of reading the account table
+    await db_session._db.execute(
+        "UPDATE account SET username = 'renamed' WHERE id = :id",
+        values={"id": account.id},
+    )
+    asserts.model_has_fields(
+        await db_session.get_transaction(transaction.id),
+        account_from={"id": account.id, "username": account.username},
+    )
+
+
+@pytest.mark.asyncio
+async def test_export_transactions(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+    monkeypatch,
+):
+    monkeypatch.setattr(settings, "EXPORT_CHUNK_SIZE", 2)
+    created = datetime(2021, 6, 1)
+    for i in range(5):
+        await factories.transaction(
+            db_session,
+            account.id if i % 2 else second_account.id,
+            second_account.id if i % 2 else account.id,
+            TransactionType.transfer,
+            100 + i,
+            id_=f"trans{i}",
+            created=created,
+        )
+
+    response = await client.get("/transactions/export", auth=account.auth)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["id"] for row in rows] == [f"trans{i}" for i in range(5)]
+    assert rows[1] == {
+        "id": "trans1",
+        "amount": 101,
+        "type": "transfer",
+        "created": created.isoformat(),
+        "account_from": {"id": account.id, "username": account.username},
+        "account_to": {
+            "id": second_account.id,
+            "username": second_account.username,
+        },
+    }
+
+    response = await client.get(
+        "/transactions/export",
+        params={"format": "csv", "dt_to": created},
+        auth=account.auth,
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(response.text.splitlines()))
+    assert rows[0][:4] == ["id", "created", "type", "amount"]
+    assert rows[2] == [
+        "trans1",
+        created.isoformat(),
+        "transfer",
+        "101",
+        str(account.id),
+        account.username,
+        str(second_account.id),
+        second_account.username,
+    ]
+    assert len(rows) == 6
+
+
+@pytest.mark.asyncio
+async def test_export_transactions_empty(
+    account: Account, client: httpx.AsyncClient
+):
+    response = await client.get(
+        "/transactions/export",
+        params={"dt_from": "2021-06-02", "dt_to": "2021-06-01"},
+        auth=account.auth,
+    )
+    assert response.status_code == 400
+
+    response = await client.get("/transactions/export", auth=account.auth)
+    assert response.status_code == 200
+    assert response.text == ""
@@ -0,0 +1,80 @@
+import httpx
+import pytest
+from wallet import metrics
+from wallet.models import Account
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram(
+        "test_seconds", "Test latency", ("op",), buckets=(0.1, 1.0)
+    )
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    histogram.observe(5, "a")
+    assert histogram.render() == [
+        "# HELP test_seconds Test latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{op="a",le="0.1"} 1',
+        'test_seconds_bucket{op="a",le="1"} 2',
+        'test_seconds_bucket{op="a",le="+Inf"} 3',
+        'test_seconds_count{op="a"} 3',
+        'test_seconds_sum{op="a"} 5.55',
+    ]
+
+
+def test_stats_render():
+    stats = metrics.Stats(
+        "test_pool",
+        "Pool usage",
+        lambda: {"primary": {"size": None, "acquired": 3}},
+        label="pool",
+    )
+    assert stats.render() == [
+        "# HELP test_pool_acquired Pool usage",
+        "# TYPE test_pool_acquired untyped",
+        'test_pool_acquired{pool="primary"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_instrument_errors():
+    @metrics.instrument("test")
+    async def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await fail()
+    assert metrics.operation_errors.series("test", "fail", "ValueError") == [1]
+    assert metrics.operations_in_flight.series("test", "fail") == [0]
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(account: Account, client: httpx.AsyncClient):
+    response = await client.get("/account", auth=account.auth)
+    assert response.status_code == 200, response.json()
+    response = await client.get("/transactions/unknown", auth=account.auth)
+    assert response.status_code == 404
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    # Requests are labeled by route templates
+    assert (
+        'wallet_http_requests_total{method="GET",route="/account",status="200"}'
+        in {line.rsplit(" ", 1)[0] for line in lines}
+    )
+    assert any(
+        line.startswith(
+            'wallet_http_request_seconds_count{method="GET",'
+            'route="/transactions/{transaction_id}"}'
+        )
+        for line in lines
+    )
+    assert any(
+        line.startswith(
+            'wallet_operation_seconds_count{component="db",operation="get_account"}'
+        )
+        for line in lines
+    )
+    assert 'wallet_db_pool_acquired{pool="primary"}' in response.text
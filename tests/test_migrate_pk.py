@@ -0,0 +1,63 @@
+import os
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from wallet.db import transaction
+from wallet.migrate_pk import migrate
+
+
+def test_migrate(tmpdir):
+    engine = sqlalchemy.create_engine(
+        f"sqlite:///{os.path.join(tmpdir, 'legacy.sqlite3')}"
+    )
+    legacy = sqlalchemy.MetaData()
+    sqlalchemy.Table(
+        "account",
+        legacy,
+        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    )
+    legacy_transaction = sqlalchemy.Table(
+        "transaction",
+        legacy,
+        sqlalchemy.Column("id", sqlalchemy.String(255), primary_key=True),
+        sqlalchemy.Column(
+            "account_from",
+            sqlalchemy.Integer,
+            sqlalchemy.ForeignKey("account.id"),
+        ),
+        sqlalchemy.Column(
+            "account_to",
+            sqlalchemy.Integer,
+            sqlalchemy.ForeignKey("account.id"),
+        ),
+        sqlalchemy.Column("type", sqlalchemy.String(8)),
+        sqlalchemy.Column("amount", sqlalchemy.Integer),
+        sqlalchemy.Column("created", sqlalchemy.DateTime),
+        sqlalchemy.Index("ix_transaction_created_id", "created", "id"),
+    )
+    legacy.create_all(engine)
+    engine.execute(legacy.tables["account"].insert(), [{"id": 1}])
+    engine.execute(
+        legacy_transaction.insert(),
+        [
+            {
+                "id": f"tx{i}",
+                "account_from": 1,
+                "account_to": 1,
+                "type": "topup",
+                "amount": 100,
+                "created": datetime(2021, 6, 1) - timedelta(minutes=i),
+            }
+            for i in range(3)
+        ],
+    )
+
+    assert migrate(engine, chunk_size=2) == ["transaction"]
+    rows = engine.execute(
+        sqlalchemy.select([transaction.c.pk, transaction.c.id]).order_by(
+            transaction.c.pk
+        )
+    ).fetchall()
+    # Internal keys follow creation time
+    assert [tuple(row) for row in rows] == [(1, "tx2"), (2, "tx1"), (3, "tx0")]
+    assert migrate(engine) == []
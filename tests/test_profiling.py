@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from wallet.profiling import ProfilingMiddleware
+
+
+def busy_loop(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+async def endpoint(scope, receive, send):
+    # Long enough to be sampled even when the sampler thread waits for the GIL on slow machines
+    await asyncio.sleep(0.2)
+    busy_loop(0.2)
+    payload = [bytearray(1000) for _ in range(100)]
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/plain")],
+        }
+    )
+    await send({"type": "http.response.body", "body": b"%d" % len(payload)})
+
+
+@pytest.mark.asyncio
+async def test_profile_request(tmp_path):
+    app = ProfilingMiddleware(
+        endpoint, directory=str(tmp_path), token="secret", memory=True
+    )
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/", headers={"X-Profile": "secret"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+
+    wall = (tmp_path / f"{profile_id}.wall.folded").read_text().splitlines()
+    cpu = (tmp_path / f"{profile_id}.cpu.folded").read_text().splitlines()
+    # Stacks start at the middleware and include both awaiting and running
+    assert all(line.startswith("__call__ (profiling.py") for line in wall)
+    assert any("endpoint (test_profiling.py" in line for line in wall)
+    assert any(";sleep (tasks.py" in line for line in wall)
+    assert any("busy_loop (test_profiling.py" in line for line in cpu)
+    assert not any(";sleep (tasks.py:" in line for line in cpu)
+    memory = (tmp_path / f"{profile_id}.memory.txt").read_text()
+    assert memory.startswith("GET / in ")
+    assert "test_profiling.py" in memory
+
+
+@pytest.mark.asyncio
+async def test_profile_not_requested(tmp_path):
+    app = ProfilingMiddleware(endpoint, directory=str(tmp_path), token="secret")
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/")
+        assert "X-Profile-Id" not in response.headers
+        response = await client.get("/", headers={"X-Profile": "wrong"})
+        assert "X-Profile-Id" not in response.headers
+    assert not list(tmp_path.iterdir())
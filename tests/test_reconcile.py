@@ -0,0 +1,62 @@
+import pytest
+from wallet.db import DB, account
+from wallet.models import BalanceMismatch, TransactionType
+from wallet.reconcile import Reconciler
+from wallet.settings import settings
+
+from . import factories
+
+
+@pytest.mark.asyncio
+async def test_reconcile(db_session: DB):
+    first = await factories.account(db_session, "first", "1q2w3e")
+    second = await factories.account(db_session, "second", "1q2w3e")
+    for id_, account_from, account_to, type_, amount in (
+        ("topup", settings.TOPUP_ACCOUNT_ID, first.id, "topup", 500),
+        ("transfer1", first.id, second.id, "transfer", 200),
+        ("transfer2", second.id, first.id, "transfer", 50),
+    ):
+        await db_session.create_transaction(
+            id_, account_from, account_to, amount, TransactionType(type_)
+        )
+
+    reconciler = Reconciler(db_session._db, chunk_size=2, lag=0)
+    assert await reconciler.run() == []
+    assert reconciler.processed == 3
+
+    await db_session._db.execute(
+        account.update().where(account.c.id == first.id).values(balance=999)
+    )
+    # Accounts without new transactions are only checked on request
+    assert await reconciler.run() == []
+    assert reconciler.processed == 0
+    assert await reconciler.run(all_accounts=True) == [
+        BalanceMismatch(account_id=first.id, balance=999, expected=350)
+    ]
+
+    # A new run continues from the checkpoint
+    await db_session.create_transaction(
+        "transfer3", second.id, first.id, 50, TransactionType.transfer
+    )
+    reconciler = Reconciler(db_session._db, chunk_size=2, lag=0)
+    assert await reconciler.run() == [
+        BalanceMismatch(account_id=first.id, balance=1049, expected=400)
+    ]
+    assert reconciler.processed == 1
+    assert (await reconciler.checkpoint())[1] == "transfer3"
+
+
+@pytest.mark.asyncio
+async def test_reconcile_pending(db_session: DB):
+    first = await factories.account(db_session, "first", "1q2w3e")
+    await db_session.create_transaction(
+        "topup",
+        settings.TOPUP_ACCOUNT_ID,
+        first.id,
+        100,
+        TransactionType.topup,
+    )
+    # Recent transactions are left for the next run, but counted as applied to balances
+    reconciler = Reconciler(db_session._db, lag=3600)
+    assert await reconciler.run(all_accounts=True) == []
+    assert reconciler.processed == 0
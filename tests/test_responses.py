@@ -0,0 +1,58 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from wallet import responses
+from wallet.models import Transaction, TransactionType
+
+TRANSACTION = {
+    "account_to": {"id": 3, "username": "test2"},
+    "amount": 100,
+    "type": TransactionType.transfer,
+    "id": "test",
+    "created": datetime(2021, 6, 1, 12, 30, 5, 123),
+    "account_from": {"id": 2, "username": "test"},
+}
+
+
+def test_dumps():
+    assert json.loads(responses.dumps([TRANSACTION])) == jsonable_encoder(
+        [Transaction(**TRANSACTION)]
+    )
+
+
+def test_dumps_stdlib(monkeypatch):
+    expected = responses.dumps([TRANSACTION])
+    monkeypatch.setattr(responses, "orjson", None)
+    assert responses.dumps([TRANSACTION]) == expected
+
+
+@pytest.mark.asyncio
+async def test_streaming_response_disconnect():
+    sent = []
+    disconnected = asyncio.Event()
+
+    async def content():
+        while True:
+            yield b"chunk"
+            await asyncio.sleep(0.01)
+
+    async def receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if len(sent) == 3:
+            disconnected.set()
+
+    response = responses.TaskStreamingResponse(content())
+    await asyncio.wait_for(response({"type": "http"}, receive, send), 10)
+    assert sent[0]["type"] == "http.response.start"
+    assert sent[1] == {
+        "type": "http.response.body",
+        "body": b"chunk",
+        "more_body": True,
+    }
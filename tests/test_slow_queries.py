@@ -0,0 +1,130 @@
+import asyncio
+
+import httpx
+import pytest
+from wallet import slow_queries
+from wallet.db import DB, account, transaction
+from wallet.models import Account
+from wallet.settings import settings
+
+
+@pytest.fixture
+def slow_query_log(db_session: DB, monkeypatch):
+    # Every statement is slow
+    monkeypatch.setattr(db_session.slow_query_log, "threshold", 0)
+    yield db_session.slow_query_log
+    db_session.slow_query_log.clear()
+
+
+@pytest.mark.asyncio
+async def test_slow_query_logged(
+    account: Account, db_session: DB, slow_query_log
+):
+    await db_session.get_account("test")
+    await slow_query_log.join()
+
+    entry = slow_query_log.entries()[0]
+    assert entry.method == "fetch_one"
+    assert "FROM account" in entry.sql
+    assert entry.duration >= 0
+    # Values are redacted
+    assert entry.params == ["value_0"]
+    assert "test" not in entry.json()
+    assert entry.explain_error is None
+    assert any("account" in str(row) for row in entry.plan)
+
+
+@pytest.mark.asyncio
+async def test_slow_query_explain_limit(
+    db_session: DB, slow_query_log, monkeypatch
+):
+    monkeypatch.setattr(slow_queries, "MAX_EXPLAINS", 2)
+    queries = [
+        account.select(),
+        account.select(),
+        transaction.select(),
+        account.select().where(account.c.id == 1),
+    ]
+    for query in queries:
+        slow_query_log.record(db_session._db, "fetch_all", query, None, 1.0)
+    await slow_query_log.join()
+
+    entries = list(reversed(slow_query_log.entries()))
+    assert [entry.explain_error is None for entry in entries] == [
+        True,
+        False,
+        True,
+        False,
+    ]
+    assert "same statement" in entries[1].explain_error
+    assert "too many" in entries[3].explain_error
+    # Statements are explained again once the previous EXPLAINs are done
+    slow_query_log.record(db_session._db, "fetch_all", queries[0], None, 1.0)
+    await slow_query_log.join()
+    assert slow_query_log.entries()[0].plan
+
+
+@pytest.mark.asyncio
+async def test_slow_query_explained_on_own_connection(file_db: DB, monkeypatch):
+    monkeypatch.setattr(file_db.slow_query_log, "threshold", 0)
+    connections = []
+    connection = file_db._db.connection
+
+    def spy():
+        connections.append(connection())
+        return connections[-1]
+
+    async def request():
+        caller = file_db._db.connection()
+        monkeypatch.setattr(file_db._db, "connection", spy)
+        async with caller:
+            await file_db._db.fetch_all(account.select())
+        return caller
+
+    caller = await asyncio.create_task(request())
+    await file_db.slow_query_log.join()
+
+    assert caller in connections
+    assert [other for other in connections if other is not caller]
+    assert file_db.slow_query_log.entries()[0].plan
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log_disabled(db_session: DB, monkeypatch):
+    monkeypatch.setattr(db_session.slow_query_log, "threshold", None)
+    await db_session.get_account("test")
+    assert db_session.slow_query_log.entries() == []
+
+
+@pytest.mark.asyncio
+async def test_slow_queries_endpoint(
+    account: Account, client: httpx.AsyncClient, slow_query_log, monkeypatch
+):
+    response = await client.get("/admin/slow-queries")
+    assert response.status_code == 404
+
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    response = await client.get(
+        "/admin/slow-queries", headers={"X-Admin-Token": "wrong"}
+    )
+    assert response.status_code == 403
+
+    response = await client.get("/account", auth=account.auth)
+    assert response.status_code == 200
+    await slow_query_log.join()
+    response = await client.get(
+        "/admin/slow-queries", headers={"X-Admin-Token": "secret"}
+    )
+    assert response.status_code == 200
+    entries = response.json()
+    assert entries
+    assert entries[0]["plan"]
+    assert set(entries[0]) == {
+        "started",
+        "duration",
+        "method",
+        "sql",
+        "params",
+        "plan",
+        "explain_error",
+    }
@@ -0,0 +1,197 @@
+import httpx
+import pytest
+from wallet.db import DB
+from wallet.models import Account, TransactionStatus
+from wallet.settings import settings
+from wallet.worker import Worker
+
+from . import asserts
+
+ASYNC = {"Prefer": "respond-async"}
+
+
+async def get_status(client: httpx.AsyncClient, account: Account, id_: str):
+    return await client.get(f"/transactions/{id_}/status", auth=account.auth)
+
+
+@pytest.mark.asyncio
+async def test_create_transaction_async(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+    db_session: DB,
+):
+    body = {
+        "account_to": {"username": second_account.username},
+        "amount": 100,
+        "type": "transfer",
+    }
+    response = await client.put(
+        "/transactions/transid", json=body, auth=account.auth, headers=ASYNC
+    )
+    assert response.status_code == 202, response.json()
+    assert response.json() == {"id": "transid", "status": "queued"}
+    assert response.headers["Location"] == "/transactions/transid/status"
+    assert response.headers["Preference-Applied"] == "respond-async"
+    # Nothing is applied until the worker runs
+    asserts.model_has_fields(await db_session.get_account("test"), balance=1000)
+    response = await get_status(client, account, "transid")
+    assert response.json() == {"id": "transid", "status": "queued"}
+
+    # Submitting again is accepted, reusing the ID for another transaction isn't
+    response = await client.put(
+        "/transactions/transid", json=body, auth=account.auth, headers=ASYNC
+    )
+    assert response.status_code == 202, response.json()
+    response = await client.put(
+        "/transactions/transid",
+        json={**body, "amount": 200},
+        auth=account.auth,
+        headers=ASYNC,
+    )
+    assert response.status_code == 409, response.json()
+
+    response = await client.put(
+        "/transactions/too_much",
+        json={**body, "amount": 1000},
+        auth=account.auth,
+        headers=ASYNC,
+    )
+    assert response.status_code == 202, response.json()
+
+    assert await Worker(db_session, batch_size=1).drain() == 2
+    asserts.model_has_fields(await db_session.get_account("test"), balance=900)
+    asserts.model_has_fields(
+        await db_session.get_account("test2"), balance=1100
+    )
+    response = await get_status(client, account, "transid")
+    assert response.json() == {"id": "transid", "status": "created"}
+    response = await get_status(client, account, "too_much")
+    assert response.json() == {
+        "id": "too_much",
+        "status": "insufficient_funds",
+    }
+
+
+@pytest.mark.asyncio
+async def test_process_queue_replays(
+    account: Account,
+    second_account: Account,
+    db_session: DB,
+    client: httpx.AsyncClient,
+):
+    response = await client.put(
+        "/transactions/topup",
+        json={"amount": 100, "type": "topup"},
+        auth=account.auth,
+        headers=ASYNC,
+    )
+    assert response.status_code == 202, response.json()
+    # A transaction already created synchronously isn't applied again
+    response = await client.put(
+        "/transactions/topup",
+        json={"amount": 100, "type": "topup"},
+        auth=account.auth,
+    )
+    assert response.status_code == 201, response.json()
+
+    assert await db_session.process_queue(10) == 1
+    asserts.model_has_fields(await db_session.get_account("test"), balance=1100)
+    assert (
+        await db_session.get_transaction_status("topup", account.id)
+        is TransactionStatus.replayed
+    )
+
+
+@pytest.mark.asyncio
+async def test_transaction_status_not_found(
+    account: Account,
+    second_account: Account,
+    client: httpx.AsyncClient,
+):
+    response = await client.put(
+        "/transactions/transid",
+        json={"amount": 100, "type": "topup"},
+        auth=account.auth,
+        headers=ASYNC,
+    )
+    assert response.status_code == 202, response.json()
+    response = await get_status(client, account, "unknown")
+    assert response.status_code == 404
+    # Statuses are only shown to the account that submitted the transaction
+    second_account.__dict__["auth"] = ("test2", "123456")
+    response = await get_status(client, second_account, "transid")
+    assert response.status_code == 404
+
+
+async def enqueue(client: httpx.AsyncClient, account: Account, id_: str):
+    response = await client.put(
+        f"/transactions/{id_}",
+        json={"amount": 100, "type": "topup"},
+        auth=account.auth,
+        headers=ASYNC,
+    )
+    assert response.status_code == 202, response.json()
+
+
+@pytest.mark.asyncio
+async def test_process_queue_claims(
+    account: Account,
+    db_session: DB,
+    client: httpx.AsyncClient,
+    monkeypatch,
+):
+    for id_ in ("topup1", "topup2"):
+        await enqueue(client, account, id_)
+
+    # Claimed by another worker
+    assert len(await db_session._claim_queued(1)) == 1
+    assert await db_session.process_queue(10) == 1
+    asserts.model_has_fields(await db_session.get_account("test"), balance=1100)
+    assert (
+        await db_session.get_transaction_status("topup1", account.id)
+        is TransactionStatus.queued
+    )
+
+    # Claims of workers that stopped expire
+    monkeypatch.setattr(settings, "QUEUE_CLAIM_TIMEOUT", -1)
+    assert await db_session.process_queue(10) == 1
+    asserts.model_has_fields(await db_session.get_account("test"), balance=1200)
+
+
+@pytest.mark.asyncio
+async def test_process_queue_failed(
+    account: Account,
+    db_session: DB,
+    client: httpx.AsyncClient,
+    monkeypatch,
+):
+    for id_ in ("topup1", "broken", "topup2"):
+        await enqueue(client, account, id_)
+    create_transactions = db_session.create_transactions
+
+    async def failing_create_transactions(account_id, items, atomic):
+        if any(item.id == "broken" for item in items):
+            raise ValueError("Broken transaction")
+        return await create_transactions(account_id, items, atomic)
+
+    monkeypatch.setattr(
+        db_session, "create_transactions", failing_create_transactions
+    )
+    monkeypatch.setattr(settings, "QUEUE_CLAIM_TIMEOUT", -1)
+    monkeypatch.setattr(settings, "QUEUE_MAX_ATTEMPTS", 2)
+
+    # The other transactions of the batch are applied
+    assert await db_session.process_queue(10) == 3
+    asserts.model_has_fields(await db_session.get_account("test"), balance=1200)
+    assert (
+        await db_session.get_transaction_status("broken", account.id)
+        is TransactionStatus.queued
+    )
+    # Retried until it runs out of attempts, then the queue is empty
+    assert await db_session.process_queue(10) == 1
+    assert (
+        await db_session.get_transaction_status("broken", account.id)
+        is TransactionStatus.failed
+    )
+    assert await db_session.process_queue(10) == 0
@@ -0,0 +1,183 @@
+"""
+Admission control for write requests.
+
+Requests of one account serialize on its row lock anyway, so letting a flood of them through only
+ties up DB connections that other accounts need. Each account and the whole process get a number
+of concurrent slots and a bounded queue of requests waiting for one. Requests that don't fit into
+the queue are rejected right away, and the API answers them with 429.
+"""
+from typing import AsyncIterator, Hashable, Optional
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+from .settings import settings
+
+
+class Overloaded(Exception):
+    """
+    The request was rejected because too many requests are already running or waiting.
+    """
+
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"Too many concurrent requests ({scope})")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """
+    Semaphore with a bounded number of waiters, which are admitted in arrival order.
+    """
+
+    def __init__(self, limit: int, queue_size: int):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.rejected = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def idle(self) -> bool:
+        return not self.active and not self._waiters
+
+    async def acquire(self) -> bool:
+        """
+        Take a slot, waiting for one if the queue isn't full. Returns False if the request is rejected.
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over right before the cancellation
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+        return True
+
+    def release(self):
+        """
+        Free a slot, handing it over to the first waiter if there is one.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionController:
+    """
+    Per-account and global concurrency limits. A limit of `None` disables it.
+    """
+
+    def __init__(
+        self,
+        account_limit: Optional[int],
+        account_queue_size: int,
+        global_limit: Optional[int],
+        global_queue_size: int,
+        retry_after: int,
+    ):
+        self.account_limit = account_limit
+        self.account_queue_size = account_queue_size
+        self.retry_after = retry_after
+        self._global = (
+            Limiter(global_limit, global_queue_size)
+            if global_limit is not None
+            else None
+        )
+        # Limiters of accounts with running or waiting requests, dropped once idle
+        self._accounts: dict[Hashable, Limiter] = {}
+        self.account_rejected = 0
+
+    @asynccontextmanager
+    async def admit(self, account_id: Hashable) -> AsyncIterator[None]:
+        """
+        Hold a slot of the account and a global one while the block runs.
+
+        The account slot is taken first, so a single account flooding the API only fills its own queue.
+        Raises `Overloaded` if either queue is full.
+        """
+        account_limiter = None
+        if self.account_limit is not None:
+            account_limiter = self._accounts.get(account_id)
+            if account_limiter is None:
+                account_limiter = self._accounts[account_id] = Limiter(
+                    self.account_limit, self.account_queue_size
+                )
+            admitted = await self._acquire(account_id, account_limiter)
+            if not admitted:
+                self.account_rejected += 1
+                raise Overloaded("account", self.retry_after)
+        try:
+            if self._global is not None and not await self._global.acquire():
+                raise Overloaded("global", self.retry_after)
+            try:
+                yield
+            finally:
+                if self._global is not None:
+                    self._global.release()
+        finally:
+            if account_limiter is not None:
+                self._release(account_id, account_limiter)
+
+    async def _acquire(self, account_id: Hashable, limiter: Limiter) -> bool:
+        try:
+            admitted = await limiter.acquire()
+        except asyncio.CancelledError:
+            self._forget_idle(account_id, limiter)
+            raise
+        if not admitted:
+            self._forget_idle(account_id, limiter)
+        return admitted
+
+    def _release(self, account_id: Hashable, limiter: Limiter):
+        limiter.release()
+        self._forget_idle(account_id, limiter)
+
+    def _forget_idle(self, account_id: Hashable, limiter: Limiter):
+        if limiter.idle and self._accounts.get(account_id) is limiter:
+            del self._accounts[account_id]
+
+    def stats(self) -> dict[str, int]:
+        """
+        Current load and the number of rejected requests since start.
+        """
+        return {
+            "accounts": len(self._accounts),
+            "account_active": sum(
+                limiter.active for limiter in self._accounts.values()
+            ),
+            "account_waiting": sum(
+                limiter.waiting for limiter in self._accounts.values()
+            ),
+            "account_rejected": self.account_rejected,
+            "global_active": self._global.active if self._global else 0,
+            "global_waiting": self._global.waiting if self._global else 0,
+            "global_rejected": self._global.rejected if self._global else 0,
+        }
+
+
+admission = AdmissionController(
+    settings.ADMISSION_ACCOUNT_LIMIT,
+    settings.ADMISSION_ACCOUNT_QUEUE_SIZE,
+    settings.ADMISSION_GLOBAL_LIMIT,
+    settings.ADMISSION_GLOBAL_QUEUE_SIZE,
+    settings.ADMISSION_RETRY_AFTER,
+)
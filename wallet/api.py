@@ -3,36 +3,126 @@ API definitions
 """
 from typing import List, Optional
 
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
 from pydantic import conint
 
-from .auth import get_password_hash
+from .admission import admission
+from .auth import create_token, get_password_hash_async
 from .db import DB
-from .deps import db, get_current_user
+from .deps import (
+    db,
+    get_basic_user,
+    get_current_account,
+    get_current_user,
+    require_admin,
+    worker,
+)
 from .models import (
     Account,
     AccountCreate,
     AccountResponse,
+    Balance,
+    Cursor,
+    ExportFormat,
     Ordering,
+    SlowQuery,
+    SummaryPeriod,
+    Token,
     Transaction,
+    TransactionBatch,
+    TransactionBatchItem,
     TransactionCreate,
+    TransactionResult,
+    TransactionStatus,
+    TransactionSummary,
     TransactionType,
+    User,
+)
+from .responses import (
+    FastJSONResponse,
+    TaskStreamingResponse,
+    dumps_csv,
+    dumps_ndjson,
 )
 from .settings import settings
 
 router = APIRouter()
 
+TRANSACTION_ERRORS = {
+    TransactionStatus.unknown_account: "Unknown account",
+    TransactionStatus.system_account: "Cannot transfer to system account",
+    TransactionStatus.insufficient_funds: "Insufficient funds",
+}
+
+CONFLICT_ERROR = (
+    "Transaction with this ID already exists with different parameters"
+)
+
+
+def _prefers_async(prefer: Optional[str]) -> bool:
+    """
+    Whether the `Prefer` header asks to process the request asynchronously, see RFC 7240.
+    """
+    if not prefer:
+        return False
+    return any(
+        preference.split(";")[0].strip().lower() == "respond-async"
+        for preference in prefer.split(",")
+    )
+
 
 @router.get("/account", response_model=AccountResponse)
-async def get_account(user: Account = Depends(get_current_user)) -> Account:
+async def get_account(user: Account = Depends(get_current_account)) -> Account:
     """
     Get account info for the authenticated account
     """
     return user
 
 
+@router.get("/account/balance", response_model=Balance)
+async def get_balance(
+    db: DB = Depends(db),
+    user: User = Depends(get_current_user),
+    at: Optional[datetime] = None,
+) -> Balance:
+    """
+    Get the balance of the authenticated account at the given time, now by default
+
+    Balances at the start and the end of a period along with its export make up an account statement.
+    """
+    if at is None:
+        at = datetime.utcnow()
+    return Balance(balance=await db.get_balance(user.id, at), at=at)
+
+
+@router.get("/account/summary", response_model=List[TransactionSummary])
+async def get_summary(
+    db: DB = Depends(db),
+    user: User = Depends(get_current_user),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    period: SummaryPeriod = SummaryPeriod.day,
+) -> list[TransactionSummary]:
+    """
+    Get the number and sum of incoming and outgoing transactions of the authenticated account by period and type
+
+    Covers days from `date_from` to `date_to` inclusive, the last 30 days by default.
+    Periods are identified by their first day. Periods without transactions are omitted.
+    """
+    if date_to is None:
+        date_to = datetime.utcnow().date()
+    if date_from is None:
+        date_from = date_to - timedelta(days=29)
+    if date_from > date_to:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"msg": "date_from must be earlier than date_to"},
+        )
+    return await db.get_summary(user.id, date_from, date_to, period)
+
+
 @router.post(
     "/account",
     status_code=status.HTTP_201_CREATED,
@@ -45,7 +135,9 @@ async def create_account(body: AccountCreate, db: DB = Depends(db)) -> Account:
     try:
         await db.create_account(
             username=body.username,
-            password=get_password_hash(body.password.get_secret_value()),
+            password=await get_password_hash_async(
+                body.password.get_secret_value()
+            ),
         )
         return await db.get_account(body.username)
     except db.dbapi.IntegrityError:
@@ -55,27 +147,53 @@ async def create_account(body: AccountCreate, db: DB = Depends(db)) -> Account:
         )
 
 
+@router.post("/token", response_model=Token)
+async def create_session_token(
+    user: Account = Depends(get_basic_user),
+) -> Token:
+    """
+    Exchange Basic credentials for a short-lived session token.
+
+    Pass the token as `Authorization: Bearer <token>` to skip password verification on subsequent requests.
+    """
+    return Token(access_token=create_token(user), expires_in=settings.TOKEN_TTL)
+
+
 @router.get("/transactions", response_model=List[Transaction])
 async def get_transactions(
     db: DB = Depends(db),
-    user: Account = Depends(get_current_user),
+    user: User = Depends(get_current_user),
     dt_from: Optional[datetime] = None,
     dt_to: Optional[datetime] = None,
-    limit: Optional[conint(le=1000)] = 100,
+    limit: Optional[conint(ge=1, le=1000)] = 100,
     order: Optional[Ordering] = Ordering.desc,
-) -> list[Transaction]:
+    cursor: Optional[str] = None,
+) -> FastJSONResponse:
     """
     Get transaction history of the authenticated account
+
+    Pages are ordered by creation time and ID. To get the next or the previous page,
+    pass the `X-Next-Cursor` or `X-Prev-Cursor` response header as `cursor` along with the same time range.
     """
-    if dt_from is None and dt_to is None:
+    page_cursor = None
+    if cursor is not None:
+        try:
+            page_cursor = Cursor.decode(cursor)
+        except (ValueError, TypeError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail={"msg": "Invalid cursor"},
+            )
+        order = page_cursor.order
+    elif dt_from is None and dt_to is None:
         dt_to = datetime.utcnow().replace(microsecond=0)
         dt_from = dt_to.replace(hour=0, minute=0, second=0)
     error = None
     if dt_from is not None and dt_to is not None and dt_from > dt_to:
         error = "dt_from must be earlier than dt_to"
-    elif order is Ordering.desc and dt_to is None:
+    elif page_cursor is None and order is Ordering.desc and dt_to is None:
         error = "Specify dt_to with descending order"
-    elif order is Ordering.asc and dt_from is None:
+    elif page_cursor is None and order is Ordering.asc and dt_from is None:
         error = "Specify dt_from with ascending order"
     if error:
         raise HTTPException(
@@ -83,13 +201,109 @@ async def get_transactions(
             detail={"msg": error},
         )
 
-    return await db.get_transactions(user.id, dt_from, dt_to, limit, order)
+    backwards = page_cursor is not None and page_cursor.backwards
+    query_order = order
+    if backwards:
+        query_order = Ordering.asc if order is Ordering.desc else Ordering.desc
+    # Fetch one extra transaction to know if there are more pages
+    transactions = await db.get_transaction_dicts(
+        user.id,
+        dt_from,
+        dt_to,
+        limit + 1,
+        query_order,
+        after=(page_cursor.created, page_cursor.id) if page_cursor else None,
+    )
+    has_more = len(transactions) > limit
+    transactions = transactions[:limit]
+    if backwards:
+        transactions.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, page_cursor is not None
+
+    headers = {}
+    if transactions:
+        first, last = transactions[0], transactions[-1]
+        if has_next:
+            headers["X-Next-Cursor"] = Cursor(
+                created=last["created"], id=last["id"], order=order
+            ).encode()
+        if has_prev:
+            headers["X-Prev-Cursor"] = Cursor(
+                created=first["created"],
+                id=first["id"],
+                order=order,
+                backwards=True,
+            ).encode()
+    return FastJSONResponse(transactions, headers=headers)
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+
+
+# Declared before `/transactions/{transaction_id}`, which would match it otherwise
+@router.get(
+    "/transactions/export",
+    response_class=TaskStreamingResponse,
+    responses={
+        200: {
+            "content": {
+                media_type: {} for media_type in EXPORT_MEDIA_TYPES.values()
+            }
+        }
+    },
+)
+async def export_transactions(
+    db: DB = Depends(db),
+    user: User = Depends(get_current_user),
+    dt_from: Optional[datetime] = None,
+    dt_to: Optional[datetime] = None,
+    format: ExportFormat = ExportFormat.ndjson,
+) -> TaskStreamingResponse:
+    """
+    Export the whole transaction history of the authenticated account, optionally limited to a time range
+
+    Transactions are streamed in ascending order as newline-delimited JSON objects of the same shape
+    as in `GET /transactions`, or as CSV with a header row.
+    """
+    if dt_from is not None and dt_to is not None and dt_from > dt_to:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"msg": "dt_from must be earlier than dt_to"},
+        )
+
+    async def content():
+        # The next chunk is only read from the DB after the previous one is sent,
+        # so a slow client slows down reading instead of piling rows up in memory
+        if format is ExportFormat.csv:
+            yield dumps_csv([], header=True)
+        async for chunk in db.iter_transaction_dicts(
+            user.id, dt_from, dt_to, settings.EXPORT_CHUNK_SIZE
+        ):
+            if format is ExportFormat.csv:
+                yield dumps_csv(chunk)
+            else:
+                yield dumps_ndjson(chunk)
+
+    return TaskStreamingResponse(
+        content(),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="transactions.{format.value}"'
+            )
+        },
+    )
 
 
 @router.get("/transactions/{transaction_id}", response_model=Transaction)
 async def get_transaction(
     db: DB = Depends(db),
-    user: Account = Depends(get_current_user),
+    user: User = Depends(get_current_user),
     transaction_id: str = Query(..., alias="transactionId"),
 ) -> Transaction:
     """
@@ -101,58 +315,157 @@ async def get_transaction(
     return transaction
 
 
+@router.get(
+    "/transactions/{transaction_id}/status", response_model=TransactionResult
+)
+async def get_transaction_status(
+    db: DB = Depends(db),
+    user: User = Depends(get_current_user),
+    transaction_id: str = Query(..., alias="transactionId"),
+) -> TransactionResult:
+    """
+    Get the status of a transaction of the authenticated account, e.g. one submitted with `Prefer: respond-async`
+
+    `queued` until the transaction is processed, then the same status as in `POST /transactions` results,
+    or `failed` if it couldn't be applied.
+    Outcomes are kept for `QUEUE_RESULT_TTL` hours, after that only created transactions are found.
+    """
+    result = await db.get_transaction_status(transaction_id, user.id)
+    if result is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    return TransactionResult(id=transaction_id, status=result)
+
+
 @router.put(
     "/transactions/{transaction_id}",
     status_code=status.HTTP_201_CREATED,
     response_model=None,
+    responses={
+        status.HTTP_202_ACCEPTED: {
+            "model": TransactionResult,
+            "description": "Queued with `Prefer: respond-async`",
+        }
+    },
 )
 async def create_transaction(
     body: TransactionCreate,
     db: DB = Depends(db),
-    user: Account = Depends(get_current_user),
+    user: User = Depends(get_current_user),
     transaction_id: str = Query(..., alias="transactionId"),
+    prefer: Optional[str] = Header(None),
 ) -> None:
     """
     Create a transaction.
 
     Clients should generate a random `transactionId` and pass it again if they have to retry the transaction.
+    A retry of an already created transaction succeeds without applying it again,
+    while reusing the ID for a transaction with different parameters is rejected with 409.
+
+    With `Prefer: respond-async`, the transaction is queued and 202 is returned right away.
+    Its outcome is reported by the status endpoint in the `Location` header.
+    Synchronous requests over the concurrency limits are rejected with 429, while queued ones aren't limited.
     """
     if body.type is TransactionType.transfer:
+        if body.account_to is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail={"msg": "Unknown account"},
+            )
         account_from_id = user.id
-        account_to = await db.get_account(
+        account_to = (
             body.account_to.id
             if body.account_to.id is not None
             else body.account_to.username
         )
+    else:
+        account_from_id = settings.TOPUP_ACCOUNT_ID
+        account_to = user.id
 
-        if account_to is None:
+    if _prefers_async(prefer):
+        result = await db.enqueue_transaction(
+            user.id,
+            TransactionBatchItem.construct(
+                id=transaction_id,
+                account_to=body.account_to
+                if body.type is TransactionType.transfer
+                else None,
+                amount=body.amount,
+                type=body.type,
+            ),
+        )
+        if result is TransactionStatus.conflict:
             raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail={"msg": "Unknown account"},
+                status_code=status.HTTP_409_CONFLICT,
+                detail={"msg": CONFLICT_ERROR},
             )
+        worker.wake()
+        return FastJSONResponse(
+            {"id": transaction_id, "status": result},
+            status_code=status.HTTP_202_ACCEPTED,
+            headers={
+                "Location": f"/transactions/{transaction_id}/status",
+                "Preference-Applied": "respond-async",
+            },
+        )
 
-        account_to_id = account_to.id
-        if account_to_id == settings.TOPUP_ACCOUNT_ID:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail={"msg": "Cannot transfer to system account"},
+    try:
+        async with admission.admit(user.id):
+            result = await db.create_transaction(
+                transaction_id,
+                account_from=account_from_id,
+                account_to=account_to,
+                amount=body.amount,
+                type_=body.type,
             )
+    except db.dbapi.IntegrityError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail={"error": str(e)}
+        )
 
-    else:
-        account_from_id = settings.TOPUP_ACCOUNT_ID
-        account_to_id = user.id
-
-    try:
-        await db.create_transaction(
-            transaction_id,
-            account_from=account_from_id,
-            account_to=account_to_id,
-            amount=body.amount,
-            type_=body.type,
+    if result is TransactionStatus.conflict:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"msg": CONFLICT_ERROR},
         )
-    except (db.dbapi.IntegrityError, db.dbapi.InternalError) as e:
+    if result not in (TransactionStatus.created, TransactionStatus.replayed):
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail={"error": str(e)}
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"msg": TRANSACTION_ERRORS[result]},
         )
 
     return "OK"
+
+
+@router.post("/transactions", response_model=List[TransactionResult])
+async def create_transactions(
+    body: TransactionBatch,
+    db: DB = Depends(db),
+    user: User = Depends(get_current_user),
+) -> list[TransactionResult]:
+    """
+    Create a batch of transactions of the authenticated account in one go.
+
+    Transactions are applied in order. If `atomic` is set, either all of them or none are applied.
+    Returns the status of each transaction; retry failed ones with the same IDs.
+    """
+    async with admission.admit(user.id):
+        statuses = await db.create_transactions(
+            user.id, body.transactions, atomic=body.atomic
+        )
+    return [
+        TransactionResult(id=item.id, status=status)
+        for item, status in zip(body.transactions, statuses)
+    ]
+
+
+@router.get(
+    "/admin/slow-queries",
+    response_model=List[SlowQuery],
+    dependencies=[Depends(require_admin)],
+    include_in_schema=False,
+)
+async def get_slow_queries(db: DB = Depends(db)) -> list[SlowQuery]:
+    """
+    Latest statements that took longer than `SLOW_QUERY_THRESHOLD`, along with their query plans
+    """
+    return db.slow_query_log.entries()
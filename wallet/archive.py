@@ -0,0 +1,173 @@
+"""
+Archival job. Moves old transactions from `transaction` to `transaction_archive`.
+
+The hot table stays small, so its indexes fit in memory, while history reads that cross
+the archive watermark are split between the tables, see `DB._transaction_tables`.
+Transactions are copied first, then the watermark is moved, and the copies in the hot table
+are deleted once every API process has re-read the watermark.
+
+    python -m wallet.archive [--days 180]
+"""
+from typing import Optional
+
+import argparse
+import asyncio
+import json
+import sys
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from databases import Database
+
+from . import models
+from .db import (
+    DB,
+    INSERT_CHUNK_SIZE,
+    archive_watermark,
+    transaction,
+    transaction_archive,
+)
+from .reconcile import Reconciler
+from .settings import settings
+
+WATERMARK_ID = 1
+
+
+class Archiver:
+    def __init__(
+        self,
+        database: Database,
+        chunk_size: int = settings.ARCHIVE_CHUNK_SIZE,
+        delete_delay: float = 2 * settings.ARCHIVE_WATERMARK_TTL,
+    ):
+        self._db = database
+        self.chunk_size = chunk_size
+        self.delete_delay = delete_delay
+        # Number of transactions copied and deleted by the last run
+        self.copied = 0
+        self.deleted = 0
+
+    async def run(self, before: datetime) -> Optional[datetime]:
+        """
+        Archive transactions created before the given time and return the new watermark.
+
+        Transactions not yet added to ledger sums by the reconciliation job are kept in the hot table,
+        as the job reads only that table. Nothing is archived until it has run.
+        The watermark never moves back, so a later run with an earlier time only finishes deletion.
+        """
+        self.copied = self.deleted = 0
+        watermark = await self.watermark()
+        checkpoint = await Reconciler(self._db).checkpoint()
+        if checkpoint is None:
+            return watermark
+        before = min(before, checkpoint[0])
+        if watermark is not None:
+            before = max(before, watermark)
+
+        # The archive assigns its own internal keys
+        columns = [column for column in transaction.c if column.name != "pk"]
+        after = None
+        while True:
+            chunk = await self._db.fetch_all(
+                DB._paginate(
+                    sqlalchemy.select(columns).where(
+                        transaction.c.created < before
+                    ),
+                    transaction.c,
+                    self.chunk_size,
+                    models.Ordering.asc,
+                    after,
+                )
+            )
+            for i in range(0, len(chunk), INSERT_CHUNK_SIZE):
+                # Rows copied by an interrupted run are skipped
+                await self._db.execute(
+                    transaction_archive.insert()
+                    .values(
+                        [dict(row) for row in chunk[i : i + INSERT_CHUNK_SIZE]]
+                    )
+                    .prefix_with("OR IGNORE", dialect="sqlite")
+                    .prefix_with("IGNORE", dialect="mysql")
+                )
+            self.copied += len(chunk)
+            if len(chunk) < self.chunk_size:
+                break
+            after = (chunk[-1]["created"], chunk[-1]["id"])
+
+        if before != watermark:
+            await self._save_watermark(before, update=watermark is not None)
+        # Readers with the previous watermark still read these transactions from the hot table
+        await asyncio.sleep(self.delete_delay)
+
+        while True:
+            ids = [
+                row["id"]
+                for row in await self._db.fetch_all(
+                    sqlalchemy.select([transaction.c.id])
+                    .where(transaction.c.created < before)
+                    .limit(self.chunk_size)
+                )
+            ]
+            if ids:
+                await self._db.execute(
+                    transaction.delete().where(transaction.c.id.in_(ids))
+                )
+                self.deleted += len(ids)
+            if len(ids) < self.chunk_size:
+                return before
+
+    async def watermark(self) -> Optional[datetime]:
+        """
+        Time before which transactions are in the archive.
+        """
+        return await self._db.fetch_val(
+            sqlalchemy.select([archive_watermark.c.created]).where(
+                archive_watermark.c.id == WATERMARK_ID
+            )
+        )
+
+    async def _save_watermark(self, created: datetime, update: bool):
+        if update:
+            await self._db.execute(
+                archive_watermark.update()
+                .where(archive_watermark.c.id == WATERMARK_ID)
+                .values(created=created)
+            )
+        else:
+            await self._db.execute(
+                archive_watermark.insert().values(
+                    id=WATERMARK_ID, created=created
+                )
+            )
+
+
+async def main(days: int):
+    database = Database(settings.DATABASE_URI)
+    await database.connect()
+    try:
+        archiver = Archiver(database)
+        watermark = await archiver.run(datetime.utcnow() - timedelta(days=days))
+    finally:
+        await database.disconnect()
+    print(
+        json.dumps(
+            {
+                "copied": archiver.copied,
+                "deleted": archiver.deleted,
+                "watermark": watermark.isoformat() if watermark else None,
+            }
+        ),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=settings.ARCHIVE_AFTER_DAYS,
+        help="Archive transactions older than this many days",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.days))
@@ -3,14 +3,23 @@ Helpers for authentication
 """
 from typing import Optional
 
+import asyncio
+import base64
 import hashlib
+import hmac
+import json
 import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
-from fastapi.security.http import HTTPBasic
+from fastapi.security.http import HTTPBasic, HTTPBearer
 
+from . import metrics, models
 from .settings import settings
 
-security = HTTPBasic()
+security = HTTPBasic(auto_error=False)
+bearer = HTTPBearer(auto_error=False)
 
 
 def get_password_hash(password: str, salt: Optional[str] = None) -> str:
@@ -35,3 +44,187 @@ def verify_password_hash(password: str, hash: str) -> bool:
     """
     salt = hash[: settings.SALT_LENGTH]
     return secrets.compare_digest(get_password_hash(password, salt), hash)
+
+
+_executor: Optional[Executor] = None
+
+
+def get_executor() -> Executor:
+    """
+    Return the pool password hashing runs on, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        if settings.PASSWORD_HASH_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(settings.PASSWORD_HASH_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(
+                settings.PASSWORD_HASH_WORKERS,
+                thread_name_prefix="password-hash",
+            )
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+@metrics.instrument("auth", "get_password_hash")
+async def get_password_hash_async(
+    password: str, salt: Optional[str] = None
+) -> str:
+    """
+    `get_password_hash` that runs in the executor pool instead of blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), get_password_hash, password, salt
+    )
+
+
+@metrics.instrument("auth", "verify_password_hash")
+async def verify_password_hash_async(password: str, hash: str) -> bool:
+    """
+    `verify_password_hash` that runs in the executor pool instead of blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), verify_password_hash, password, hash
+    )
+
+
+class CredentialCache:
+    """
+    Bounded LRU cache of recently verified credentials with TTL eviction.
+
+    Entries are keyed by an HMAC of the username, the password and the stored password hash,
+    so no plaintext is kept in memory and an entry stops matching as soon as the stored hash changes.
+    """
+
+    def __init__(
+        self, maxsize: int, ttl: float, key: str = settings.SECRET_KEY
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._key = key.encode("utf-8")
+        self._entries: "OrderedDict[bytes, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _digest(self, username: str, password: str, hash: str) -> bytes:
+        message = "\0".join((username, password, hash)).encode("utf-8")
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def get(self, username: str, password: str, hash: str) -> bool:
+        """
+        Check whether the credentials were verified against `hash` recently.
+        """
+        digest = self._digest(username, password, hash)
+        expires = self._entries.get(digest)
+        if expires is not None and expires > time.monotonic():
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return True
+        if expires is not None:
+            del self._entries[digest]
+        self.misses += 1
+        return False
+
+    def add(self, username: str, password: str, hash: str) -> None:
+        """
+        Remember successfully verified credentials, evicting the least recently used entry if full.
+        """
+        if self.maxsize <= 0:
+            return
+        digest = self._digest(username, password, hash)
+        self._entries[digest] = time.monotonic() + self.ttl
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Drop all entries, e.g. after a password change.
+        """
+        self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+
+credential_cache = CredentialCache(
+    settings.CREDENTIAL_CACHE_SIZE, settings.CREDENTIAL_CACHE_TTL
+)
+
+
+async def verify_credentials(username: str, password: str, hash: str) -> bool:
+    """
+    Same as `verify_password_hash_async`, but skips hashing for recently verified credentials.
+    """
+    if credential_cache.get(username, password, hash):
+        return True
+    if await verify_password_hash_async(password, hash):
+        credential_cache.add(username, password, hash)
+        return True
+    return False
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(
+        hmac.new(
+            settings.SECRET_KEY.encode("utf-8"),
+            payload.encode("ascii"),
+            hashlib.sha256,
+        ).digest()
+    )
+
+
+def create_token(user: models.User, ttl: Optional[int] = None) -> str:
+    """
+    Create a session token for the user that expires in `ttl` seconds.
+
+    The token is a base64-encoded JSON payload and its HMAC-SHA256 signature, separated by a dot.
+    """
+    expires = int(time.time()) + (
+        ttl if ttl is not None else settings.TOKEN_TTL
+    )
+    payload = _b64encode(
+        json.dumps(
+            {"sub": user.id, "name": user.username, "exp": expires},
+            separators=(",", ":"),
+        ).encode("utf-8")
+    )
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: str) -> Optional[models.User]:
+    """
+    Return the user the token was issued for, or None if it's malformed, forged or expired.
+    """
+    if not token.isascii():
+        # Signatures are compared as ASCII strings, and valid tokens are base64 anyway
+        return None
+    payload, _, signature = token.partition(".")
+    if not secrets.compare_digest(_sign(payload), signature):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if claims["exp"] <= time.time():
+        return None
+    return models.User(id=claims["sub"], username=claims["name"])
@@ -1,15 +1,32 @@
 """
 DB schema definitions and operations
 """
-from typing import Optional, Union
+from typing import (
+    AsyncIterator,
+    Callable,
+    Hashable,
+    Iterable,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from datetime import datetime
+import logging
+import secrets
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
 
 import sqlalchemy
 from databases import Database, DatabaseURL
+from databases.core import Connection
 
-from . import models
+from . import metrics, models
 from .settings import settings
+from .slow_queries import LoggedDatabase, SlowQueryLog
+
+logger = logging.getLogger(__name__)
 
 metadata = sqlalchemy.MetaData()
 
@@ -33,34 +50,187 @@ account = sqlalchemy.Table(
     ),
 )
 
-transaction = sqlalchemy.Table(
-    "transaction",
+
+def _transaction_table(name: str, **kwargs) -> sqlalchemy.Table:
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        # Internal key. InnoDB clusters rows by the primary key and appends it to every secondary index,
+        # so a short increasing one keeps indexes compact and inserts at the end of the table.
+        sqlalchemy.Column(
+            "pk",
+            sqlalchemy.BigInteger().with_variant(sqlalchemy.Integer, "sqlite"),
+            primary_key=True,
+        ),
+        # ID given by the client, see `DB.create_transaction`
+        sqlalchemy.Column(
+            "id",
+            sqlalchemy.String(length=255),
+            nullable=False,
+            unique=True,
+        ),
+        sqlalchemy.Column(
+            "account_from",
+            sqlalchemy.Integer,
+            sqlalchemy.ForeignKey("account.id"),
+            nullable=False,
+        ),
+        sqlalchemy.Column(
+            "account_to",
+            sqlalchemy.Integer,
+            sqlalchemy.ForeignKey("account.id"),
+            nullable=False,
+        ),
+        sqlalchemy.Column(
+            "type", sqlalchemy.Enum(models.TransactionType), nullable=False
+        ),
+        sqlalchemy.Column("amount", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("created", sqlalchemy.DateTime, nullable=False),
+        # `id` breaks ties between transactions created in the same second for keyset pagination
+        sqlalchemy.Index(f"ix_{name}_created_id", "created", "id"),
+        # Account history is selected separately for each direction, see `DB._history_query`
+        sqlalchemy.Index(
+            f"ix_{name}_account_from_created", "account_from", "created", "id"
+        ),
+        sqlalchemy.Index(
+            f"ix_{name}_account_to_created", "account_to", "created", "id"
+        ),
+        **kwargs,
+    )
+
+
+transaction = _transaction_table("transaction")
+
+# Transactions created before the archive watermark, moved from `transaction` by `wallet.archive`.
+# The table is compressed on MySQL, as it's much larger and mostly cold.
+transaction_archive = _transaction_table(
+    "transaction_archive", mysql_row_format="COMPRESSED"
+)
+
+# Transactions created before this time are in `transaction_archive`, a single row
+archive_watermark = sqlalchemy.Table(
+    "archive_watermark",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("created", sqlalchemy.DateTime, nullable=False),
+)
+
+# Closing balance of an account at the end of each day its balance changed on, see `DB.get_balance`
+balance_snapshot = sqlalchemy.Table(
+    "balance_snapshot",
     metadata,
     sqlalchemy.Column(
-        "id", sqlalchemy.String(length=255), nullable=False, primary_key=True
+        "account_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("account.id"),
+        primary_key=True,
     ),
+    sqlalchemy.Column("day", sqlalchemy.Date, primary_key=True),
+    sqlalchemy.Column("balance", sqlalchemy.Integer, nullable=False),
+)
+# Number and sum of incoming and outgoing transactions per account, day and type, see `DB.get_summary`.
+# Outgoing topups of the system account aren't counted, like its balance isn't changed by them.
+transaction_rollup = sqlalchemy.Table(
+    "transaction_rollup",
+    metadata,
     sqlalchemy.Column(
-        "account_from",
+        "account_id",
         sqlalchemy.Integer,
         sqlalchemy.ForeignKey("account.id"),
-        nullable=False,
+        primary_key=True,
+    ),
+    sqlalchemy.Column("day", sqlalchemy.Date, primary_key=True),
+    sqlalchemy.Column(
+        "type", sqlalchemy.Enum(models.TransactionType), primary_key=True
+    ),
+    sqlalchemy.Column("count_in", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("amount_in", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("count_out", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("amount_out", sqlalchemy.Integer, nullable=False),
+)
+
+# Sums of transactions per account up to the checkpoint of the reconciliation job, see `wallet.reconcile`
+ledger_sum = sqlalchemy.Table(
+    "ledger_sum",
+    metadata,
+    sqlalchemy.Column(
+        "account_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("account.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("balance", sqlalchemy.Integer, nullable=False),
+)
+
+# The last transaction in `(created, id)` order added to `ledger_sum`, a single row
+reconcile_checkpoint = sqlalchemy.Table(
+    "reconcile_checkpoint",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("created", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column(
+        "transaction_id", sqlalchemy.String(length=255), nullable=False
+    ),
+)
+
+# Transactions submitted with `Prefer: respond-async`, applied in batches by `wallet.worker`.
+# `status` is set once a transaction is processed.
+transaction_queue = sqlalchemy.Table(
+    "transaction_queue",
+    metadata,
+    sqlalchemy.Column(
+        "pk",
+        sqlalchemy.BigInteger().with_variant(sqlalchemy.Integer, "sqlite"),
+        primary_key=True,
     ),
     sqlalchemy.Column(
-        "account_to",
+        "id", sqlalchemy.String(length=255), nullable=False, unique=True
+    ),
+    sqlalchemy.Column(
+        "account_id",
         sqlalchemy.Integer,
         sqlalchemy.ForeignKey("account.id"),
         nullable=False,
     ),
+    # Recipient of a transfer as given by the client, by ID or by username
+    sqlalchemy.Column("account_to_id", sqlalchemy.Integer),
+    sqlalchemy.Column("account_to_username", sqlalchemy.String(length=255)),
     sqlalchemy.Column(
         "type", sqlalchemy.Enum(models.TransactionType), nullable=False
     ),
     sqlalchemy.Column("amount", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("queued", sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column("status", sqlalchemy.Enum(models.TransactionStatus)),
+    sqlalchemy.Column("processed", sqlalchemy.DateTime),
+    # Random token of the `process_queue` call that claimed the transaction, and when, so concurrent
+    # workers don't apply it at the same time. Claims expire after `QUEUE_CLAIM_TIMEOUT`.
+    sqlalchemy.Column("claim", sqlalchemy.String(length=32)),
+    sqlalchemy.Column("claimed", sqlalchemy.DateTime),
     sqlalchemy.Column(
-        "created", sqlalchemy.DateTime, nullable=False, index=True
+        "attempts", sqlalchemy.Integer, nullable=False, server_default="0"
     ),
+    # Pending transactions are picked up in submission order
+    sqlalchemy.Index("ix_transaction_queue_status_pk", "status", "pk"),
+    sqlalchemy.Index("ix_transaction_queue_processed", "processed"),
 )
 
 
+# Key and counters of `transaction_rollup` rows
+RollupKey = Tuple[int, date, models.TransactionType]
+ROLLUP_COUNTERS = ("count_in", "amount_in", "count_out", "amount_out")
+
+# Parameters of a transaction that must match when it's retried with the same ID:
+# account_from, account_to, amount and type
+TransactionKey = Tuple[int, int, int, models.TransactionType]
+
+# Rows per multi-row INSERT, keeps the number of bound parameters within SQLite limits
+INSERT_CHUNK_SIZE = 100
+
+# Timestamps are stored with at most microsecond precision,
+# so subtracting this turns an exclusive upper bound into an inclusive one
+TIMESTAMP_RESOLUTION = timedelta(microseconds=1)
+
+
 def init_db(engine: sqlalchemy.engine.Engine):
     """
     Create all required tables and insert prerequisite data.
@@ -79,18 +249,274 @@ def init_db(engine: sqlalchemy.engine.Engine):
             pass
 
 
+class PoolStats:
+    """
+    How long it takes to acquire connections from a pool.
+    """
+
+    def __init__(self):
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float):
+        self.acquired += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+
+class Statement:
+    """
+    Query compiled once into SQL text, to be executed with different parameter values.
+
+    Building and compiling an SQLAlchemy expression takes longer than running a simple indexed query,
+    so hot queries are compiled once per dialect and only parameter values are bound per call.
+    Every occurrence of a named `bindparam()` gets its own placeholder, as some backends
+    bind parameters by position.
+    """
+
+    def __init__(
+        self,
+        query: sqlalchemy.sql.expression.Select,
+        dialect: sqlalchemy.engine.Dialect,
+    ):
+        self.names: dict[str, list[str]] = defaultdict(list)
+
+        def replace(element):
+            if (
+                isinstance(element, sqlalchemy.sql.expression.BindParameter)
+                and not element.unique
+            ):
+                names = self.names[element.key]
+                names.append(f"{element.key}_{len(names)}")
+                return sqlalchemy.bindparam(names[-1], type_=element.type)
+            return None
+
+        query = sqlalchemy.sql.visitors.replacement_traverse(query, {}, replace)
+        compiled = query.compile(dialect=type(dialect)(paramstyle="named"))
+        self.text = (
+            sqlalchemy.text(compiled.string)
+            .bindparams(
+                *[
+                    sqlalchemy.bindparam(
+                        name, value=bind.value, type_=bind.type
+                    )
+                    for bind, name in compiled.bind_names.items()
+                ]
+            )
+            .columns(*query.c)
+        )
+
+    def __call__(self, **values) -> sqlalchemy.sql.expression.TextAsFrom:
+        return self.text.bindparams(
+            **{
+                name: value
+                for key, value in values.items()
+                for name in self.names[key]
+            }
+        )
+
+
 class DB:
     """
     `databases` wrapper that implements actual DB operations.
+
+    Writes go to the primary pool. History reads go to a separate read pool if `read_db_uri` is given,
+    which may point to the same DB or to a replica.
     """
 
-    def __init__(self, db_uri: DatabaseURL, *args, **kwargs):
-        self._db = Database(db_uri, *args, **kwargs)
+    def __init__(
+        self,
+        db_uri: DatabaseURL,
+        *args,
+        read_db_uri: Optional[DatabaseURL] = None,
+        read_pool_options: Optional[dict] = None,
+        **kwargs,
+    ):
+        # Statements of both pools that took longer than `SLOW_QUERY_THRESHOLD`
+        self.slow_query_log = SlowQueryLog(
+            settings.SLOW_QUERY_THRESHOLD, settings.SLOW_QUERY_LOG_SIZE
+        )
+        self._db = LoggedDatabase(
+            db_uri, *args, slow_query_log=self.slow_query_log, **kwargs
+        )
+        if read_db_uri is not None:
+            self._read_db = LoggedDatabase(
+                read_db_uri,
+                *args,
+                slow_query_log=self.slow_query_log,
+                **{**kwargs, **(read_pool_options or {})},
+            )
+        else:
+            self._read_db = self._db
+        self._pool_stats = {self._db: PoolStats(), self._read_db: PoolStats()}
+        # When accounts were last written to, to read their data from the primary for a while
+        self._last_writes: OrderedDict[int, float] = OrderedDict()
+        # Usernames never change, so transactions are read without joining `account`.
+        # Filled lazily, see `_get_usernames`.
+        self._usernames: OrderedDict[int, str] = OrderedDict()
+        # Recently created transactions, to answer retries without touching `account` rows
+        self._recent_transactions: OrderedDict[
+            str, TransactionKey
+        ] = OrderedDict()
+        # Compiled hot queries by dialect and shape, see `_statement`
+        self._statements: dict[tuple[str, Hashable], Statement] = {}
+        # Archive watermark of each pool and when it was read, see `_archive_watermark`
+        self._archive_watermarks: dict[
+            Database, tuple[Optional[datetime], float]
+        ] = {}
+
+    def clear_caches(self):
+        """
+        Forget all cached data, e.g. after rolling back a transaction that created accounts.
+        """
+        self._usernames.clear()
+        self._recent_transactions.clear()
+        self._archive_watermarks.clear()
 
     def __call__(self) -> "DB":
         # Hook for FastAPI dependency injection
         return self
 
+    async def connect(self):
+        await self._db.connect()
+        if self._read_db is not self._db:
+            await self._read_db.connect()
+
+    async def disconnect(self):
+        if self._read_db is not self._db:
+            await self._read_db.disconnect()
+        await self._db.disconnect()
+
+    def pool_stats(self) -> dict[str, dict[str, Optional[float]]]:
+        """
+        Size and connection wait times of the primary and the read pool.
+
+        Sizes are only known for backends with a real pool (MySQL), SQLite opens a connection per request.
+        """
+        pools = {"primary": self._db}
+        if self._read_db is not self._db:
+            pools["read"] = self._read_db
+        stats = {}
+        for name, database in pools.items():
+            pool = getattr(database._backend, "_pool", None)
+            pool_stats = self._pool_stats[database]
+            stats[name] = {
+                "size": getattr(pool, "size", None),
+                "free": getattr(pool, "freesize", None),
+                "max_size": getattr(pool, "maxsize", None),
+                "acquired": pool_stats.acquired,
+                "wait_seconds_total": pool_stats.wait_total,
+                "wait_seconds_max": pool_stats.wait_max,
+            }
+        return stats
+
+    @asynccontextmanager
+    async def _connection(
+        self, database: Database
+    ) -> AsyncIterator[Connection]:
+        """
+        Acquire a connection from the pool, recording how long it took.
+
+        `databases` keeps the connection for the current task, so all queries to `database`
+        inside the block reuse it.
+        """
+        connection = database.connection()
+        start = time.perf_counter()
+        async with connection:
+            self._pool_stats[database].record(time.perf_counter() - start)
+            yield connection
+
+    def _read_database(self, account_id: Optional[int]) -> Database:
+        """
+        Pool for reading data of the account.
+
+        Accounts that were written to in the last `READ_YOUR_WRITES_WINDOW` seconds are read from the primary,
+        so their clients see their own writes even if the replica lags behind.
+        """
+        if account_id is None:
+            return self._db
+        last_write = self._last_writes.get(account_id)
+        if (
+            last_write is not None
+            and time.monotonic() - last_write < settings.READ_YOUR_WRITES_WINDOW
+        ):
+            return self._db
+        return self._read_db
+
+    def _mark_written(self, *account_ids: int):
+        if self._read_db is self._db:
+            return
+        now = time.monotonic()
+        for account_id in account_ids:
+            self._last_writes[account_id] = now
+            self._last_writes.move_to_end(account_id)
+        # Entries are ordered by time, so expired ones are at the start
+        while (
+            self._last_writes
+            and now - next(iter(self._last_writes.values()))
+            >= settings.READ_YOUR_WRITES_WINDOW
+        ):
+            self._last_writes.popitem(last=False)
+
+    def _statement(
+        self,
+        database: Database,
+        shape: Hashable,
+        build: Callable[[], sqlalchemy.sql.expression.Select],
+    ) -> Statement:
+        """
+        Compiled statement for the query `build()` returns, cached by the dialect and `shape`.
+
+        `shape` must identify everything that changes the SQL, values go into named `bindparam()`s.
+        """
+        dialect = database._backend._dialect
+        key = (dialect.name, shape)
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = self._statements[key] = Statement(build(), dialect)
+        return statement
+
+    async def _archive_watermark(
+        self, database: Database
+    ) -> Optional[datetime]:
+        """
+        Time before which transactions are archived, re-read every `ARCHIVE_WATERMARK_TTL` seconds.
+
+        Each pool has its own watermark, so a lagging replica is read consistently with its own data.
+        """
+        watermark, checked = self._archive_watermarks.get(
+            database, (None, None)
+        )
+        now = time.monotonic()
+        if checked is None or now - checked >= settings.ARCHIVE_WATERMARK_TTL:
+            watermark = await database.fetch_val(
+                sqlalchemy.select([archive_watermark.c.created])
+            )
+            self._archive_watermarks[database] = (watermark, now)
+        return watermark
+
+    @staticmethod
+    def _transaction_tables(
+        watermark: Optional[datetime],
+        dt_from: Optional[datetime] = None,
+        dt_to: Optional[datetime] = None,
+    ) -> list[tuple[sqlalchemy.Table, Optional[datetime], Optional[datetime]]]:
+        """
+        Tables with transactions created from `dt_from` to `dt_to` inclusive, newer first,
+        along with the part of the range each of them holds.
+
+        Transactions being archived are in both tables for a while, so ranges are split at the watermark.
+        """
+        if watermark is None or (dt_from is not None and dt_from >= watermark):
+            return [(transaction, dt_from, dt_to)]
+        if dt_to is not None and dt_to < watermark:
+            return [(transaction_archive, dt_from, dt_to)]
+        return [
+            (transaction, watermark, dt_to),
+            (transaction_archive, dt_from, watermark - TIMESTAMP_RESOLUTION),
+        ]
+
     @property
     def dbapi(self):
         # Shortcut for accessing dialect module, e.g. for handling errors.
@@ -102,68 +528,762 @@ class DB:
             return dbapi.error
         return dbapi
 
+    @metrics.instrument("db")
     async def get_account(
         self, id_or_username: Union[int, str]
     ) -> Optional[models.Account]:
-        if isinstance(id_or_username, int):
-            query = account.select().where(account.c.id == id_or_username)
-        else:
-            query = account.select().where(account.c.username == id_or_username)
-        res = await self._db.fetch_one(query)
+        column = "id" if isinstance(id_or_username, int) else "username"
+        statement = self._statement(
+            self._db,
+            ("account", column),
+            lambda: account.select().where(
+                account.c[column] == sqlalchemy.bindparam("value")
+            ),
+        )
+        async with self._connection(self._db):
+            res = await self._db.fetch_one(statement(value=id_or_username))
         if res is not None:
             return models.Account.parse_obj(res)
         return None
 
+    @metrics.instrument("db")
+    async def get_balance(self, account_id: int, at: datetime) -> int:
+        """
+        Balance of the account at the given time.
+
+        Starts from the latest daily snapshot before the day of `at` and adds transactions since then,
+        which are only that day's transactions if all of them were created with snapshots.
+        Without an earlier snapshot, transactions after `at` are subtracted from the current balance.
+        """
+        database = self._read_database(account_id)
+        async with self._connection(database):
+            snapshot = await database.fetch_one(
+                sqlalchemy.select(
+                    [balance_snapshot.c.day, balance_snapshot.c.balance]
+                )
+                .where(balance_snapshot.c.account_id == account_id)
+                .where(balance_snapshot.c.day < at.date())
+                .order_by(balance_snapshot.c.day.desc())
+                .limit(1)
+            )
+            if snapshot is not None:
+                day_end = datetime.combine(
+                    snapshot["day"] + timedelta(days=1), datetime.min.time()
+                )
+                return snapshot["balance"] + await self._balance_change(
+                    database, account_id, since=day_end, until=at
+                )
+            balance = await database.fetch_val(
+                sqlalchemy.select([account.c.balance]).where(
+                    account.c.id == account_id
+                )
+            )
+            return balance - await self._balance_change(
+                database, account_id, since=at + TIMESTAMP_RESOLUTION
+            )
+
+    async def _balance_change(
+        self,
+        database: Database,
+        account_id: int,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> int:
+        """
+        Sum of `_balance_change_query` over the tables holding the range.
+        """
+        watermark = await self._archive_watermark(database)
+        change = 0
+        for table, part_from, part_to in self._transaction_tables(
+            watermark, since, until
+        ):
+            change += await database.fetch_val(
+                self._balance_change_query(
+                    account_id, part_from, part_to, table
+                )
+            )
+        return change
+
+    @metrics.instrument("db")
+    async def get_summary(
+        self,
+        account_id: int,
+        date_from: date,
+        date_to: date,
+        period: models.SummaryPeriod = models.SummaryPeriod.day,
+    ) -> list[models.TransactionSummary]:
+        """
+        Number and sum of incoming and outgoing transactions of the account by period and type,
+        for days from `date_from` to `date_to` inclusive.
+
+        Daily rollup rows are grouped into periods here, so a year takes at most a row per day and type to read.
+        Periods are identified by their first day, which may be earlier than `date_from`.
+        """
+        summaries: dict[tuple[date, models.TransactionType], Counter] = {}
+        database = self._read_database(account_id)
+        async with self._connection(database):
+            rows = await database.fetch_all(
+                transaction_rollup.select()
+                .where(transaction_rollup.c.account_id == account_id)
+                .where(transaction_rollup.c.day >= date_from)
+                .where(transaction_rollup.c.day <= date_to)
+                .order_by(transaction_rollup.c.day)
+            )
+        for row in rows:
+            key = (period.start(row["day"]), row["type"])
+            summary = summaries.setdefault(key, Counter())
+            for counter in ROLLUP_COUNTERS:
+                summary[counter] += row[counter]
+        types = list(models.TransactionType)
+        return [
+            models.TransactionSummary(
+                period=period_start,
+                type=type_,
+                **summaries[period_start, type_],
+            )
+            for period_start, type_ in sorted(
+                summaries, key=lambda key: (key[0], types.index(key[1]))
+            )
+        ]
+
+    @metrics.instrument("db")
+    async def rebuild_rollup(self, day: date):
+        """
+        Recompute rollup rows of the day from its transactions.
+
+        Used to fill in days before the rollup was maintained. Transactions are only created
+        with the current time, so it's safe to run for past days while the API is running.
+        """
+        start = datetime.combine(day, datetime.min.time())
+        end = start + timedelta(days=1) - TIMESTAMP_RESOLUTION
+        async with self._connection(self._db), self._db.transaction():
+            increments: dict[RollupKey, Counter[str]] = {}
+            parts = self._transaction_tables(
+                await self._archive_watermark(self._db), start, end
+            )
+            for table, part_from, part_to in parts:
+                for direction, column in (
+                    ("in", table.c.account_to),
+                    ("out", table.c.account_from),
+                ):
+                    query = (
+                        sqlalchemy.select(
+                            [
+                                column.label("account_id"),
+                                table.c.type,
+                                sqlalchemy.func.count().label("count"),
+                                sqlalchemy.func.sum(table.c.amount).label(
+                                    "amount"
+                                ),
+                            ]
+                        )
+                        .where(table.c.created >= part_from)
+                        .where(table.c.created <= part_to)
+                        .group_by(column, table.c.type)
+                    )
+                    if direction == "out":
+                        query = query.where(
+                            table.c.type == models.TransactionType.transfer
+                        )
+                    for row in await self._db.fetch_all(query):
+                        counters = increments.setdefault(
+                            (row["account_id"], day, row["type"]), Counter()
+                        )
+                        counters[f"count_{direction}"] += row["count"]
+                        counters[f"amount_{direction}"] += row["amount"]
+            await self._db.execute(
+                transaction_rollup.delete().where(
+                    transaction_rollup.c.day == day
+                )
+            )
+            await self._apply_rollup_increments(increments)
+
+    @metrics.instrument("db")
     async def create_account(self, username: str, password: str):
-        async with self._db.transaction():
+        async with self._connection(self._db), self._db.transaction():
             await self._db.execute(
                 account.insert(),
                 values={"username": username, "password": password},
             )
 
+    @metrics.instrument("db")
     async def create_transaction(
         self,
         id_: str,
         account_from: int,
-        account_to: int,
+        account_to: Union[int, str],
         amount: int,
         type_: models.TransactionType,
-    ):
+    ) -> models.TransactionStatus:
+        """
+        Move `amount` between the accounts and record the transaction.
+
+        For transfers both account rows are locked first, then the recipient is resolved (by ID or username)
+        and the sender's balance is checked with a single query before any balance is changed,
+        so insufficient funds are reported without relying on the balance constraint.
+
+        A retry with the ID of an existing transaction is recognized before any account is locked.
+        It's reported as `replayed` if the parameters match and as `conflict` otherwise.
+        """
+        async with self._connection(self._db):
+            existing = await self._find_transaction(id_)
+            if existing is not None:
+                return await self._replay_status(
+                    existing, account_from, account_to, amount, type_
+                )
+
+            created = datetime.utcnow().replace(microsecond=0)
+            try:
+                async with self._db.transaction():
+                    if type_ is models.TransactionType.transfer:
+                        await self._lock_accounts(
+                            (account.c.id == account_from)
+                            | self._account_filter(account, account_to)
+                        )
+                        sender = account.alias("sender")
+                        recipient = account.alias("recipient")
+                        res = await self._db.fetch_one(
+                            sqlalchemy.select(
+                                [sender.c.balance, recipient.c.id]
+                            )
+                            .where(sender.c.id == account_from)
+                            .where(self._account_filter(recipient, account_to))
+                        )
+                        if res is None:
+                            return models.TransactionStatus.unknown_account
+                        if res[recipient.c.id] == settings.TOPUP_ACCOUNT_ID:
+                            return models.TransactionStatus.system_account
+                        if res[sender.c.balance] < amount:
+                            return models.TransactionStatus.insufficient_funds
+                        account_to = res[recipient.c.id]
+
+                    # Both balances are updated with one statement
+                    deltas = self._balance_deltas(
+                        account_from, account_to, amount, type_
+                    )
+                    await self._db.execute(self._balance_update(deltas))
+                    await self._snapshot_balances(deltas, created.date())
+                    row = {
+                        "id": id_,
+                        "account_from": account_from,
+                        "account_to": account_to,
+                        "amount": amount,
+                        "type": type_,
+                        "created": created,
+                    }
+                    await self._db.execute(transaction.insert(), values=row)
+                    await self._update_rollup([row])
+            except self.dbapi.IntegrityError:
+                # A concurrent request with the same ID has been committed first
+                existing = await self._find_transaction(id_)
+                if existing is None:
+                    raise
+                return await self._replay_status(
+                    existing, account_from, account_to, amount, type_
+                )
+
+        self._remember_transaction(
+            id_, (account_from, account_to, amount, type_)
+        )
+        self._mark_written(account_from, account_to)
+        return models.TransactionStatus.created
+
+    @metrics.instrument("db")
+    async def create_transactions(
+        self,
+        account_id: int,
+        items: list[models.TransactionBatchItem],
+        atomic: bool = True,
+    ) -> list[models.TransactionStatus]:
+        """
+        Apply a batch of transactions of the account in a single DB transaction.
+
+        Recipients and already existing IDs are looked up with one query each, balance changes are aggregated
+        into one UPDATE and transactions are recorded with multi-row INSERTs.
+        Transactions are validated in order against the running balance of the account.
+        If `atomic` is set and any transaction fails, none of them are applied.
+        If a concurrent request records one of the IDs first, the batch is applied again,
+        and that transaction is reported as `replayed` or `conflict`.
+        Returns the status of each transaction.
+        """
+        async with self._connection(self._db):
+            try:
+                statuses, rows, deltas = await self._apply_transactions(
+                    account_id, items, atomic
+                )
+            except self.dbapi.IntegrityError:
+                # The existing ID is found by the retry
+                statuses, rows, deltas = await self._apply_transactions(
+                    account_id, items, atomic
+                )
+
+        for row in rows:
+            self._remember_transaction(
+                row["id"],
+                (
+                    row["account_from"],
+                    row["account_to"],
+                    row["amount"],
+                    row["type"],
+                ),
+            )
+        self._mark_written(*deltas)
+        return statuses
+
+    async def _apply_transactions(
+        self,
+        account_id: int,
+        items: list[models.TransactionBatchItem],
+        atomic: bool,
+    ) -> tuple[list[models.TransactionStatus], list[dict], Counter[int]]:
+        """
+        Single attempt of `create_transactions`.
+
+        Returns the statuses, the recorded transaction rows and the balance changes.
+        """
+        transfers = [
+            item
+            for item in items
+            if item.type is models.TransactionType.transfer
+        ]
+        recipient_ids = {
+            item.account_to.id
+            for item in transfers
+            if item.account_to and item.account_to.id is not None
+        }
+        recipient_usernames = {
+            item.account_to.username
+            for item in transfers
+            if item.account_to and item.account_to.id is None
+        }
+        created = datetime.utcnow().replace(microsecond=0)
+        statuses = []
+        deltas: Counter[int] = Counter()
+        rows = []
+
+        # Recipients are locked together with the sender, so concurrent batches and transfers
+        # between the same accounts can't each hold one of the rows and wait for the other
+        locked = account.c.id == account_id
+        if recipient_ids:
+            locked |= account.c.id.in_(list(recipient_ids))
+        if recipient_usernames:
+            locked |= account.c.username.in_(list(recipient_usernames))
+
         async with self._db.transaction():
-            if type_ is models.TransactionType.transfer:
+            await self._lock_accounts(locked)
+            balance = await self._db.fetch_val(
+                sqlalchemy.select([account.c.balance]).where(
+                    account.c.id == account_id
+                )
+            )
+            recipients = {}
+            if recipient_ids or recipient_usernames:
+                for row in await self._db.fetch_all(
+                    sqlalchemy.select([account.c.id, account.c.username]).where(
+                        account.c.id.in_(list(recipient_ids))
+                        | account.c.username.in_(list(recipient_usernames))
+                    )
+                ):
+                    recipients[row["id"]] = row["id"]
+                    recipients[row["username"]] = row["id"]
+            existing = await self._find_transactions(
+                [item.id for item in items]
+            )
+
+            for item in items:
+                if item.type is models.TransactionType.transfer:
+                    account_from = account_id
+                    account_to = (
+                        recipients.get(
+                            item.account_to.id
+                            if item.account_to.id is not None
+                            else item.account_to.username
+                        )
+                        if item.account_to is not None
+                        else None
+                    )
+                else:
+                    account_from = settings.TOPUP_ACCOUNT_ID
+                    account_to = account_id
+
+                key = (account_from, account_to, item.amount, item.type)
+                if item.id in existing:
+                    status = (
+                        models.TransactionStatus.replayed
+                        if existing[item.id] == key
+                        else models.TransactionStatus.conflict
+                    )
+                elif account_to is None:
+                    status = models.TransactionStatus.unknown_account
+                elif account_to == settings.TOPUP_ACCOUNT_ID:
+                    status = models.TransactionStatus.system_account
+                elif (
+                    account_from == account_id
+                    and balance + deltas[account_id] < item.amount
+                ):
+                    status = models.TransactionStatus.insufficient_funds
+                else:
+                    status = models.TransactionStatus.created
+                    existing[item.id] = key
+                    self._balance_deltas(
+                        account_from, account_to, item.amount, item.type, deltas
+                    )
+                    rows.append(
+                        {
+                            "id": item.id,
+                            "account_from": account_from,
+                            "account_to": account_to,
+                            "amount": item.amount,
+                            "type": item.type,
+                            "created": created,
+                        }
+                    )
+                statuses.append(status)
+
+            if atomic and any(
+                status
+                not in (
+                    models.TransactionStatus.created,
+                    models.TransactionStatus.replayed,
+                )
+                for status in statuses
+            ):
+                statuses = [
+                    models.TransactionStatus.aborted
+                    if status is models.TransactionStatus.created
+                    else status
+                    for status in statuses
+                ]
+                return statuses, [], Counter()
+
+            if rows:
+                await self._db.execute(self._balance_update(deltas))
+                await self._snapshot_balances(deltas, created.date())
+                for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+                    await self._db.execute(
+                        transaction.insert().values(
+                            rows[i : i + INSERT_CHUNK_SIZE]
+                        )
+                    )
+                await self._update_rollup(rows)
+        return statuses, rows, deltas
+
+    # Asynchronous submission, see `wallet.worker`
+
+    @metrics.instrument("db")
+    async def enqueue_transaction(
+        self, account_id: int, item: models.TransactionBatchItem
+    ) -> models.TransactionStatus:
+        """
+        Queue a transaction of the account to be applied later with `create_transactions`.
+
+        Takes a single INSERT, so submission doesn't wait for account locks or balance updates.
+        Returns `queued`, also when the same transaction is submitted again,
+        or `conflict` if the ID is already queued with different parameters.
+        """
+        row = {
+            "id": item.id,
+            "account_id": account_id,
+            "account_to_id": item.account_to.id if item.account_to else None,
+            "account_to_username": item.account_to.username
+            if item.account_to
+            else None,
+            "type": item.type,
+            "amount": item.amount,
+        }
+        async with self._connection(self._db):
+            try:
                 await self._db.execute(
-                    account.update()
-                    .where(account.c.id == account_from)
-                    .values(balance=account.c.balance - amount)
+                    transaction_queue.insert().values(
+                        queued=datetime.utcnow(), **row
+                    )
+                )
+                return models.TransactionStatus.queued
+            except self.dbapi.IntegrityError:
+                existing = await self._db.fetch_one(
+                    sqlalchemy.select(
+                        [transaction_queue.c[column] for column in row]
+                    ).where(transaction_queue.c.id == item.id)
+                )
+        if existing is not None and dict(existing) == row:
+            return models.TransactionStatus.queued
+        return models.TransactionStatus.conflict
+
+    @metrics.instrument("db")
+    async def get_transaction_status(
+        self, transaction_id: str, account_id: int
+    ) -> Optional[models.TransactionStatus]:
+        """
+        Outcome of a transaction of the account submitted asynchronously.
+
+        Transactions created synchronously, or whose queue entries are already pruned, are reported as `created`.
+        """
+        async with self._connection(self._db):
+            status = await self._db.fetch_one(
+                sqlalchemy.select([transaction_queue.c.status])
+                .where(transaction_queue.c.id == transaction_id)
+                .where(transaction_queue.c.account_id == account_id)
+            )
+        if status is not None:
+            return status["status"] or models.TransactionStatus.queued
+        if await self.get_transaction(transaction_id, account_id) is not None:
+            return models.TransactionStatus.created
+        return None
+
+    @metrics.instrument("db")
+    async def process_queue(self, limit: int) -> int:
+        """
+        Apply up to `limit` queued transactions in submission order and record their statuses.
+
+        Transactions are claimed first, so workers running at the same time pick up different ones.
+        Transactions of each account are applied with one `create_transactions` call.
+        Processing is idempotent: transactions applied by a run that failed to record the statuses
+        are replayed once their claim expires, and statuses already recorded are kept.
+        Transactions that can't be applied are retried after their claim expires
+        and marked as `failed` after `QUEUE_MAX_ATTEMPTS` attempts.
+        Returns the number of processed transactions.
+        """
+        rows = await self._claim_queued(limit)
+        items: defaultdict[int, list] = defaultdict(list)
+        for row in rows:
+            account_to = None
+            if row["account_to_id"] is not None:
+                account_to = models.AccountBase.construct(
+                    id=row["account_to_id"]
+                )
+            elif row["account_to_username"] is not None:
+                account_to = models.AccountBase.construct(
+                    username=row["account_to_username"]
+                )
+            items[row["account_id"]].append(
+                (
+                    row,
+                    models.TransactionBatchItem.construct(
+                        id=row["id"],
+                        account_to=account_to,
+                        amount=row["amount"],
+                        type=row["type"],
+                    ),
+                )
+            )
+
+        processed = datetime.utcnow()
+        for account_id, account_items in items.items():
+            statuses = await self._apply_queued(account_id, account_items)
+            by_status: defaultdict[
+                models.TransactionStatus, list
+            ] = defaultdict(list)
+            for (row, _), status in zip(account_items, statuses):
+                if status is None:
+                    if row["attempts"] < settings.QUEUE_MAX_ATTEMPTS:
+                        # Left claimed, so it's retried after the claim expires
+                        continue
+                    status = models.TransactionStatus.failed
+                by_status[status].append(row["pk"])
+            async with self._connection(self._db):
+                for status, pks in by_status.items():
+                    await self._db.execute(
+                        transaction_queue.update()
+                        .where(transaction_queue.c.pk.in_(pks))
+                        .where(transaction_queue.c.status.is_(None))
+                        .values(status=status, processed=processed)
+                    )
+        return len(rows)
+
+    async def _claim_queued(
+        self, limit: int
+    ) -> list[sqlalchemy.engine.RowProxy]:
+        """
+        Claim up to `limit` pending transactions that aren't claimed by another worker and return them.
+        """
+        claim = secrets.token_hex(16)
+        now = datetime.utcnow()
+        claimable = transaction_queue.c.status.is_(None) & (
+            transaction_queue.c.claimed.is_(None)
+            | (
+                transaction_queue.c.claimed
+                < now - timedelta(seconds=settings.QUEUE_CLAIM_TIMEOUT)
+            )
+        )
+        async with self._connection(self._db):
+            pks = [
+                row["pk"]
+                for row in await self._db.fetch_all(
+                    sqlalchemy.select([transaction_queue.c.pk])
+                    .where(claimable)
+                    .order_by(transaction_queue.c.pk)
+                    .limit(limit)
                 )
+            ]
+            if not pks:
+                return []
+            # Rows claimed by another worker since they were read are skipped
             await self._db.execute(
-                account.update()
-                .where(account.c.id == account_to)
-                .values(balance=account.c.balance + amount)
+                transaction_queue.update()
+                .where(transaction_queue.c.pk.in_(pks))
+                .where(claimable)
+                .values(
+                    claim=claim,
+                    claimed=now,
+                    attempts=transaction_queue.c.attempts + 1,
+                )
+            )
+            return await self._db.fetch_all(
+                transaction_queue.select()
+                .where(transaction_queue.c.pk.in_(pks))
+                .where(transaction_queue.c.claim == claim)
+                .order_by(transaction_queue.c.pk)
+            )
+
+    async def _apply_queued(
+        self,
+        account_id: int,
+        account_items: list[
+            tuple[sqlalchemy.engine.RowProxy, models.TransactionBatchItem]
+        ],
+    ) -> list[Optional[models.TransactionStatus]]:
+        """
+        Apply queued transactions of the account, returning `None` for the ones that failed.
+
+        If the batch fails, its transactions are applied one by one, so a transaction that can't be applied
+        doesn't hold back the others.
+        """
+        try:
+            return await self.create_transactions(
+                account_id, [item for _, item in account_items], atomic=False
             )
+        except Exception:
+            if len(account_items) == 1:
+                logger.exception(
+                    "Failed to apply queued transaction %s",
+                    account_items[0][1].id,
+                )
+                return [None]
+        statuses = []
+        for account_item in account_items:
+            statuses += await self._apply_queued(account_id, [account_item])
+        return statuses
+
+    @metrics.instrument("db")
+    async def prune_queue(self, before: datetime):
+        """
+        Delete queue entries processed before the given time.
+        """
+        async with self._connection(self._db):
             await self._db.execute(
-                transaction.insert(),
-                values={
-                    "id": id_,
-                    "account_from": account_from,
-                    "account_to": account_to,
-                    "amount": amount,
-                    "type": type_,
-                    "created": datetime.utcnow().replace(microsecond=0),
-                },
+                transaction_queue.delete().where(
+                    transaction_queue.c.processed < before
+                )
             )
 
+    # Helpers for idempotent retries
+
+    async def _find_transaction(self, id_: str) -> Optional[TransactionKey]:
+        return (await self._find_transactions([id_])).get(id_)
+
+    async def _find_transactions(
+        self, ids: list[str]
+    ) -> dict[str, TransactionKey]:
+        """
+        Get parameters of the existing transactions with the given IDs.
+        """
+        found = {
+            id_: self._recent_transactions[id_]
+            for id_ in ids
+            if id_ in self._recent_transactions
+        }
+        missing = [id_ for id_ in ids if id_ not in found]
+        tables = [transaction]
+        if missing and await self._archive_watermark(self._db) is not None:
+            # Retries of archived transactions are rare, so the archive is only read for what's left
+            tables.append(transaction_archive)
+        for table in tables:
+            if not missing:
+                break
+            for row in await self._db.fetch_all(
+                sqlalchemy.select(
+                    [
+                        table.c.id,
+                        table.c.account_from,
+                        table.c.account_to,
+                        table.c.amount,
+                        table.c.type,
+                    ]
+                ).where(table.c.id.in_(missing))
+            ):
+                found[row["id"]] = (
+                    row["account_from"],
+                    row["account_to"],
+                    row["amount"],
+                    row["type"],
+                )
+            missing = [id_ for id_ in missing if id_ not in found]
+        return found
+
+    def _remember_transaction(self, id_: str, key: TransactionKey):
+        self._recent_transactions[id_] = key
+        while (
+            len(self._recent_transactions)
+            > settings.RECENT_TRANSACTIONS_CACHE_SIZE
+        ):
+            self._recent_transactions.popitem(last=False)
+
+    async def _replay_status(
+        self,
+        existing: TransactionKey,
+        account_from: int,
+        account_to: Union[int, str],
+        amount: int,
+        type_: models.TransactionType,
+    ) -> models.TransactionStatus:
+        """
+        Status of a retried transaction, depending on whether it matches the existing one.
+        """
+        if isinstance(account_to, str):
+            existing_account_to = existing[1]
+            usernames = await self._get_usernames({existing_account_to})
+            if usernames.get(existing_account_to) == account_to:
+                account_to = existing_account_to
+        if existing == (account_from, account_to, amount, type_):
+            return models.TransactionStatus.replayed
+        return models.TransactionStatus.conflict
+
+    @metrics.instrument("db")
     async def get_transaction(
         self, transaction_id: str, account_id: Optional[int] = None
     ) -> Optional[models.Transaction]:
-        query = self._transaction_query(for_account=account_id).where(
-            transaction.c.id == transaction_id
-        )
-        res = await self._db.fetch_one(query)
-        if res is not None:
-            return self._build_transaction_model(res)
-        return None
+        database = self._read_database(account_id)
+        values = {"transaction_id": transaction_id}
+        if account_id is not None:
+            values["account_id"] = account_id
+        async with self._connection(database):
+            tables = [transaction]
+            if await self._archive_watermark(database) is not None:
+                tables.append(transaction_archive)
+            for table in tables:
+                statement = self._statement(
+                    database,
+                    ("transaction", table.name, account_id is not None),
+                    lambda: self._transaction_query(
+                        for_account=sqlalchemy.bindparam("account_id")
+                        if account_id is not None
+                        else None,
+                        table=table,
+                    ).where(
+                        table.c.id == sqlalchemy.bindparam("transaction_id")
+                    ),
+                )
+                res = await database.fetch_one(statement(**values))
+                if res is not None:
+                    break
+            else:
+                return None
+            usernames = await self._get_usernames(
+                {res["account_from"], res["account_to"]}, database
+            )
+        return self._build_transaction_model(res, usernames)
 
+    @metrics.instrument("db")
     async def get_transactions(
         self,
         account_id: int,
@@ -171,68 +1291,505 @@ class DB:
         dt_to: Optional[datetime] = None,
         limit: Optional[int] = None,
         order: Optional[models.Ordering] = None,
+        after: Optional[tuple[datetime, str]] = None,
     ) -> list[models.Transaction]:
-        query = self._transaction_query(for_account=account_id)
+        """
+        Get transactions of the account ordered by `(created, id)`.
 
-        if dt_from is not None:
-            query = query.where(transaction.c.created >= dt_from)
-        if dt_to is not None:
-            query = query.where(transaction.c.created <= dt_to)
-        if limit is not None:
-            query = query.limit(limit)
-        if order is not None:
-            query = query.order_by(
-                transaction.c.created.asc()
-                if order is models.Ordering.asc
-                else transaction.c.created.desc()
+        `after` is the `(created, id)` key of the transaction to continue from in the given order,
+        which allows to paginate with an index seek instead of an offset.
+        """
+        return [
+            models.Transaction.construct(**row)
+            for row in await self.get_transaction_dicts(
+                account_id, dt_from, dt_to, limit, order, after
             )
+        ]
 
-        res = await self._db.fetch_all(query)
-        return [self._build_transaction_model(row) for row in res]
+    @metrics.instrument("db")
+    async def get_transaction_dicts(
+        self,
+        account_id: int,
+        dt_from: Optional[datetime] = None,
+        dt_to: Optional[datetime] = None,
+        limit: Optional[int] = None,
+        order: Optional[models.Ordering] = None,
+        after: Optional[tuple[datetime, str]] = None,
+    ) -> list[dict]:
+        """
+        Same as `get_transactions`, but returns plain dicts in the shape of `models.Transaction`.
 
-    # Helpers for selecting transactions
+        Used to encode large pages to JSON without creating and validating models.
+        Ranges that cross the archive watermark are read from both tables, the next one only
+        if the page isn't filled yet.
+        """
+        # The `after` key bounds the range too, so the page doesn't touch a table it can't continue in
+        range_from, range_to = dt_from, dt_to
+        if after is not None:
+            if order is models.Ordering.asc:
+                range_from = max(dt_from or after[0], after[0])
+            else:
+                range_to = min(dt_to or after[0], after[0])
+        database = self._read_database(account_id)
+        res = []
+        async with self._connection(database):
+            parts = self._transaction_tables(
+                await self._archive_watermark(database), range_from, range_to
+            )
+            if order is models.Ordering.asc:
+                parts.reverse()
+            for table, part_from, part_to in parts:
+                remaining = limit - len(res) if limit is not None else None
+                statement, values = self._history_statement(
+                    database,
+                    table,
+                    account_id,
+                    part_from,
+                    part_to,
+                    remaining,
+                    order,
+                    after,
+                )
+                res.extend(await database.fetch_all(statement(**values)))
+                if limit is not None and len(res) >= limit:
+                    break
+            usernames = await self._get_usernames(
+                {
+                    row[column]
+                    for row in res
+                    for column in ("account_from", "account_to")
+                },
+                database,
+            )
+        return [self._transaction_dict(row, usernames) for row in res]
+
+    def _history_statement(
+        self,
+        database: Database,
+        table: sqlalchemy.Table,
+        account_id: int,
+        dt_from: Optional[datetime],
+        dt_to: Optional[datetime],
+        limit: Optional[int],
+        order: Optional[models.Ordering],
+        after: Optional[tuple[datetime, str]],
+    ) -> tuple[Statement, dict]:
+        """
+        Cached history statement of the table along with the values to execute it with.
+        """
+        values = {
+            "account_id": account_id,
+            "dt_from": dt_from,
+            "dt_to": dt_to,
+            "limit": limit,
+        }
+        if after is not None:
+            values["after_created"], values["after_id"] = after
+        values = {
+            name: value for name, value in values.items() if value is not None
+        }
+        params = {
+            name: sqlalchemy.bindparam(
+                name,
+                type_=sqlalchemy.Integer if name == "limit" else None,
+            )
+            for name in values
+        }
+        statement = self._statement(
+            database,
+            ("history", table.name, order, *sorted(values)),
+            lambda: self._history_query(
+                params["account_id"],
+                params.get("dt_from"),
+                params.get("dt_to"),
+                params.get("limit"),
+                order,
+                (params["after_created"], params["after_id"])
+                if after is not None
+                else None,
+                table,
+            ),
+        )
+        return statement, values
+
+    async def iter_transaction_dicts(
+        self,
+        account_id: int,
+        dt_from: Optional[datetime],
+        dt_to: Optional[datetime],
+        chunk_size: int,
+    ) -> AsyncIterator[list[dict]]:
+        """
+        Iterate over all transactions of the account in ascending order, in chunks of `chunk_size`.
+
+        Each chunk is a separate keyset-paginated query, so memory use doesn't depend on the number
+        of transactions and no connection is held while the consumer processes a chunk.
+        """
+        after = None
+        while True:
+            chunk = await self.get_transaction_dicts(
+                account_id,
+                dt_from,
+                dt_to,
+                chunk_size,
+                models.Ordering.asc,
+                after,
+            )
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = (chunk[-1]["created"], chunk[-1]["id"])
+
+    async def _get_usernames(
+        self, account_ids: set[int], database: Optional[Database] = None
+    ) -> dict[int, str]:
+        """
+        Map account IDs to usernames, querying only the ones that aren't cached yet.
+        """
+        usernames = {}
+        for account_id in account_ids:
+            username = self._usernames.get(account_id)
+            if username is not None:
+                self._usernames.move_to_end(account_id)
+                usernames[account_id] = username
+        missing = account_ids - usernames.keys()
+        if missing:
+            for row in await (database or self._db).fetch_all(
+                sqlalchemy.select([account.c.id, account.c.username]).where(
+                    account.c.id.in_(list(missing))
+                )
+            ):
+                usernames[row["id"]] = row["username"]
+                self._usernames[row["id"]] = row["username"]
+            while len(self._usernames) > settings.USERNAME_CACHE_SIZE:
+                self._usernames.popitem(last=False)
+        return usernames
+
+    # Helpers for creating transactions
 
     @staticmethod
-    def _transaction_query(
-        for_account: Optional[int] = None,
-    ) -> sqlalchemy.sql.expression.Select:
-        account_from_alias = account.alias()
-        account_to_alias = account.alias()
-        query = (
-            sqlalchemy.sql.select(
-                [
-                    transaction,
-                    account_from_alias.c.username.label(
-                        "account_from_username"
-                    ),
-                    account_to_alias.c.username.label("account_to_username"),
-                ]
+    def _account_filter(
+        table: sqlalchemy.sql.expression.FromClause,
+        id_or_username: Union[int, str],
+    ) -> sqlalchemy.sql.expression.ColumnElement:
+        if isinstance(id_or_username, int):
+            return table.c.id == id_or_username
+        return table.c.username == id_or_username
+
+    async def _lock_accounts(
+        self, where: sqlalchemy.sql.expression.ColumnElement
+    ):
+        """
+        Lock the matching account rows until the end of the transaction with a no-op UPDATE.
+
+        It must be the first statement of the transaction. A SQLite transaction that starts with a read
+        can't take the write lock later while another transaction holds it and fails with "database is locked",
+        while one that starts with a write waits for the lock. On MySQL it locks the rows like `FOR UPDATE`.
+        """
+        await self._db.execute(
+            account.update().where(where).values(balance=account.c.balance)
+        )
+
+    @staticmethod
+    def _balance_deltas(
+        account_from: int,
+        account_to: int,
+        amount: int,
+        type_: models.TransactionType,
+        deltas: Optional[Counter[int]] = None,
+    ) -> Counter[int]:
+        """
+        Add balance changes caused by the transaction to `deltas`.
+
+        The system account's balance is never changed by topups. A transfer to the same account adds up to zero.
+        """
+        if deltas is None:
+            deltas = Counter()
+        if type_ is models.TransactionType.transfer:
+            deltas[account_from] -= amount
+        deltas[account_to] += amount
+        return deltas
+
+    @staticmethod
+    def _balance_update(
+        deltas: Counter[int],
+    ) -> sqlalchemy.sql.expression.Update:
+        """
+        Single statement that applies balance changes to all accounts in `deltas`.
+        """
+        return (
+            account.update()
+            .where(account.c.id.in_(list(deltas)))
+            .values(
+                balance=account.c.balance
+                + sqlalchemy.case(
+                    [
+                        (account.c.id == account_id, delta)
+                        for account_id, delta in deltas.items()
+                    ],
+                    else_=0,
+                )
             )
-            .where(
-                transaction.c.account_from == account_from_alias.c.id,
+        )
+
+    async def _snapshot_balances(self, account_ids: Iterable[int], day: date):
+        """
+        Record current balances of the accounts as their closing balances of `day`.
+
+        Must be called in the same DB transaction as the balance update, after it.
+        """
+        account_ids = list(account_ids)
+        await self._db.execute(
+            balance_snapshot.update()
+            .where(balance_snapshot.c.account_id.in_(account_ids))
+            .where(balance_snapshot.c.day == day)
+            .values(
+                balance=sqlalchemy.select([account.c.balance])
+                .where(account.c.id == balance_snapshot.c.account_id)
+                .as_scalar()
+            )
+        )
+        # Accounts that don't have a snapshot of the day yet
+        await self._db.execute(
+            balance_snapshot.insert()
+            .from_select(
+                ["account_id", "day", "balance"],
+                sqlalchemy.select(
+                    [
+                        account.c.id,
+                        sqlalchemy.literal(day, sqlalchemy.Date),
+                        account.c.balance,
+                    ]
+                ).where(account.c.id.in_(account_ids)),
+            )
+            .prefix_with("OR IGNORE", dialect="sqlite")
+            .prefix_with("IGNORE", dialect="mysql")
+        )
+
+    async def _update_rollup(self, rows: Iterable[dict]):
+        """
+        Add newly created transactions to `transaction_rollup`.
+        """
+        increments: dict[RollupKey, Counter[str]] = {}
+        for row in rows:
+            day = row["created"].date()
+            counters = increments.setdefault(
+                (row["account_to"], day, row["type"]), Counter()
+            )
+            counters["count_in"] += 1
+            counters["amount_in"] += row["amount"]
+            if row["type"] is models.TransactionType.transfer:
+                counters = increments.setdefault(
+                    (row["account_from"], day, row["type"]), Counter()
+                )
+                counters["count_out"] += 1
+                counters["amount_out"] += row["amount"]
+        await self._apply_rollup_increments(increments)
+
+    async def _apply_rollup_increments(
+        self, increments: dict[RollupKey, Counter[str]]
+    ):
+        keys = list(increments)
+        for i in range(0, len(keys), INSERT_CHUNK_SIZE):
+            chunk = keys[i : i + INSERT_CHUNK_SIZE]
+            await self._db.execute(
+                transaction_rollup.insert()
+                .values(
+                    [
+                        {
+                            "account_id": account_id,
+                            "day": day,
+                            "type": type_,
+                            **dict.fromkeys(ROLLUP_COUNTERS, 0),
+                        }
+                        for account_id, day, type_ in chunk
+                    ]
+                )
+                .prefix_with("OR IGNORE", dialect="sqlite")
+                .prefix_with("IGNORE", dialect="mysql")
             )
-            .where(
-                transaction.c.account_to == account_to_alias.c.id,
+            values = {}
+            for counter in ROLLUP_COUNTERS:
+                whens = [
+                    (self._rollup_key_filter(key), increments[key][counter])
+                    for key in chunk
+                    if increments[key][counter]
+                ]
+                if whens:
+                    values[counter] = transaction_rollup.c[
+                        counter
+                    ] + sqlalchemy.case(whens, else_=0)
+            await self._db.execute(
+                transaction_rollup.update()
+                .where(
+                    sqlalchemy.or_(
+                        *[self._rollup_key_filter(key) for key in chunk]
+                    )
+                )
+                .values(values)
             )
+
+    @staticmethod
+    def _rollup_key_filter(
+        key: RollupKey,
+    ) -> sqlalchemy.sql.expression.ColumnElement:
+        # Built anew for each use, as the SQLite backend doesn't support reusing bound parameters
+        account_id, day, type_ = key
+        return sqlalchemy.and_(
+            transaction_rollup.c.account_id == account_id,
+            transaction_rollup.c.day == day,
+            transaction_rollup.c.type == type_,
         )
+
+    # Helpers for selecting transactions
+
+    @staticmethod
+    def _transaction_query(
+        for_account: Optional[int] = None,
+        table: sqlalchemy.Table = transaction,
+    ) -> sqlalchemy.sql.expression.Select:
+        query = table.select()
         if for_account is not None:
             query = query.where(
-                (transaction.c.account_from == for_account)
-                | (transaction.c.account_to == for_account)
+                (table.c.account_from == for_account)
+                | (table.c.account_to == for_account)
             )
         return query
 
     @staticmethod
+    def _balance_change_query(
+        account_id: int,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        table: sqlalchemy.Table = transaction,
+    ) -> sqlalchemy.sql.expression.Select:
+        """
+        Net change of the account's balance by transactions created from `since` to `until` inclusive.
+
+        Incoming and outgoing amounts are summed separately, so each sum is a range scan of its index.
+        """
+        sums = []
+        for column in (table.c.account_to, table.c.account_from):
+            conditions = [column == account_id]
+            if column is table.c.account_from:
+                # Topups don't change the system account's balance
+                conditions.append(
+                    table.c.type == models.TransactionType.transfer
+                )
+            if since is not None:
+                conditions.append(table.c.created >= since)
+            if until is not None:
+                conditions.append(table.c.created <= until)
+            sums.append(
+                sqlalchemy.select(
+                    [
+                        sqlalchemy.func.coalesce(
+                            sqlalchemy.func.sum(table.c.amount), 0
+                        )
+                    ]
+                )
+                .where(sqlalchemy.and_(*conditions))
+                .as_scalar()
+            )
+        incoming, outgoing = sums
+        return sqlalchemy.select([incoming - outgoing])
+
+    @classmethod
+    def _history_query(
+        cls,
+        account_id: int,
+        dt_from: Optional[datetime] = None,
+        dt_to: Optional[datetime] = None,
+        limit: Optional[int] = None,
+        order: Optional[models.Ordering] = None,
+        after: Optional[tuple[datetime, str]] = None,
+        table: sqlalchemy.Table = transaction,
+    ) -> sqlalchemy.sql.expression.Select:
+        """
+        Transactions of the account as a UNION ALL of outgoing and incoming ones.
+
+        Filtering by `account_from = X OR account_to = X` can't use an index for both sides,
+        while each branch here is a range scan of its `(account, created, id)` index.
+        Branches are ordered and limited on their own and merged on top.
+        """
+        branches = []
+        for column in (table.c.account_from, table.c.account_to):
+            query = cls._transaction_query(table=table).where(
+                column == account_id
+            )
+            if column is table.c.account_to:
+                # Transfers to self are already selected as outgoing
+                query = query.where(table.c.account_from != account_id)
+            if dt_from is not None:
+                query = query.where(table.c.created >= dt_from)
+            if dt_to is not None:
+                query = query.where(table.c.created <= dt_to)
+            query = cls._paginate(query, table.c, limit, order, after)
+            branches.append(sqlalchemy.select([query.alias()]))
+
+        history = sqlalchemy.union_all(*branches).alias("history")
+        return cls._paginate(
+            sqlalchemy.select([history]), history.c, limit, order
+        )
+
+    @staticmethod
+    def _paginate(
+        query: sqlalchemy.sql.expression.Select,
+        columns: sqlalchemy.sql.expression.ColumnCollection,
+        limit: Optional[int] = None,
+        order: Optional[models.Ordering] = None,
+        after: Optional[tuple[datetime, str]] = None,
+    ) -> sqlalchemy.sql.expression.Select:
+        """
+        Order the query by `(created, id)`, starting after the `after` key.
+        """
+        if after is not None:
+            # The redundant bound on `created` keeps the condition a single index range
+            created, id_ = after
+            if order is models.Ordering.asc:
+                query = query.where(columns.created >= created).where(
+                    (columns.created > created) | (columns.id > id_)
+                )
+            else:
+                query = query.where(columns.created <= created).where(
+                    (columns.created < created) | (columns.id < id_)
+                )
+        if limit is not None:
+            query = query.limit(limit)
+        if order is models.Ordering.asc:
+            query = query.order_by(columns.created.asc(), columns.id.asc())
+        elif order is not None or after is not None:
+            query = query.order_by(columns.created.desc(), columns.id.desc())
+        return query
+
+    @classmethod
     def _build_transaction_model(
+        cls,
         row: sqlalchemy.engine.RowProxy,
+        usernames: dict[int, str],
     ) -> models.Transaction:
-        row = dict(row)
-        row["account_from"] = {
-            "id": row.pop("account_from"),
-            "username": row.pop("account_from_username"),
-        }
-        row["account_to"] = {
-            "id": row.pop("account_to"),
-            "username": row.pop("account_to_username"),
+        return models.Transaction.construct(
+            **cls._transaction_dict(row, usernames)
+        )
+
+    @staticmethod
+    def _transaction_dict(
+        row: sqlalchemy.engine.RowProxy,
+        usernames: dict[int, str],
+    ) -> dict:
+        # Keys are in the order of `models.Transaction` fields, as in responses encoded by the model
+        return {
+            "account_to": {
+                "id": row["account_to"],
+                "username": usernames.get(row["account_to"]),
+            },
+            "amount": row["amount"],
+            "type": row["type"],
+            "id": row["id"],
+            "created": row["created"],
+            "account_from": {
+                "id": row["account_from"],
+                "username": usernames.get(row["account_from"]),
+            },
         }
-        return models.Transaction.construct(**row)
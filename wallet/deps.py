@@ -1,27 +1,111 @@
 """
 Dependency definitions for the FastAPI dependency injection system
 """
-from fastapi import Depends, HTTPException, status
-from fastapi.security import HTTPBasicCredentials
+from typing import Optional
+
+import secrets
+
+from databases import DatabaseURL
+from fastapi import Depends, Header, HTTPException, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBasicCredentials
 
 from . import auth, models
 from .db import DB
 from .settings import settings
+from .worker import Worker
+
+# Backends with a connection pool. The SQLite backend passes all options to `aiosqlite.connect`.
+POOLED_DIALECTS = {"mysql", "postgres", "postgresql"}
+
+
+def _pool_options(db_uri: str, size: Optional[int]) -> dict[str, int]:
+    if size is None or DatabaseURL(db_uri).dialect not in POOLED_DIALECTS:
+        return {}
+    return {"max_size": size}
+
+
+db = DB(
+    settings.DATABASE_URI,
+    read_db_uri=settings.DATABASE_READ_URI,
+    read_pool_options=_pool_options(
+        settings.DATABASE_READ_URI or settings.DATABASE_URI,
+        settings.DATABASE_READ_POOL_SIZE,
+    ),
+    **_pool_options(settings.DATABASE_URI, settings.DATABASE_POOL_SIZE),
+)
 
-db = DB(settings.DATABASE_URI)
+# Applies transactions submitted with `Prefer: respond-async`
+worker = Worker(db)
+
+
+def _unauthorized(detail: str, scheme: str = "Basic") -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": scheme},
+    )
+
+
+async def get_basic_user(
+    db: DB = Depends(db),
+    credentials: Optional[HTTPBasicCredentials] = Depends(auth.security),
+) -> models.Account:
+    if credentials is not None:
+        user = await db.get_account(credentials.username)
+        if user and await auth.verify_credentials(
+            credentials.username,
+            credentials.password,
+            user.password.get_secret_value(),
+        ):
+            return user
+    raise _unauthorized("Incorrect username or password")
 
 
 async def get_current_user(
     db: DB = Depends(db),
-    credentials: HTTPBasicCredentials = Depends(auth.security),
+    credentials: Optional[HTTPBasicCredentials] = Depends(auth.security),
+    token: Optional[HTTPAuthorizationCredentials] = Depends(auth.bearer),
+) -> models.User:
+    """
+    Authenticate the request either with a session token or with Basic credentials.
+
+    Token authentication doesn't touch the DB, so only the account ID and username are available.
+    Use `get_current_account` to get the full account.
+    """
+    if token is not None:
+        user = auth.verify_token(token.credentials)
+        if user is None:
+            raise _unauthorized("Invalid or expired token", scheme="Bearer")
+        return user
+    return await get_basic_user(db, credentials)
+
+
+async def get_current_account(
+    db: DB = Depends(db),
+    user: models.User = Depends(get_current_user),
 ) -> models.Account:
-    user = await db.get_account(credentials.username)
-    if user and auth.verify_password_hash(
-        credentials.password, user.password.get_secret_value()
-    ):
+    if isinstance(user, models.Account):
         return user
-    raise HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Incorrect username or password",
-        headers={"WWW-Authenticate": "Basic"},
-    )
+    account = await db.get_account(user.id)
+    if account is None:
+        raise _unauthorized("Unknown account", scheme="Bearer")
+    return account
+
+
+async def require_admin(
+    x_admin_token: Optional[str] = Header(None),
+) -> None:
+    """
+    Allow the request only if it carries `ADMIN_TOKEN` in the `X-Admin-Token` header.
+
+    Admin endpoints pretend not to exist if no token is configured.
+    """
+    if settings.ADMIN_TOKEN is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    if x_admin_token is None or not secrets.compare_digest(
+        x_admin_token.encode(), settings.ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail={"msg": "Invalid admin token"},
+        )
@@ -1,10 +1,13 @@
 from fastapi import FastAPI, Request, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 
+from . import auth, metrics, profiling
+from .admission import Overloaded, admission
 from .api import router
-from .deps import db
+from .deps import db, worker
+from .settings import settings
 
 app = FastAPI(
     title="Wallet API",
@@ -12,15 +15,63 @@ app = FastAPI(
 )
 app.include_router(router)
 
+if settings.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.registry.register(
+        metrics.Stats(
+            "wallet_db_pool",
+            "Connection pool usage, see DB.pool_stats",
+            db.pool_stats,
+            label="pool",
+        )
+    )
+    metrics.registry.register(
+        metrics.Stats(
+            "wallet_admission",
+            "Admitted, waiting and rejected transaction requests",
+            admission.stats,
+        )
+    )
+    metrics.registry.register(
+        metrics.Stats(
+            "wallet_credential_cache",
+            "Verified credentials cache usage",
+            auth.credential_cache.stats,
+        )
+    )
+
+    @app.get("/metrics", include_in_schema=False)
+    async def get_metrics() -> PlainTextResponse:
+        return PlainTextResponse(
+            metrics.registry.render(),
+            media_type="text/plain; version=0.0.4",
+        )
+
+
+if settings.PROFILING_ENABLED:
+    # Added last, so profiles include the time spent in other middleware
+    app.add_middleware(
+        profiling.ProfilingMiddleware,
+        directory=settings.PROFILING_DIR,
+        token=settings.ADMIN_TOKEN,
+        sample_rate=settings.PROFILING_SAMPLE_RATE,
+        interval=settings.PROFILING_INTERVAL,
+        memory=settings.PROFILING_MEMORY,
+    )
+
 
 @app.on_event("startup")
 async def startup():
-    await db._db.connect()
+    await db.connect()
+    if settings.QUEUE_WORKER:
+        worker.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    await db._db.disconnect()
+    await worker.stop()
+    await db.disconnect()
+    auth.shutdown_executor()
 
 
 @app.exception_handler(RequestValidationError)
@@ -31,3 +82,12 @@ async def validation_exception_handler(
         status_code=status.HTTP_400_BAD_REQUEST,
         content=jsonable_encoder({"errors": exc.errors()}),
     )
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_exception_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": {"msg": str(exc)}},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
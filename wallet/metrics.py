@@ -0,0 +1,352 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Recording a value takes a dict lookup and a few increments, so metrics are always on.
+Values are kept per process: with several workers, each one is scraped separately.
+"""
+from typing import Any, Awaitable, Callable, Iterable, Optional, TypeVar
+
+import functools
+import time
+from bisect import bisect_left
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Latency buckets in seconds, from a cached credential check to a slow batch
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def samples(self) -> Iterable[tuple[str, Labels, Labels, float]]:
+        """
+        `(name, label names, label values, value)` of each sample.
+        """
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(
+                f"{name}{_format_labels(label_names, label_values)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()):
+        super().__init__(name, documentation, labels)
+        # Values are single-item lists, so callers can keep a series to update it without lookups
+        self._values: dict[Labels, list[float]] = {}
+
+    def series(self, *labels: str) -> list[float]:
+        value = self._values.get(labels)
+        if value is None:
+            value = self._values[labels] = [0]
+        return value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.series(*labels)[0] += amount
+
+    def samples(self) -> Iterable[tuple[str, Labels, Labels, float]]:
+        for labels, value in sorted(self._values.items()):
+            yield self.name, self.labels, labels, value[0]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.series(*labels)[0] -= amount
+
+    def set(self, value: float, *labels: str):
+        self.series(*labels)[0] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # Per label values: count in each bucket, the last one for values above all bounds, and the sum
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def series(self, *labels: str) -> tuple[list[int], list[float]]:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = (
+                [0] * (len(self.buckets) + 1),
+                [0.0],
+            )
+        return entry
+
+    def observe(self, value: float, *labels: str):
+        counts, total = self.series(*labels)
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> Iterable[tuple[str, Labels, Labels, float]]:
+        names = self.labels + ("le",)
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", names, labels + (
+                    _format_value(bound),
+                ), cumulative
+            yield f"{self.name}_count", self.labels, labels, cumulative
+            yield f"{self.name}_sum", self.labels, labels, total[0]
+
+
+class Stats(Metric):
+    """
+    Stats dicts kept by other components, e.g. `DB.pool_stats`, read at scrape time.
+
+    `collect` returns either a dict of stats or, if the metric has a label, a dict of them by label value.
+    Each stat becomes a metric named `<name>_<stat>`. Missing values are skipped.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable[[], dict],
+        label: Optional[str] = None,
+    ):
+        super().__init__(name, documentation, (label,) if label else ())
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        stats = self.collect()
+        if not self.labels:
+            stats = {None: stats}
+        by_stat: dict[str, list[str]] = {}
+        for label, values in stats.items():
+            labels = _format_labels(
+                self.labels, (label,) if self.labels else ()
+            )
+            for stat, value in values.items():
+                if value is not None:
+                    by_stat.setdefault(stat, []).append(
+                        f"{self.name}_{stat}{labels} {_format_value(value)}"
+                    )
+        lines = []
+        for stat, samples in by_stat.items():
+            lines.append(f"# HELP {self.name}_{stat} {self.documentation}")
+            lines.append(f"# TYPE {self.name}_{stat} untyped")
+            lines.extend(samples)
+        return lines
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_seconds = registry.register(
+    Histogram(
+        "wallet_http_request_seconds",
+        "Latency of HTTP requests by route",
+        ("method", "route"),
+    )
+)
+http_requests = registry.register(
+    Counter(
+        "wallet_http_requests_total",
+        "HTTP requests by route and status code",
+        ("method", "route", "status"),
+    )
+)
+http_in_flight = registry.register(
+    Gauge("wallet_http_requests_in_flight", "HTTP requests being processed")
+)
+http_exceptions = registry.register(
+    Counter(
+        "wallet_http_exceptions_total",
+        "Unhandled exceptions raised by HTTP requests by class",
+        ("method", "route", "exception"),
+    )
+)
+operation_seconds = registry.register(
+    Histogram(
+        "wallet_operation_seconds",
+        "Latency of DB and authentication operations",
+        ("component", "operation"),
+    )
+)
+operations_in_flight = registry.register(
+    Gauge(
+        "wallet_operations_in_flight",
+        "DB and authentication operations being performed",
+        ("component", "operation"),
+    )
+)
+operation_errors = registry.register(
+    Counter(
+        "wallet_operation_errors_total",
+        "Exceptions raised by DB and authentication operations by class",
+        ("component", "operation", "exception"),
+    )
+)
+
+T = TypeVar("T")
+
+
+def instrument(
+    component: str, operation: Optional[str] = None
+) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Decorator recording latency, in-flight count and exceptions of a coroutine function.
+
+    The operation is named after the function by default.
+    """
+
+    def decorator(
+        fn: Callable[..., Awaitable[T]]
+    ) -> Callable[..., Awaitable[T]]:
+        labels = (component, operation or fn.__name__)
+        # Series are looked up once, so recording is a few list updates
+        in_flight = operations_in_flight.series(*labels)
+        counts, total = operation_seconds.series(*labels)
+        buckets = operation_seconds.buckets
+
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            in_flight[0] += 1
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                operation_errors.inc(*labels, type(e).__name__)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                counts[bisect_left(buckets, elapsed)] += 1
+                total[0] += elapsed
+                in_flight[0] -= 1
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, status codes and exceptions of HTTP requests.
+
+    Requests are labeled by the path template of the route they matched, so the number of series
+    doesn't grow with IDs in URLs.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._route_paths: Optional[dict[Any, str]] = None
+
+    def _route(self, scope: Scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._route_paths is None:
+            self._route_paths = {
+                route.endpoint: route.path
+                for route in scope["app"].router.routes
+                if hasattr(route, "endpoint")
+            }
+        return self._route_paths.get(endpoint, "unmatched")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        exception = None
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            http_in_flight.dec()
+            method, route = scope["method"], self._route(scope)
+            http_request_seconds.observe(elapsed, method, route)
+            http_requests.inc(method, route, str(status_code))
+            if exception is not None:
+                http_exceptions.inc(method, route, type(exception).__name__)
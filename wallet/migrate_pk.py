@@ -0,0 +1,107 @@
+"""
+Migrates transaction tables keyed by the client ID to the internal integer `pk` key.
+
+Each table is renamed, recreated with the current schema and filled in `(created, id)` order,
+so internal keys follow creation time. Rows are copied in chunks of `CHUNK_SIZE`, one transaction each.
+Writes must be stopped while it runs. Tables that already have `pk` are skipped, and an interrupted
+run continues after the last copied row.
+
+    python -m wallet.migrate_pk
+"""
+import sqlalchemy
+
+from . import models
+from .db import DB, transaction, transaction_archive
+from .settings import settings
+
+# Rows copied per transaction, so the tables aren't locked for the whole copy
+CHUNK_SIZE = 10000
+
+
+def migrate(
+    engine: sqlalchemy.engine.Engine, chunk_size: int = CHUNK_SIZE
+) -> list[str]:
+    """
+    Migrate the tables that need it and return their names.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    migrated = []
+    for table in (transaction, transaction_archive):
+        old_name = f"{table.name}_old"
+        inspector = sqlalchemy.inspect(engine)
+        tables = set(inspector.get_table_names())
+        if old_name not in tables:
+            if table.name not in tables or "pk" in {
+                column["name"] for column in inspector.get_columns(table.name)
+            }:
+                continue
+            with engine.begin() as conn:
+                conn.execute(
+                    f"ALTER TABLE {quote(table.name)} RENAME TO {quote(old_name)}"
+                )
+
+        old = sqlalchemy.Table(
+            old_name, sqlalchemy.MetaData(), autoload_with=engine
+        )
+        if engine.dialect.name == "sqlite":
+            # Index names are global in SQLite, so they'd clash with the new table's ones.
+            # The copy reads the old table by `(created, id)`, so that index is recreated under another name.
+            for index in list(old.indexes):
+                index.drop(engine)
+                old.indexes.discard(index)
+            sqlalchemy.Index(
+                f"ix_{old_name}_created_id", old.c.created, old.c.id
+            ).create(engine)
+        table.create(engine, checkfirst=True)
+        _copy(engine, old, table, chunk_size)
+        old.drop(engine)
+        migrated.append(table.name)
+    return migrated
+
+
+def _copy(
+    engine: sqlalchemy.engine.Engine,
+    old: sqlalchemy.Table,
+    table: sqlalchemy.Table,
+    chunk_size: int,
+):
+    """
+    Copy rows of `old` to `table` in `(created, id)` order, `chunk_size` rows per transaction.
+    """
+    columns = [column.name for column in table.c if column.name != "pk"]
+    last_copied = (
+        sqlalchemy.select([table.c.created, table.c.id])
+        .order_by(table.c.pk.desc())
+        .limit(1)
+    )
+    # An interrupted run continues after the last copied row
+    after = engine.execute(last_copied).first()
+    while True:
+        with engine.begin() as conn:
+            copied = conn.execute(
+                table.insert().from_select(
+                    columns,
+                    DB._paginate(
+                        sqlalchemy.select(
+                            [old.c[column] for column in columns]
+                        ),
+                        old.c,
+                        chunk_size,
+                        models.Ordering.asc,
+                        tuple(after) if after is not None else None,
+                    ),
+                )
+            ).rowcount
+            after = conn.execute(last_copied).first()
+        if copied < chunk_size:
+            return
+
+
+if __name__ == "__main__":
+    # Databases uses PyMySQL by default, while SQLAlchemy uses MySQLdb.
+    # So we have to pass the driver explicitly.
+    sqlalchemy_url = settings.DATABASE_URI.replace(
+        "mysql://", "mysql+pymysql://"
+    )
+    for name in migrate(sqlalchemy.create_engine(sqlalchemy_url)):
+        print(f"Migrated {name}")
@@ -3,13 +3,18 @@ App-specific types and Pydantic models
 """
 from typing import Optional
 
-from datetime import datetime
+import base64
+import json
+from datetime import date, datetime, timedelta
 from enum import Enum
 
-from pydantic import BaseModel, constr, validator
+from pydantic import BaseModel, conlist, constr, validator
 from pydantic.types import NonNegativeInt, PositiveInt, SecretStr
 
+from .settings import settings
+
 Username = constr(min_length=1, max_length=255)
+TransactionId = constr(min_length=1, max_length=255)
 
 
 class AccountBase(BaseModel):
@@ -34,23 +39,116 @@ class AccountResponse(BaseModel):
     balance: NonNegativeInt
 
 
-class Account(BaseModel):
+class User(BaseModel):
     id: int
     username: Username
+
+
+class Account(User):
     balance: NonNegativeInt
     password: SecretStr
 
 
+class Balance(BaseModel):
+    balance: int
+    at: datetime
+
+
+class BalanceMismatch(BaseModel):
+    account_id: int
+    balance: int
+    # Sum of the account's transactions
+    expected: int
+
+
+class Token(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int
+
+
 class TransactionType(Enum):
     topup = "topup"
     transfer = "transfer"
 
 
+class TransactionStatus(Enum):
+    created = "created"
+    unknown_account = "unknown_account"
+    system_account = "system_account"
+    insufficient_funds = "insufficient_funds"
+    # A transaction with the same ID and parameters already exists
+    replayed = "replayed"
+    # A transaction with the same ID but different parameters already exists
+    conflict = "conflict"
+    # Not applied because another transaction in an all-or-nothing batch failed
+    aborted = "aborted"
+    # Submitted asynchronously and not processed yet
+    queued = "queued"
+    # Submitted asynchronously and couldn't be applied, see `QUEUE_MAX_ATTEMPTS`
+    failed = "failed"
+
+
 class Ordering(Enum):
     desc = "desc"
     asc = "asc"
 
 
+class SummaryPeriod(Enum):
+    day = "day"
+    week = "week"
+    month = "month"
+
+    def start(self, day: date) -> date:
+        """
+        First day of the period that contains `day`. Weeks start on Monday.
+        """
+        if self is SummaryPeriod.week:
+            return day - timedelta(days=day.weekday())
+        if self is SummaryPeriod.month:
+            return day.replace(day=1)
+        return day
+
+
+class ExportFormat(Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class Cursor(BaseModel):
+    """
+    Position in the transaction history to continue from.
+
+    Passed to clients as an opaque string.
+    """
+
+    created: datetime
+    id: str
+    order: Ordering
+    # Whether the page goes back from this position, i.e. it's the previous page
+    backwards: bool = False
+
+    def encode(self) -> str:
+        data = [self.created.isoformat(), self.id, self.order.value]
+        if self.backwards:
+            data.append(1)
+        return base64.urlsafe_b64encode(
+            json.dumps(data, separators=(",", ":")).encode("utf-8")
+        ).decode("ascii")
+
+    @classmethod
+    def decode(cls, value: str) -> "Cursor":
+        created, id_, order, *backwards = json.loads(
+            base64.urlsafe_b64decode(value.encode("ascii"))
+        )
+        return cls(
+            created=created,
+            id=id_,
+            order=order,
+            backwards=bool(backwards),
+        )
+
+
 class TransactionCreate(BaseModel):
     account_to: Optional[AccountBase] = None
     amount: PositiveInt
@@ -58,6 +156,49 @@ class TransactionCreate(BaseModel):
 
 
 class Transaction(TransactionCreate):
-    id: constr(min_length=1, max_length=255)
+    id: TransactionId
     created: datetime
     account_from: AccountBase
+
+
+class TransactionSummary(BaseModel):
+    # First day of the period
+    period: date
+    type: TransactionType
+    count_in: int = 0
+    amount_in: int = 0
+    count_out: int = 0
+    amount_out: int = 0
+
+
+class TransactionBatchItem(TransactionCreate):
+    id: TransactionId
+
+
+class TransactionBatch(BaseModel):
+    transactions: conlist(
+        TransactionBatchItem, min_items=1, max_items=settings.BATCH_MAX_SIZE
+    )
+    # Apply either all transactions or none of them
+    atomic: bool = True
+
+
+class TransactionResult(BaseModel):
+    id: TransactionId
+    status: TransactionStatus
+
+
+class SlowQuery(BaseModel):
+    """
+    Statement logged by `wallet.slow_queries`. Parameter values are redacted, only their names are kept.
+    """
+
+    started: datetime
+    duration: float
+    # `databases` method the statement was run with, e.g. `fetch_all`
+    method: str
+    sql: str
+    params: list[str]
+    # Rows of `EXPLAIN`, set once it's captured
+    plan: Optional[list[dict]] = None
+    explain_error: Optional[str] = None
@@ -0,0 +1,254 @@
+"""
+On-demand sampling profiler for single requests.
+
+A profiled request is sampled from a background thread every `interval` seconds. Each sample is the
+stack of the request's task: the frames being executed if the task is running, otherwise the chain of
+coroutines it's suspended in, e.g. waiting for the DB or for a password hash. All samples make up
+the wall-clock profile, the ones taken while the task was running make up the CPU profile.
+Profiles are written in the folded stacks format, which flamegraph.pl and speedscope read.
+Each sample is weighted by the microseconds since the previous one: code holding the GIL delays
+the sampler thread, and counting samples would understate it.
+
+The middleware is only installed if `PROFILING_ENABLED` is set, so there's no cost otherwise.
+"""
+from types import FrameType
+from typing import Any, Optional
+
+import asyncio
+import logging
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_ID_HEADER = b"x-profile-id"
+
+# Number of lines with the largest allocation growth written by tracemalloc
+MEMORY_TOP_LINES = 50
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _await_chain(coro: Any) -> list[FrameType]:
+    """
+    Frames of a suspended coroutine and of the coroutines it awaits, the outermost first.
+    """
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(
+            coro, "gi_frame", None
+        )
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(
+            coro, "gi_yieldfrom", None
+        )
+    return frames
+
+
+class Profile:
+    """
+    Samples of one request.
+
+    `root` is the frame of the middleware, frames above it belong to the server and are left out.
+    """
+
+    def __init__(self, task: asyncio.Task, thread_id: int, root: FrameType):
+        self.task = task
+        self.thread_id = thread_id
+        self.root = root
+        # Microseconds spent in each stack
+        self.wall: Counter[str] = Counter()
+        self.cpu: Counter[str] = Counter()
+        self._sampled = time.perf_counter()
+
+    def sample(self, thread_frame: Optional[FrameType], now: float):
+        weight = round((now - self._sampled) * 1e6)
+        self._sampled = now
+        stack = []
+        frame = thread_frame
+        while frame is not None and frame is not self.root:
+            stack.append(frame)
+            frame = frame.f_back
+        if frame is self.root:
+            # The task is running
+            stack.append(frame)
+            stack.reverse()
+            key = ";".join(_frame_name(frame) for frame in stack)
+            self.wall[key] += weight
+            self.cpu[key] += weight
+            return
+
+        chain = _await_chain(self.task.get_coro())
+        for i, frame in enumerate(chain):
+            if frame is self.root:
+                chain = chain[i:]
+                break
+        self.wall[";".join(_frame_name(frame) for frame in chain)] += weight
+
+
+class Sampler:
+    """
+    Thread taking samples of the profiles in progress. It runs only while there are any.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._profiles: set[Profile] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler", daemon=True
+                )
+                self._thread.start()
+
+    def remove(self, profile: Profile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                now = time.perf_counter()
+                frames = sys._current_frames()
+                for profile in self._profiles:
+                    profile.sample(frames.get(profile.thread_id), now)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling requests that carry `token` in the `X-Profile` header, and a `sample_rate`
+    fraction of other requests.
+
+    Profiles are written to `directory` as `<id>.wall.folded` and `<id>.cpu.folded`, and, with `memory`
+    set, the allocation growth during the request as `<id>.memory.txt`. The ID is returned in the
+    `X-Profile-Id` response header.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        directory: str,
+        token: Optional[str] = None,
+        sample_rate: float = 0.0,
+        interval: float = 0.001,
+        memory: bool = False,
+    ):
+        self.app = app
+        self.directory = directory
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        self.memory = memory
+        self.sampler = Sampler(interval)
+        # Profiled requests tracing memory, and whether tracemalloc was started for them
+        self._tracing = 0
+        self._started_tracemalloc = False
+
+    def _should_profile(self, scope: Scope) -> bool:
+        if self.token is not None:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return secrets.compare_digest(value, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = (
+            f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-"
+            f"{uuid.uuid4().hex[:8]}"
+        )
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (PROFILE_ID_HEADER, profile_id.encode()),
+                ]
+            await send(message)
+
+        memory_before = self._start_tracing() if self.memory else None
+        profile = Profile(
+            asyncio.current_task(), threading.get_ident(), sys._getframe()
+        )
+        self.sampler.add(profile)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.sampler.remove(profile)
+            memory = None
+            if memory_before is not None:
+                memory = self._snapshot().compare_to(memory_before, "lineno")
+                self._stop_tracing()
+            title = f"{scope['method']} {scope['path']} in {elapsed:.3f}s"
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._write, profile_id, title, profile, memory
+            )
+            logger.info("Profiled %s: %s", title, profile_id)
+
+    def _start_tracing(self) -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._tracing += 1
+        return self._snapshot()
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+
+    def _stop_tracing(self):
+        # Tracing slows down all allocations, so it's stopped after the last profiled request,
+        # unless it was started by someone else, e.g. with PYTHONTRACEMALLOC
+        self._tracing -= 1
+        if not self._tracing and self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _write(
+        self,
+        profile_id: str,
+        title: str,
+        profile: Profile,
+        memory: Optional[list[tracemalloc.StatisticDiff]],
+    ):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, profile_id)
+        for kind, samples in (("wall", profile.wall), ("cpu", profile.cpu)):
+            with open(f"{path}.{kind}.folded", "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        if memory is not None:
+            with open(f"{path}.memory.txt", "w") as f:
+                f.write(f"{title}\n")
+                for stat in memory[:MEMORY_TOP_LINES]:
+                    f.write(f"{stat}\n")
@@ -0,0 +1,272 @@
+"""
+Ledger reconciliation job. Checks that account balances match the sums of their transactions.
+
+Each run adds transactions created since the previous run to per-account sums in `ledger_sum`
+and reports accounts whose balance differs from the sum. Transactions are read in chunks, and each chunk
+is applied in one DB transaction together with the checkpoint, so an interrupted run resumes where it stopped.
+
+    python -m wallet.reconcile [--all-accounts]
+"""
+from typing import AsyncIterator, Iterable, Optional
+
+import argparse
+import asyncio
+import json
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from databases import Database
+
+from . import models
+from .db import DB, account, ledger_sum, reconcile_checkpoint, transaction
+from .settings import settings
+
+CHECKPOINT_ID = 1
+
+
+class Reconciler:
+    def __init__(
+        self,
+        database: Database,
+        chunk_size: int = settings.RECONCILE_CHUNK_SIZE,
+        lag: float = settings.RECONCILE_LAG,
+    ):
+        self._db = database
+        self.chunk_size = chunk_size
+        self.lag = lag
+        # Number of transactions added to the sums by the last run
+        self.processed = 0
+
+    async def run(
+        self, all_accounts: bool = False
+    ) -> list[models.BalanceMismatch]:
+        """
+        Add new transactions to the sums and check balances.
+
+        Only accounts with new transactions are checked unless `all_accounts` is set.
+        """
+        until = datetime.utcnow() - timedelta(seconds=self.lag)
+        checkpoint = await self.checkpoint()
+        touched: set[int] = set()
+        self.processed = 0
+        async for chunk in self._transactions(checkpoint, until):
+            deltas: Counter[int] = Counter()
+            for row in chunk:
+                DB._balance_deltas(
+                    row["account_from"],
+                    row["account_to"],
+                    row["amount"],
+                    row["type"],
+                    deltas,
+                )
+            last = (chunk[-1]["created"], chunk[-1]["id"])
+            async with self._db.transaction():
+                await self._add_to_sums(deltas)
+                await self._save_checkpoint(last, update=checkpoint is not None)
+            checkpoint = last
+            touched.update(deltas)
+            self.processed += len(chunk)
+
+        return await self._mismatches(
+            checkpoint, None if all_accounts else touched
+        )
+
+    async def checkpoint(self) -> Optional[tuple[datetime, str]]:
+        """
+        `(created, id)` of the last transaction added to the sums.
+        """
+        row = await self._db.fetch_one(
+            sqlalchemy.select(
+                [
+                    reconcile_checkpoint.c.created,
+                    reconcile_checkpoint.c.transaction_id,
+                ]
+            ).where(reconcile_checkpoint.c.id == CHECKPOINT_ID)
+        )
+        if row is None:
+            return None
+        return row["created"], row["transaction_id"]
+
+    async def _transactions(
+        self,
+        after: Optional[tuple[datetime, str]],
+        until: Optional[datetime] = None,
+    ) -> AsyncIterator[list[sqlalchemy.engine.RowProxy]]:
+        """
+        Iterate over transactions after the `(created, id)` key in chunks, in ascending order.
+        """
+        while True:
+            query = transaction.select()
+            if until is not None:
+                query = query.where(transaction.c.created < until)
+            chunk = await self._db.fetch_all(
+                DB._paginate(
+                    query,
+                    transaction.c,
+                    self.chunk_size,
+                    models.Ordering.asc,
+                    after,
+                )
+            )
+            if chunk:
+                yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+            after = (chunk[-1]["created"], chunk[-1]["id"])
+
+    async def _add_to_sums(self, deltas: Counter[int]):
+        await self._db.execute(
+            ledger_sum.insert()
+            .values(
+                [
+                    {"account_id": account_id, "balance": 0}
+                    for account_id in deltas
+                ]
+            )
+            .prefix_with("OR IGNORE", dialect="sqlite")
+            .prefix_with("IGNORE", dialect="mysql")
+        )
+        await self._db.execute(
+            ledger_sum.update()
+            .where(ledger_sum.c.account_id.in_(list(deltas)))
+            .values(
+                balance=ledger_sum.c.balance
+                + sqlalchemy.case(
+                    [
+                        (ledger_sum.c.account_id == account_id, delta)
+                        for account_id, delta in deltas.items()
+                    ],
+                    else_=0,
+                )
+            )
+        )
+
+    async def _save_checkpoint(
+        self, checkpoint: tuple[datetime, str], update: bool
+    ):
+        created, transaction_id = checkpoint
+        values = {"created": created, "transaction_id": transaction_id}
+        if update:
+            await self._db.execute(
+                reconcile_checkpoint.update()
+                .where(reconcile_checkpoint.c.id == CHECKPOINT_ID)
+                .values(**values)
+            )
+        else:
+            await self._db.execute(
+                reconcile_checkpoint.insert().values(id=CHECKPOINT_ID, **values)
+            )
+
+    async def _mismatches(
+        self,
+        checkpoint: Optional[tuple[datetime, str]],
+        account_ids: Optional[Iterable[int]],
+    ) -> list[models.BalanceMismatch]:
+        """
+        Compare balances with the sums, or with zero for accounts without transactions.
+
+        Transactions after the checkpoint are already included in the balances. They are read along
+        with the balances in one DB transaction, so concurrent transactions don't cause false mismatches.
+        """
+        mismatches = []
+        async with self._db.transaction():
+            pending: Counter[int] = Counter()
+            async for chunk in self._transactions(checkpoint):
+                for row in chunk:
+                    DB._balance_deltas(
+                        row["account_from"],
+                        row["account_to"],
+                        row["amount"],
+                        row["type"],
+                        pending,
+                    )
+            async for chunk in self._balances(account_ids):
+                for row in chunk:
+                    expected = (row["expected"] or 0) + pending[row["id"]]
+                    if row["balance"] != expected:
+                        mismatches.append(
+                            models.BalanceMismatch(
+                                account_id=row["id"],
+                                balance=row["balance"],
+                                expected=expected,
+                            )
+                        )
+        return mismatches
+
+    async def _balances(
+        self, account_ids: Optional[Iterable[int]]
+    ) -> AsyncIterator[list[sqlalchemy.engine.RowProxy]]:
+        """
+        Iterate over balances and sums of the accounts, or of all accounts, in chunks.
+        """
+        query = sqlalchemy.select(
+            [
+                account.c.id,
+                account.c.balance,
+                ledger_sum.c.balance.label("expected"),
+            ]
+        ).select_from(
+            account.outerjoin(
+                ledger_sum, ledger_sum.c.account_id == account.c.id
+            )
+        )
+        if account_ids is not None:
+            account_ids = sorted(account_ids)
+            for i in range(0, len(account_ids), self.chunk_size):
+                yield await self._db.fetch_all(
+                    query.where(
+                        account.c.id.in_(account_ids[i : i + self.chunk_size])
+                    )
+                )
+            return
+
+        last_id = None
+        while True:
+            chunk_query = query.order_by(account.c.id).limit(self.chunk_size)
+            if last_id is not None:
+                chunk_query = chunk_query.where(account.c.id > last_id)
+            chunk = await self._db.fetch_all(chunk_query)
+            if chunk:
+                yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+            last_id = chunk[-1]["id"]
+
+
+async def main(all_accounts: bool) -> int:
+    database = Database(settings.DATABASE_URI)
+    await database.connect()
+    try:
+        reconciler = Reconciler(database)
+        mismatches = await reconciler.run(all_accounts=all_accounts)
+        checkpoint = await reconciler.checkpoint()
+    finally:
+        await database.disconnect()
+    for mismatch in mismatches:
+        print(mismatch.json())
+    print(
+        json.dumps(
+            {
+                "processed": reconciler.processed,
+                "checkpoint": [checkpoint[0].isoformat(), checkpoint[1]]
+                if checkpoint
+                else None,
+                "mismatches": len(mismatches),
+            }
+        ),
+        file=sys.stderr,
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--all-accounts",
+        action="store_true",
+        help="Check all accounts, not only the ones with new transactions",
+    )
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.all_accounts)))
@@ -0,0 +1,40 @@
+"""
+Fills in transaction rollup rows, see `DB.get_summary`, for days before they were maintained on writes.
+
+    python -m wallet.rollup --from 2021-01-01 [--to 2021-06-30]
+"""
+import argparse
+import asyncio
+from datetime import date, datetime, timedelta
+
+from .db import DB
+from .settings import settings
+
+
+async def main(date_from: date, date_to: date):
+    db = DB(settings.DATABASE_URI)
+    await db.connect()
+    try:
+        day = date_from
+        while day <= date_to:
+            await db.rebuild_rollup(day)
+            print(f"Rebuilt {day.isoformat()}")
+            day += timedelta(days=1)
+    finally:
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--from", dest="date_from", type=date.fromisoformat, required=True
+    )
+    parser.add_argument(
+        "--to",
+        dest="date_to",
+        type=date.fromisoformat,
+        default=datetime.utcnow().date() - timedelta(days=1),
+        help="Last day to rebuild, yesterday by default",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.date_from, args.date_to))
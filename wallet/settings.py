@@ -1,3 +1,5 @@
+from typing import Literal, Optional
+
 import secrets
 
 from pydantic import BaseSettings
@@ -8,11 +10,102 @@ class Settings(BaseSettings):
 
     DATABASE_URI: str = "sqlite:///db.sqlite3"
     TEST_DATABASE_URI: str = "sqlite:///testdb.sqlite3"
+    # History reads use a separate pool if set. It can be the same DB as DATABASE_URI or a replica.
+    DATABASE_READ_URI: Optional[str] = None
+    # Maximum number of connections in the primary and the read pool. Not used with SQLite.
+    DATABASE_POOL_SIZE: Optional[int] = None
+    DATABASE_READ_POOL_SIZE: Optional[int] = None
+    # Accounts that were written to in this many seconds are read from the primary
+    READ_YOUR_WRITES_WINDOW: float = 5.0
 
     SALT_LENGTH = 32
 
     TOPUP_ACCOUNT_ID = 1
 
+    # Recently verified credentials are cached to skip password hashing.
+    # Set the size to 0 to disable the cache.
+    CREDENTIAL_CACHE_SIZE: int = 1024
+    CREDENTIAL_CACHE_TTL: float = 60.0
+
+    # Password hashing runs off the event loop in this pool.
+    # The number of workers defaults to the `concurrent.futures` default for the pool kind.
+    PASSWORD_HASH_EXECUTOR: Literal["thread", "process"] = "thread"
+    PASSWORD_HASH_WORKERS: Optional[int] = None
+
+    # Lifetime of session tokens in seconds. Tokens are signed with SECRET_KEY,
+    # so it has to be set explicitly for tokens to be valid across workers and restarts.
+    TOKEN_TTL: int = 900
+
+    BATCH_MAX_SIZE: int = 1000
+
+    # Number of account usernames cached for reading transactions
+    USERNAME_CACHE_SIZE: int = 100000
+
+    # Number of recently created transaction IDs remembered to answer retries without querying the DB
+    RECENT_TRANSACTIONS_CACHE_SIZE: int = 10000
+
+    # Number of transactions read from the DB at a time by the history export
+    EXPORT_CHUNK_SIZE: int = 500
+
+    # Number of transactions processed at a time by the reconciliation job.
+    # Transactions created in the last RECONCILE_LAG seconds are left for the next run,
+    # as transactions with earlier timestamps may still be committed during that time.
+    RECONCILE_CHUNK_SIZE: int = 1000
+    RECONCILE_LAG: float = 60.0
+
+    # Transactions older than this many days are moved to the archive table by `wallet.archive`
+    ARCHIVE_AFTER_DAYS: int = 180
+    # Number of transactions read and deleted at a time by the archival job
+    ARCHIVE_CHUNK_SIZE: int = 1000
+    # How often the API re-reads the archive watermark, in seconds.
+    # The archival job waits for twice as long before deleting archived transactions.
+    ARCHIVE_WATERMARK_TTL: float = 60.0
+
+    # Transactions submitted with `Prefer: respond-async` are applied by a worker
+    # in batches of up to QUEUE_BATCH_SIZE. The worker runs in each API process if QUEUE_WORKER is set,
+    # otherwise run `python -m wallet.worker` separately.
+    QUEUE_WORKER: bool = True
+    QUEUE_BATCH_SIZE: int = 500
+    # Seconds between checks of an empty queue. Submissions to the same process wake the worker up at once.
+    QUEUE_POLL_INTERVAL: float = 1.0
+    # Workers claim the transactions they process for this many seconds. Transactions that couldn't be applied
+    # are retried once the claim expires, and marked as failed after QUEUE_MAX_ATTEMPTS attempts.
+    QUEUE_CLAIM_TIMEOUT: float = 60.0
+    QUEUE_MAX_ATTEMPTS: int = 3
+    # Statuses of processed transactions are kept for this many hours
+    QUEUE_RESULT_TTL: int = 168
+
+    # Concurrent transaction requests admitted per account and in total, and the number of requests
+    # waiting for a slot. Requests that don't fit into a queue are rejected with 429 and Retry-After
+    # set to ADMISSION_RETRY_AFTER seconds. A limit of None disables it.
+    ADMISSION_ACCOUNT_LIMIT: Optional[int] = 2
+    ADMISSION_ACCOUNT_QUEUE_SIZE: int = 8
+    ADMISSION_GLOBAL_LIMIT: Optional[int] = None
+    ADMISSION_GLOBAL_QUEUE_SIZE: int = 100
+    ADMISSION_RETRY_AFTER: int = 1
+
+    # Serve Prometheus metrics on /metrics, see `wallet.metrics`.
+    # The endpoint isn't authenticated, so don't expose it publicly.
+    METRICS_ENABLED: bool = True
+
+    # Statements taking at least this many seconds are logged along with their query plan,
+    # see `wallet.slow_queries`. None disables the log. The latest SLOW_QUERY_LOG_SIZE
+    # statements are served on /admin/slow-queries.
+    SLOW_QUERY_THRESHOLD: Optional[float] = 0.5
+    SLOW_QUERY_LOG_SIZE: int = 100
+
+    # Token for admin endpoints, passed in the X-Admin-Token header. Admin endpoints are disabled if it's not set.
+    ADMIN_TOKEN: Optional[str] = None
+
+    # Profile requests that carry ADMIN_TOKEN in the X-Profile header, and a PROFILING_SAMPLE_RATE fraction
+    # of other requests, see `wallet.profiling`. Stacks are sampled every PROFILING_INTERVAL seconds.
+    # With PROFILING_MEMORY set, allocations are traced during profiled requests, which slows down the process.
+    PROFILING_ENABLED: bool = False
+    PROFILING_SAMPLE_RATE: float = 0.0
+    PROFILING_INTERVAL: float = 0.001
+    PROFILING_DIR: str = "profiles"
+    PROFILING_MEMORY: bool = False
+
     class Config:
         case_sensitive = True
 
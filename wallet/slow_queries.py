@@ -0,0 +1,203 @@
+"""
+Slow-query log.
+
+Statements running longer than a threshold are logged with their SQL and the names of their
+parameters, values are left out as they contain account data. The query plan is captured with
+`EXPLAIN` in the background, on a separate connection, so the request that ran the query isn't delayed.
+Only a few statements are explained at a time, see `MAX_EXPLAINS`.
+The latest entries are kept in memory for `GET /admin/slow-queries`.
+"""
+from typing import Any, Optional, Union
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from databases import Database
+from sqlalchemy.sql import ClauseElement
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+Query = Union[ClauseElement, str]
+
+EXPLAIN_PREFIXES = {"sqlite": "EXPLAIN QUERY PLAN ", "mysql": "EXPLAIN "}
+# EXPLAINs running at once. Statements are usually slow when the DB is overloaded,
+# so plans of further statements aren't captured rather than adding to the load.
+MAX_EXPLAINS = 2
+
+
+class SlowQueryLog:
+    """
+    Ring buffer of the latest `size` statements that took at least `threshold` seconds.
+
+    A threshold of `None` disables the log.
+    """
+
+    def __init__(self, threshold: Optional[float], size: int):
+        self.threshold = threshold
+        self._entries: deque[models.SlowQuery] = deque(maxlen=size)
+        # EXPLAIN tasks in progress, referenced so they aren't garbage collected
+        self._tasks: set[asyncio.Task] = set()
+        # SQL of the statements being explained
+        self._explaining: set[str] = set()
+
+    def entries(self) -> list[models.SlowQuery]:
+        """
+        Logged statements, the latest first.
+        """
+        return list(reversed(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+
+    def record(
+        self,
+        database: Database,
+        method: str,
+        query: Query,
+        values: Optional[dict],
+        duration: float,
+    ):
+        if self.threshold is None or duration < self.threshold:
+            return
+        clause = database.connection()._build_query(query, values)
+        compiled = clause.compile(dialect=database._backend._dialect)
+        entry = models.SlowQuery(
+            started=datetime.utcnow() - timedelta(seconds=duration),
+            duration=duration,
+            method=method,
+            sql=compiled.string,
+            params=sorted(compiled.params),
+        )
+        self._entries.append(entry)
+        logger.warning(
+            "Slow query (%.3fs, %s): %s Params: %s",
+            duration,
+            method,
+            " ".join(entry.sql.split()),
+            ", ".join(entry.params),
+        )
+        if entry.sql in self._explaining:
+            entry.explain_error = (
+                "Skipped, the same statement is being explained"
+            )
+            return
+        if len(self._explaining) >= MAX_EXPLAINS:
+            entry.explain_error = (
+                "Skipped, too many statements are being explained"
+            )
+            return
+        # Started in an empty context: `databases` keeps the connection of the task in a context variable,
+        # and a copy of the caller's context would run the EXPLAIN on the caller's connection,
+        # next to its following statements and inside its transaction
+        task = contextvars.Context().run(
+            asyncio.get_running_loop().create_task,
+            self._explain(database, clause, entry),
+        )
+        self._tasks.add(task)
+        self._explaining.add(entry.sql)
+
+        def done(task: asyncio.Task):
+            self._tasks.discard(task)
+            self._explaining.discard(entry.sql)
+
+        task.add_done_callback(done)
+
+    async def join(self):
+        """
+        Wait for plans of the logged statements to be captured.
+        """
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    @staticmethod
+    async def _explain(
+        database: Database, clause: ClauseElement, entry: models.SlowQuery
+    ):
+        """
+        Run `EXPLAIN` for the statement with its original parameters and store the plan in `entry`.
+        """
+        prefix = EXPLAIN_PREFIXES.get(database.url.dialect)
+        if prefix is None:
+            entry.explain_error = (
+                f"EXPLAIN isn't supported for {database.url.dialect}"
+            )
+            return
+        try:
+            async with database.connection() as connection:
+                # Compiled by the backend like `databases` does it, so parameters are bound the same way
+                sql, args, _ = connection._connection._compile(clause)
+                cursor = await connection.raw_connection.cursor()
+                try:
+                    await cursor.execute(prefix + sql, args)
+                    columns = [column[0] for column in cursor.description]
+                    rows = await cursor.fetchall()
+                finally:
+                    await cursor.close()
+        except Exception as e:
+            entry.explain_error = f"{type(e).__name__}: {e}"
+            logger.warning("Failed to explain a slow query: %s", e)
+            return
+        entry.plan = [dict(zip(columns, row)) for row in rows]
+
+
+class LoggedDatabase(Database):
+    """
+    `Database` that reports statements taking longer than the log's threshold to `slow_query_log`.
+    """
+
+    def __init__(self, *args, slow_query_log: SlowQueryLog, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slow_query_log = slow_query_log
+
+    async def _timed(self, method: str, query: Query, values, run):
+        start = time.perf_counter()
+        try:
+            return await run
+        finally:
+            self.slow_query_log.record(
+                self,
+                method,
+                query,
+                values,
+                time.perf_counter() - start,
+            )
+
+    async def fetch_all(self, query: Query, values: dict = None) -> list:
+        return await self._timed(
+            "fetch_all", query, values, super().fetch_all(query, values)
+        )
+
+    async def fetch_one(self, query: Query, values: dict = None) -> Any:
+        return await self._timed(
+            "fetch_one", query, values, super().fetch_one(query, values)
+        )
+
+    async def fetch_val(
+        self, query: Query, values: dict = None, column: Any = 0
+    ) -> Any:
+        return await self._timed(
+            "fetch_val",
+            query,
+            values,
+            super().fetch_val(query, values, column=column),
+        )
+
+    async def execute(self, query: Query, values: dict = None) -> Any:
+        return await self._timed(
+            "execute", query, values, super().execute(query, values)
+        )
+
+    async def execute_many(self, query: Query, values: list) -> None:
+        # Parameters of the first row are enough to explain the statement
+        return await self._timed(
+            "execute_many",
+            query,
+            values[0] if values else None,
+            super().execute_many(query, values),
+        )
@@ -0,0 +1,107 @@
+"""
+Worker applying transactions submitted with `Prefer: respond-async`, see `DB.process_queue`.
+
+Runs in each API process if `QUEUE_WORKER` is set. Workers claim the transactions they process,
+so workers in several processes don't pick up the same ones. It can also run on its own:
+
+    python -m wallet.worker
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from .db import DB
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds between deletions of old queue entries
+PRUNE_INTERVAL = 3600.0
+
+
+class Worker:
+    def __init__(
+        self,
+        db: DB,
+        batch_size: int = settings.QUEUE_BATCH_SIZE,
+        poll_interval: float = settings.QUEUE_POLL_INTERVAL,
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        # Created by `run`, so it belongs to the loop the worker runs in
+        self._wakeup = None
+        self._task = None
+        self._pruned = None
+
+    def wake(self):
+        """
+        Process the queue now instead of after the poll interval.
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                processed = await self.drain()
+                if self._pruned is None or (
+                    time.monotonic() - self._pruned >= PRUNE_INTERVAL
+                ):
+                    await self.db.prune_queue(
+                        datetime.utcnow()
+                        - timedelta(hours=settings.QUEUE_RESULT_TTL)
+                    )
+                    self._pruned = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to process the transaction queue")
+                processed = 0
+            if not processed:
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), self.poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+
+    async def drain(self) -> int:
+        """
+        Process queued transactions until the queue is empty. Returns the number of processed transactions.
+        """
+        total = 0
+        while True:
+            processed = await self.db.process_queue(self.batch_size)
+            total += processed
+            if processed < self.batch_size:
+                return total
+
+
+async def main():
+    db = DB(settings.DATABASE_URI)
+    await db.connect()
+    try:
+        await Worker(db).run()
+    finally:
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())